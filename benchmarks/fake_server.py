@@ -0,0 +1,401 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+"""Local HTTP server imitating a ServiceNow instance
+
+Serves the Table API (/api/now/table), the Aggregate API (/api/now/stats),
+the Import Set API (/api/now/import), the Batch API (/api/now/v1/batch)
+and the legacy JSONv2 processor
+(<table>.do?JSONv2) from in-memory tables, so the client can be benchmarked
+end-to-end through its real HTTP stack.
+"""
+
+import base64
+import json
+import random
+import threading
+import time
+import uuid
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlsplit, parse_qs
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlsplit, parse_qs
+
+
+OPERATORS = ('!=', '>=', '<=', '=', '>', '<', 'NOT IN', 'NOT LIKE',
+             'IN', 'LIKE', 'STARTSWITH', 'ENDSWITH')
+
+
+def _match(row, condition):
+    for op in OPERATORS:
+        if op in condition:
+            key, val = condition.split(op, 1)
+            break
+    else:
+        return True
+    field = row.get(key, '')
+    if op == '=':
+        return field == val
+    if op == '!=':
+        return field != val
+    if op == '>=':
+        return field >= val
+    if op == '<=':
+        return field <= val
+    if op == '>':
+        return field > val
+    if op == '<':
+        return field < val
+    if op == 'IN':
+        return field in val.split(',')
+    if op == 'NOT IN':
+        return field not in val.split(',')
+    if op == 'LIKE':
+        return val in field
+    if op == 'NOT LIKE':
+        return val not in field
+    if op == 'STARTSWITH':
+        return field.startswith(val)
+    return field.endswith(val)
+
+
+def select(rows, query):
+    """Filters and orders rows following an encoded query"""
+    order = []
+    clauses = []
+    for part in (query or '').split('^'):
+        if part == '':
+            continue
+        if part.startswith('ORDERBYDESC'):
+            order.append((part[len('ORDERBYDESC'):], True))
+        elif part.startswith('ORDERBY'):
+            order.append((part[len('ORDERBY'):], False))
+        elif part.startswith('OR') and len(clauses) > 0:
+            clauses[-1].append(part[2:])
+        else:
+            clauses.append([part])
+    result = [row for row in rows
+              if all(any(_match(row, c) for c in clause)
+                     for clause in clauses)]
+    for field, desc in reversed(order):
+        result.sort(key=lambda r: r.get(field, ''), reverse=desc)
+    return result
+
+
+class FakeInstance(object):
+    """In-memory ServiceNow data with a configurable cost model
+
+    - latency: seconds added to every request
+    - row_cost: seconds added for each row returned by a request
+    - max_rps: requests allowed per second before answering 429
+
+    `transform_maps` maps a staging table to (target table, coalesce
+    field or None); rows imported into other staging tables are ignored.
+    """
+    def __init__(self, latency=0.0, row_cost=0.0, max_rps=None, seed=0):
+        self.latency = latency
+        self.row_cost = row_cost
+        self.max_rps = max_rps
+        self.tables = {'sys_dictionary': [], 'sys_db_object': [],
+                       'sys_choice': []}
+        self.transform_maps = {}
+        self.requests = 0
+        self.throttled = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._window = (0, 0)
+
+    def populate(self, table, count, display='number'):
+        """Creates `count` rows in `table` with a few repeated columns"""
+        rows = self.tables.setdefault(table, [])
+        for i in range(len(rows), len(rows) + count):
+            stamp = '2020-01-01 00:00:{0:02d}'.format(i % 60)
+            rows.append({
+                'sys_id': uuid.UUID(int=self._random.getrandbits(128)).hex,
+                'number': '{0}{1:07d}'.format(table[:3].upper(), i),
+                'state': self._random.choice(('New', 'In Progress',
+                                              'Closed')),
+                'priority': str(self._random.randint(1, 5)),
+                'short_description': 'Generated record {0}'.format(i),
+                'sys_created_on': stamp,
+                'sys_updated_on': stamp,
+            })
+        if not select(self.tables['sys_dictionary'],
+                      'name={0}^display=true'.format(table)):
+            self.tables['sys_dictionary'].append(
+                {'sys_id': uuid.uuid4().hex, 'name': table,
+                 'element': display, 'display': 'true'})
+            self.tables['sys_db_object'].append(
+                {'sys_id': uuid.uuid4().hex, 'name': table,
+                 'super_class': ''})
+        return rows
+
+    def reset_counters(self):
+        with self._lock:
+            self.requests = 0
+            self.throttled = 0
+
+    def _admit(self):
+        with self._lock:
+            self.requests += 1
+            if self.max_rps is None:
+                return True
+            second = int(time.time())
+            start, count = self._window
+            if start != second:
+                start, count = second, 0
+            self._window = (start, count + 1)
+            if count >= self.max_rps:
+                self.throttled += 1
+                return False
+            return True
+
+    def _cost(self, rows):
+        delay = self.latency + self.row_cost * rows
+        if delay > 0:
+            time.sleep(delay)
+
+    @staticmethod
+    def _project(row, fields, display_value):
+        if fields:
+            row = dict((f, row.get(f, '')) for f in fields.split(','))
+        if display_value in ('all', 'true'):
+            if display_value == 'true':
+                return dict(row)
+            return dict((k, {'value': v, 'display_value': v})
+                        for k, v in row.items())
+        return dict(row)
+
+    def table(self, method, table, sys_id, params, body):
+        rows = self.tables.setdefault(table, [])
+        if method == 'POST':
+            record = dict(body or {})
+            record.setdefault('sys_id', uuid.uuid4().hex)
+            rows.append(record)
+            return 201, {'result': record}
+        if sys_id is not None:
+            matches = [r for r in rows if r['sys_id'] == sys_id]
+            if len(matches) == 0:
+                return 404, {'error': {'message': 'No Record found'}}
+            if method == 'DELETE':
+                rows.remove(matches[0])
+                return 204, None
+            if method in ('PUT', 'PATCH'):
+                matches[0].update(body or {})
+            return 200, {'result': self._project(
+                matches[0], params.get('sysparm_fields'),
+                params.get('sysparm_display_value'))}
+        result = select(rows, params.get('sysparm_query'))
+        offset = int(params.get('sysparm_offset', 0))
+        limit = int(params.get('sysparm_limit', 10000))
+        return 200, {'result': [
+            self._project(r, params.get('sysparm_fields'),
+                          params.get('sysparm_display_value'))
+            for r in result[offset:offset + limit]]}
+
+    @staticmethod
+    def _aggregate(rows, params):
+        stats = {}
+        if params.get('sysparm_count') == 'true':
+            stats['count'] = str(len(rows))
+        for agg in ('min', 'max', 'sum', 'avg'):
+            fields = params.get('sysparm_{0}_fields'.format(agg))
+            if not fields:
+                continue
+            stats[agg] = {}
+            for field in fields.split(','):
+                values = [r.get(field, '') for r in rows]
+                if agg in ('sum', 'avg'):
+                    values = [float(v) for v in values if v != '']
+                if len(values) == 0:
+                    stats[agg][field] = ''
+                elif agg == 'min':
+                    stats[agg][field] = str(min(values))
+                elif agg == 'max':
+                    stats[agg][field] = str(max(values))
+                elif agg == 'sum':
+                    stats[agg][field] = str(sum(values))
+                else:
+                    stats[agg][field] = str(sum(values) / len(values))
+        return stats
+
+    def stats(self, table, params):
+        rows = select(self.tables.get(table, []), params.get('sysparm_query'))
+        group_by = params.get('sysparm_group_by')
+        if not group_by:
+            return 200, {'result': {'stats': self._aggregate(rows, params)}}
+        fields = group_by.split(',')
+        groups = {}
+        for row in rows:
+            key = tuple(row.get(f, '') for f in fields)
+            groups.setdefault(key, []).append(row)
+        return 200, {'result': [{
+            'stats': self._aggregate(members, params),
+            'groupby_fields': [{'field': f, 'value': v}
+                               for f, v in zip(fields, key)],
+        } for key, members in sorted(groups.items())]}
+
+    def import_set(self, staging, body):
+        rows = self.tables.setdefault(staging, [])
+        set_id = uuid.uuid4().hex
+        target, coalesce = self.transform_maps.get(staging, (None, None))
+        for i, record in enumerate((body or {}).get('records', [])):
+            row = dict(record, sys_id=uuid.uuid4().hex,
+                       sys_import_set=set_id, sys_import_row=str(i))
+            if target is None:
+                row.update(sys_import_state='ignored',
+                           sys_import_state_comment='No transform map')
+            else:
+                records = self.tables.setdefault(target, [])
+                matches = [r for r in records if coalesce is not None and
+                           r.get(coalesce) == record.get(coalesce)]
+                if matches:
+                    matches[0].update(record)
+                    state = 'updated'
+                else:
+                    matches = [dict(record, sys_id=uuid.uuid4().hex)]
+                    records.append(matches[0])
+                    state = 'inserted'
+                row.update(sys_import_state=state, sys_target_table=target,
+                           sys_target_sys_id=matches[0]['sys_id'])
+            rows.append(row)
+        return 201, {'import_set_id': set_id,
+                     'multi_import_set_id': uuid.uuid4().hex}
+
+    def jsonv2(self, table, params, body):
+        rows = self.tables.setdefault(table, [])
+        action = params.get('sysparm_action')
+        if action is None:
+            action = 'get' if 'sysparm_sys_id' in params else 'getRecords'
+        if action == 'get':
+            result = [r for r in rows
+                      if r['sys_id'] == params.get('sysparm_sys_id')]
+        elif action == 'getKeys':
+            result = [','.join(r['sys_id'] for r in select(
+                rows, params.get('sysparm_query')))]
+        elif action == 'getRecords':
+            result = select(rows, params.get('sysparm_query'))
+        elif action == 'insert':
+            record = dict(body or {})
+            record.setdefault('sys_id', uuid.uuid4().hex)
+            rows.append(record)
+            result = [record]
+        elif action == 'update':
+            result = select(rows, params.get('sysparm_query'))
+            for row in result:
+                row.update(body or {})
+        elif action == 'deleteRecord':
+            result = [r for r in rows
+                      if r['sys_id'] == params.get('sysparm_sys_id')]
+            for row in result:
+                rows.remove(row)
+        else:
+            return 400, {'error': 'unknown action {0}'.format(action)}
+        return 200, {'records': result}
+
+    def batch(self, body):
+        serviced = []
+        for request in (body or {}).get('rest_requests', []):
+            data = request.get('body')
+            if data:
+                data = json.loads(base64.b64decode(data).decode('utf-8'))
+            status, payload = self._route(request['method'], request['url'],
+                                          data or None)
+            data = json.dumps(payload).encode('utf-8') \
+                if payload is not None else b''
+            serviced.append({
+                'id': request['id'], 'status_code': status,
+                'status_text': 'OK' if status < 400 else 'Error',
+                'headers': [], 'execution_time': 0,
+                'body': base64.b64encode(data).decode('ascii')})
+        return 200, {'batch_request_id': (body or {}).get('batch_request_id'),
+                     'serviced_requests': serviced,
+                     'unserviced_requests': []}
+
+    def handle(self, method, url, body):
+        """Returns (status, payload) for a request"""
+        if not self._admit():
+            return 429, {'error': {'message': 'Too Many Requests'}}
+        status, payload = self._route(method, url, body)
+        result = payload.get('result', payload.get('records')) \
+            if isinstance(payload, dict) else None
+        self._cost(len(result) if isinstance(result, list) else 1)
+        return status, payload
+
+    def _route(self, method, url, body):
+        parts = urlsplit(url)
+        params = dict((k, v[-1]) for k, v in parse_qs(
+            parts.query, keep_blank_values=True).items())
+        path = [p for p in parts.path.split('/') if p != '']
+        if len(path) >= 4 and path[:3] == ['api', 'now', 'table']:
+            status, payload = self.table(
+                method, path[3], path[4] if len(path) > 4 else None,
+                params, body)
+        elif len(path) == 4 and path[:3] == ['api', 'now', 'stats']:
+            status, payload = self.stats(path[3], params)
+        elif len(path) == 5 and path[:3] == ['api', 'now', 'import'] and \
+                path[4] == 'insertMultiple' and method == 'POST':
+            status, payload = self.import_set(path[3], body)
+        elif path == ['api', 'now', 'v1', 'batch'] and method == 'POST':
+            status, payload = self.batch(body)
+        elif len(path) == 1 and path[0].endswith('.do'):
+            status, payload = self.jsonv2(path[0][:-3], params, body)
+        else:
+            status, payload = 404, {'error': {'message': 'Invalid path'}}
+        return status, payload
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def _dispatch(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = json.loads(self.rfile.read(length).decode('utf-8')) \
+            if length > 0 else None
+        status, payload = self.server.instance.handle(
+            self.command, self.path, body)
+        data = json.dumps(payload).encode('utf-8') \
+            if payload is not None else b''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    do_GET = do_POST = do_PUT = do_PATCH = do_DELETE = _dispatch
+
+
+class FakeServer(ThreadingMixIn, HTTPServer):
+    """Threaded HTTP server bound to a FakeInstance
+
+    Use as a context manager; `url` is the instance base URL.
+    """
+    daemon_threads = True
+
+    def __init__(self, instance, host='127.0.0.1', port=0):
+        HTTPServer.__init__(self, (host, port), _Handler)
+        self.instance = instance
+        self._thread = None
+
+    @property
+    def url(self):
+        return 'http://{0}:{1}'.format(*self.server_address[:2])
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
+        self.server_close()
+        self._thread.join()
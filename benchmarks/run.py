@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+"""End-to-end benchmarks against a local fake ServiceNow instance
+
+    python benchmarks/run.py --rows 5000 --output bench.json
+    python benchmarks/run.py --compare bench.json
+    python benchmarks/run.py --transport fake
+
+Each benchmark reports wall time, rows/sec and the number of HTTP requests
+the operation needed. Results can be saved and compared to a previous run.
+With `--transport fake` requests are answered in-process, without sockets,
+to profile the client alone.
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import servicenow.importset  # noqa
+import servicenow.table  # noqa
+import servicenow.transport  # noqa
+import servicenow.ws  # noqa
+from benchmarks.fake_server import FakeInstance, FakeServer  # noqa
+
+TABLE = 'incident'
+
+
+def bench_iter(snow, instance, rows):
+    return sum(1 for _ in snow.Table(TABLE))
+
+
+def bench_parallel_scan(snow, instance, rows):
+    return sum(1 for _ in snow.Table(TABLE).parallel_scan(partitions=8,
+                                                          workers=4))
+
+
+def bench_len(snow, instance, rows):
+    len(snow.Table(TABLE))
+    return 1
+
+
+def bench_search(snow, instance, rows):
+    return sum(1 for _ in snow.Table(TABLE).search('state=New'))
+
+
+def bench_insert(snow, instance, rows):
+    table = snow.Table(TABLE + '_insert')
+    count = min(rows, 200)
+    for i in range(count):
+        table.insert({'number': 'BENCH{0:07d}'.format(i), 'state': 'New'})
+    return count
+
+
+def bench_import_set(snow, instance, rows):
+    instance.transform_maps['u_imp_' + TABLE] = (TABLE + '_import', 'number')
+    importset = servicenow.importset.ImportSet(snow, 'u_imp_' + TABLE,
+                                               chunk_size=500)
+    return sum(1 for _ in importset.load(
+        {'number': r['number'], 'state': r['state']}
+        for r in instance.tables[TABLE]))
+
+
+def bench_sysid_to_value(snow, instance, rows):
+    records = instance.tables[TABLE][:min(rows, 100)]
+    for record in records:
+        snow.sysid_to_value(TABLE, record['sys_id'])
+    return len(records)
+
+
+def bench_ws_get(snow, instance, rows):
+    ws = servicenow.ws.ServiceNow(snow.url, 'admin', 'admin',
+                                  transport=snow.transport)
+    records = instance.tables[TABLE][:min(rows, 100)]
+    for record in records:
+        ws.get('{0}/{1}'.format(TABLE, record['sys_id']))
+    return len(records)
+
+
+def bench_ws_get_records(snow, instance, rows):
+    ws = servicenow.ws.ServiceNow(snow.url, 'admin', 'admin',
+                                  transport=snow.transport)
+    return len(ws.get(TABLE, query='state=New'))
+
+
+def bench_ws_bulk_get(snow, instance, rows):
+    ws = servicenow.ws.ServiceNow(snow.url, 'admin', 'admin',
+                                  transport=snow.transport)
+    return sum(1 for _ in ws.bulk_get(TABLE, query='state=New'))
+
+
+BENCHMARKS = (
+    ('table_iter', bench_iter),
+    ('table_parallel_scan', bench_parallel_scan),
+    ('table_len', bench_len),
+    ('table_search', bench_search),
+    ('table_insert', bench_insert),
+    ('import_set', bench_import_set),
+    ('sysid_to_value', bench_sysid_to_value),
+    ('ws_get', bench_ws_get),
+    ('ws_get_records', bench_ws_get_records),
+    ('ws_bulk_get', bench_ws_bulk_get),
+)
+
+
+def run(args):
+    instance = FakeInstance(latency=args.latency, row_cost=args.row_cost,
+                            max_rps=args.max_rps)
+    instance.populate(TABLE, args.rows)
+    if args.transport == 'fake':
+        server = None
+        url = 'http://fake'
+        transport = servicenow.transport.FakeTransport(instance)
+    else:
+        server = FakeServer(instance).__enter__()
+        url = server.url
+        transport = args.transport
+    results = {}
+    try:
+        for name, func in BENCHMARKS:
+            if args.only and name not in args.only:
+                continue
+            best = None
+            for _ in range(args.repeat):
+                snow = servicenow.table.ServiceNow(url, 'admin', 'admin',
+                                                   transport=transport)
+                instance.reset_counters()
+                start = time.time()
+                try:
+                    rows = func(snow, instance, args.rows)
+                except servicenow.ServiceNowHttpError as e:
+                    results[name] = {'error': str(e),
+                                     'requests': instance.requests,
+                                     'throttled': instance.throttled}
+                    break
+                elapsed = time.time() - start
+                if best is None or elapsed < best['seconds']:
+                    best = {
+                        'seconds': round(elapsed, 4),
+                        'rows': rows,
+                        'rows_per_sec': round(rows / elapsed, 1)
+                        if elapsed > 0 else None,
+                        'requests': instance.requests,
+                        'throttled': instance.throttled,
+                    }
+            else:
+                results[name] = best
+    finally:
+        if server is not None:
+            server.__exit__(None, None, None)
+    return results
+
+
+def compare(results, baseline):
+    lines = ['{0:<20} {1:>12} {2:>12} {3:>8} {4:>10}'.format(
+        'benchmark', 'rows/sec', 'baseline', 'ratio', 'requests')]
+    for name, res in sorted(results.items()):
+        if 'error' in res:
+            lines.append('{0:<20} {1}'.format(name, res['error']))
+            continue
+        old = baseline.get(name, {})
+        ratio = ''
+        if old.get('rows_per_sec') and res['rows_per_sec']:
+            ratio = '{0:.2f}x'.format(res['rows_per_sec'] /
+                                      old['rows_per_sec'])
+        lines.append('{0:<20} {1:>12} {2:>12} {3:>8} {4:>5}/{5:<5}'.format(
+            name, res['rows_per_sec'], old.get('rows_per_sec', '-'), ratio,
+            res['requests'], old.get('requests', '-')))
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=2000,
+                        help='rows in the benchmarked table')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds added to every request')
+    parser.add_argument('--row-cost', type=float, default=0.0,
+                        help='seconds added for each returned row')
+    parser.add_argument('--max-rps', type=int, default=None,
+                        help='requests per second before throttling (429)')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='runs per benchmark, the fastest is kept')
+    parser.add_argument('--transport', default=None,
+                        choices=['fake', 'auto'] +
+                        sorted(servicenow.transport.TRANSPORTS),
+                        help='HTTP library of the client, fake answers '
+                        'in-process without a server')
+    parser.add_argument('--only', action='append',
+                        help='run only the named benchmark')
+    parser.add_argument('--output', help='save results to this JSON file')
+    parser.add_argument('--compare', help='JSON results to compare against')
+    args = parser.parse_args(argv)
+
+    results = run(args)
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f).get('results', {})
+    print(compare(results, baseline))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'params': vars(args), 'results': results}, f,
+                      indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,23 +2,26 @@
 # -*- coding: utf-8 -*-
 # vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
 
-import json
+import base64
+import itertools
 import logging
-import ssl
+import re
+import threading
+import time
+
+from collections import deque
+from servicenow.budget import Budget
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait
+from servicenow.codec import get_codec
+from servicenow.concurrency import SingleFlight, bind, bounded_map
+from servicenow.concurrency import deadline, remaining
+from servicenow.transport import FileChunks, TransportError, get_transport
 
 try:
-    from urllib.request import HTTPPasswordMgrWithDefaultRealm, HTTPSHandler
-    from urllib.request import HTTPBasicAuthHandler, ProxyHandler
-    from urllib.request import build_opener, Request
-    from urllib.error import HTTPError, URLError
-    from http.client import BadStatusLine
-    from urllib.parse import quote
+    from urllib.parse import quote, urlsplit
 except ImportError:
-    from urllib2 import HTTPPasswordMgrWithDefaultRealm, HTTPSHandler
-    from urllib2 import HTTPBasicAuthHandler, ProxyHandler
-    from urllib2 import build_opener, Request, HTTPError, URLError
-    from httplib import BadStatusLine
     from urllib import quote
+    from urlparse import urlsplit
 
 
 class ServiceNowDecodeError(Exception):
@@ -42,6 +45,33 @@ class ServiceNowHttpError(Exception):
             self.code, self.message, self.url)
 
 
+class ServiceNowDeadlineExceeded(Exception):
+    def __init__(self, url):
+        self.url = url
+
+    def __str__(self):
+        return 'Deadline exceeded before {0}'.format(self.url)
+
+
+class ServiceNowCircuitOpen(Exception):
+    def __init__(self, url, retry_after):
+        self.url = url
+        self.retry_after = retry_after
+
+    def __str__(self):
+        return 'Circuit open, retry in {0:.1f}s: {1}'.format(
+            self.retry_after, self.url)
+
+
+class ServiceNowBudgetExceeded(Exception):
+    def __init__(self, message, budget):
+        self.message = message
+        self.budget = budget
+
+    def __str__(self):
+        return self.message
+
+
 class ServiceNowReferenceNotFound(Exception):
     def __init__(self, value, table):
         self.value = value
@@ -52,91 +82,304 @@ class ServiceNowReferenceNotFound(Exception):
 
 
 class ServiceNow(object):
-    """Handles and requests ServiceNow instance"""
-    def __init__(self, url, username, password, proxy=None, verify=True):
+    """Handles and requests ServiceNow instance
+
+    `response_cache` is an optional servicenow.cache.ResponseCache serving
+    repeated GET requests from memory until the table is written.
+
+    `transport` picks the HTTP library (see servicenow.transport): None
+    for urllib, 'auto' for the fastest installed one, a name, or a
+    Transport instance.
+
+    `timeout` bounds each request, in seconds: a number, or a (connect,
+    read) tuple. See deadline() to bound whole operations.
+
+    `breaker` is an optional servicenow.breaker.CircuitBreaker rejecting
+    requests with ServiceNowCircuitOpen while the instance is failing.
+
+    `cassette` is an optional servicenow.cassette.Cassette recording the
+    requests sent through the transport, or replaying recorded ones
+    without any network access.
+
+    With `hedge`, a GET not answered within the 95th percentile of the
+    observed GET latencies is sent a second time, the first answer
+    winning.
+
+    An instance can be shared between threads: transports are thread-safe
+    and lazy lookups run once.
+    """
+    _hedge_workers = 32
+    _hedge_min_samples = 20
+
+    def __init__(self, url, username, password, proxy=None, verify=True,
+                 codec=None, response_cache=None, transport=None,
+                 timeout=None, hedge=False, breaker=None, cassette=None):
         self.url = url
         self._logger = logging.getLogger('servicenow')
-        password_mgr = HTTPPasswordMgrWithDefaultRealm()
-        password_mgr.add_password(None, self.url, username, password)
-        handlers = []
-        if verify is False:
-            ctx = ssl.create_default_context()
-            ctx.check_hostname = False
-            ctx.verify_mode = ssl.CERT_NONE
-            handlers.append(HTTPSHandler(context=ctx))
-        handlers.append(HTTPBasicAuthHandler(password_mgr))
-        if proxy is not None:
-            handlers.append(ProxyHandler(
-                {'http': proxy, 'https': proxy}))
-        self._opener = build_opener(*handlers)
+        self._codec = get_codec(codec)
+        self.response_cache = response_cache
+        self._flight = SingleFlight(expired=self._flight_expired)
+        self._write_counter = itertools.count(1)
+        self._writes = 0
+        self.transport = get_transport(transport, url, username, password,
+                                       proxy, verify)
+        if cassette is not None:
+            if cassette.transport is None:
+                cassette.transport = self.transport
+            self.transport = cassette
+        if timeout is not None and not isinstance(timeout, tuple):
+            timeout = (timeout, timeout)
+        self.timeout = timeout
+        self.hedge = hedge
+        self.breaker = breaker
+        self._budgets = []
+        self._latencies = deque(maxlen=256)
+        self.__hedge_executor = None
+        self.__hedge_lock = threading.Lock()
         self.__admin = None
+        self.__admin_lock = threading.Lock()
+
+    def deadline(self, seconds):
+        """Context manager bounding the requests sent in its block
+
+        Requests sent more than `seconds` after entering the block, by
+        the current thread or the workers of bulk operations, raise
+        ServiceNowDeadlineExceeded; requests in flight are given the time
+        left as timeout.
+        """
+        return deadline(seconds)
+
+    def budget(self, max_requests=None, limits=None, action='raise',
+               n_plus_one=10):
+        """Context manager counting the calls made in its block
+
+        See servicenow.budget.Budget: exceeding `max_requests` calls, or
+        limits such as {'GET table': 100}, raises
+        ServiceNowBudgetExceeded (or warns with action='warn'), and
+        repeated requests from a single call site are reported.
+        """
+        return Budget(self, max_requests, limits, action, n_plus_one)
+
+    def _timeout(self, url):
+        """(connect, read) timeout of a request, bounded by the deadline"""
+        left = remaining()
+        if left is None:
+            return self.timeout
+        if left <= 0:
+            raise ServiceNowDeadlineExceeded(url)
+        if self.timeout is None:
+            return (left, left)
+        return (min(self.timeout[0], left), min(self.timeout[1], left))
+
+    def _send(self, url, func, *args):
+        """Runs a transport call under the timeouts and circuit breaker"""
+        timeout = self._timeout(url)
+        circuit = None
+        if self.breaker is not None:
+            circuit = (urlsplit(url).netloc, self._table_from_url(url))
+            retry_after = self.breaker.acquire(*circuit)
+            if retry_after is not None:
+                raise ServiceNowCircuitOpen(url, retry_after)
+        outcome = None
+        try:
+            result = func(*args, timeout=timeout)
+            if circuit is not None:
+                outcome = self.breaker.success
+            return result
+        except TransportError as e:
+            left = remaining()
+            if left is not None and left <= 0:
+                raise ServiceNowDeadlineExceeded(url)
+            error = ServiceNowHttpError(url, e.code, e.message, e.content)
+            if circuit is not None:
+                outcome = self.breaker.failure \
+                    if error.code in self.breaker.failure_codes \
+                    else self.breaker.success
+            raise error
+        finally:
+            if circuit is not None:
+                (outcome or self.breaker.release)(*circuit)
 
     @property
     def _admin(self):
         if self.__admin is None:
-            res = self.get('sys_choice', fields='value', limit=1)
-            if len(res) == 0 or 'value' not in res[0]:
-                self.__admin = False
-            else:
-                self.__admin = True
-        return self.__admin   
+            with self.__admin_lock:
+                if self.__admin is None:
+                    res = self.get('sys_choice', fields='value', limit=1)
+                    self.__admin = len(res) > 0 and 'value' in res[0]
+        return self.__admin
 
-    def _call(self, method, url, params=None,
-              status_codes=(200, 201, 204)):
+    def _request(self, method, url, params=None,
+                 status_codes=(200, 201, 204)):
+        """Sends a request and returns the raw response body
+
+        An error dict is returned when the status code is unexpected.
+        """
         self._logger.info('%s %s', method.upper(), url)
-        request = Request(url)
-        request.get_method = lambda: method
-        request.add_header("Content-Type", "application/json")
-        request.add_header("Accept", "application/json")
+        headers = {"Content-Type": "application/json",
+                   "Accept": "application/json"}
+        body = None
         if params:
-            request.data = json.dumps(params).encode('utf-8')
-            self._logger.debug('Body: %s', json.dumps(params))
-        result = response = None
-        try:
-            response = self._opener.open(request)
-        except HTTPError as e:
-            try:
-                content = e.read()
-            except:
-                content = None
-            raise ServiceNowHttpError(request.get_full_url(), e.code,
-                                      e.msg, content)
-        except BadStatusLine as e:
-            raise ServiceNowHttpError(request.get_full_url(), None, e.line)
-        except URLError as e:
-            raise ServiceNowHttpError(request.get_full_url(), None, e.reason)
-        self._logger.debug('Status Code: %d', response.getcode())
-        if response.getcode() not in status_codes:
+            body = self._codec.dumps(params)
+            self._logger.debug('Body: %s', body)
+        status, reason, tmp = self._send(url, self.transport.send, method,
+                                         url, headers, body)
+        self._logger.debug('Status Code: %d', status)
+        if status not in status_codes:
             return {'error': {
-                'code': response.getcode(),
-                'message': response.msg
+                'code': status,
+                'message': reason
             }}
-        tmp = response.read()
         if len(tmp) > 1024:
             self._logger.debug('Response: %s...', tmp[:1024])
         else:
             self._logger.debug('Response: %s', tmp)
-        try:
-            response_data = tmp.decode('utf-8', 'ignore')
-        except AttributeError:
-            response_data = tmp
-        if len(response_data) == 0:
+        return tmp
+
+    def _stream(self, method, url, body=None, headers=None,
+                status_codes=(200,), chunk_size=65536):
+        """Sends a request and returns the response body by chunks
+
+        `body` may be a file object, sent by blocks of `chunk_size` bytes.
+        Nothing is decoded, so binary contents go through with constant
+        memory.
+        """
+        self._logger.info('%s %s', method.upper(), url)
+        headers = dict({'Accept': '*/*'}, **(headers or {}))
+        if hasattr(body, 'read') and not isinstance(body, FileChunks):
+            body = FileChunks(body, chunk_size)
+        status, reason, chunks = self._send(url, self.transport.stream,
+                                            method, url, headers, body,
+                                            chunk_size)
+        self._logger.debug('Status Code: %d', status)
+        if status not in status_codes:
+            chunks.close()
+            raise ServiceNowHttpError(url, status, reason)
+        return chunks
+
+    def _decode(self, tmp):
+        if len(tmp) == 0:
             return None
         try:
-            result = json.loads(response_data)
+            result = self._codec.loads(tmp)
         except ValueError as e:
-            raise ServiceNowDecodeError(response_data, str(e))
+            if isinstance(tmp, bytes):
+                tmp = tmp.decode('utf-8', 'ignore')
+            raise ServiceNowDecodeError(tmp, str(e))
         for field in ('result', 'records'):
             if field in result:
                 result = result[field]
         return result
 
+    def _table_from_url(self, url):
+        """Returns the table a REST URL reads or writes, None if unknown"""
+        match = re.search('/api/now/(?:v[0-9]+/)?(?:table|stats)/([^/?&]+)',
+                          url)
+        return match.group(1) if match else None
+
+    def _get(self, url, status_codes, table):
+        generation = None
+        if table is not None:
+            generation = self.response_cache.generation(table)
+        if self.hedge:
+            tmp = self._hedged_request(url, status_codes)
+        else:
+            tmp = self._request('GET', url, status_codes=status_codes)
+        if table is not None and not isinstance(tmp, dict):
+            self.response_cache.put(table, url, tmp, generation)
+        return tmp
+
+    def _timed_request(self, url, status_codes):
+        start = time.time()
+        tmp = self._request('GET', url, status_codes=status_codes)
+        self._latencies.append(time.time() - start)
+        return tmp
+
+    def _hedge_delay(self):
+        """95th percentile of the GET latencies, None until enough GETs"""
+        latencies = sorted(self._latencies)
+        if len(latencies) < self._hedge_min_samples:
+            return None
+        return latencies[int(0.95 * (len(latencies) - 1))]
+
+    @property
+    def _hedge_executor(self):
+        if self.__hedge_executor is None:
+            # not the admin lock, held while _admin sends its GET
+            with self.__hedge_lock:
+                if self.__hedge_executor is None:
+                    self.__hedge_executor = ThreadPoolExecutor(
+                        max_workers=self._hedge_workers)
+        return self.__hedge_executor
+
+    def _hedged_request(self, url, status_codes):
+        """Sends a GET again if it is slower than usual
+
+        The slower request is not interrupted but its answer is ignored.
+        """
+        delay = self._hedge_delay()
+        if delay is None:
+            return self._timed_request(url, status_codes)
+        request = bind(self._timed_request)
+        futures = [self._hedge_executor.submit(request, url, status_codes)]
+        done, _ = wait(futures, timeout=delay)
+        if len(done) == 0:
+            self._logger.debug('Hedging %s after %.3f seconds', url, delay)
+            futures.append(self._hedge_executor.submit(request, url,
+                                                       status_codes))
+        for future in as_completed(futures):
+            try:
+                return future.result()
+            except Exception as e:
+                error = e
+        raise error
+
+    def _call(self, method, url, params=None,
+              status_codes=(200, 201, 204)):
+        for budget in tuple(self._budgets):
+            budget.record(method, url)
+        cache = self.response_cache
+        table = self._table_from_url(url) if cache is not None else None
+        if method != 'GET':
+            try:
+                tmp = self._request(method, url, params, status_codes)
+            finally:
+                # later GETs never join a request sent before this write
+                self._writes = next(self._write_counter)
+                if table is not None:
+                    cache.invalidate(table)
+        else:
+            tmp = cache.get(url) if table is not None else None
+            if tmp is None:
+                # concurrent identical GETs share a single request
+                tmp = self._flight.do(
+                    ('GET', url, status_codes, self._writes), self._get,
+                    url, status_codes, table)
+            else:
+                self._logger.debug('Response cache hit: %s', url)
+        if isinstance(tmp, dict):
+            return dict(tmp)
+        return self._decode(tmp)
+
+    def _flight_expired(self, key):
+        """Error of a caller whose deadline passed waiting for key
+
+        key[1] is the URL of a GET, the table of a lookup.
+        """
+        return ServiceNowDeadlineExceeded(key[1])
+
+    def _compile_query(self, kwargs):
+        """Encodes a servicenow.query.Query given as `query` keyword"""
+        if hasattr(kwargs.get('query'), 'compile'):
+            kwargs['query'] = kwargs['query'].compile()
+
     def _url_rewrite(self, path, **kwargs):
         if len(path.split('/')) < 3:
             url = "{0}/api/now/table/{1}".format(self.url, path)
         else:
             url = "{0}/{1}".format(self.url, path)
         opts = []
+        self._compile_query(kwargs)
         if 'order' in kwargs:
             query_suffix = 'ORDERBY'
             if 'order_direction' in kwargs:
@@ -167,6 +410,10 @@ class ServiceNow(object):
         Needs read-only rights (or greater) on sys_dictionary and
         sys_db_object tables
         """
+        return self._flight.do(('display_field', table),
+                               self._lookup_display_field, table)
+
+    def _lookup_display_field(self, table):
         sd = self.get('sys_dictionary',
                       query='name={0}^display=true'.format(table),
                       fields='element')
@@ -246,12 +493,128 @@ class ServiceNow(object):
                           self._url_rewrite(path),
                           status_codes=(200, 202, 204))
 
+    def update_where(self, path, query, params, workers=4, pagesize=10000,
+                     batch_size=100, **kwargs):
+        """Update every record matching the query
+
+        The matching sys_ids are listed first, by pages ordered on sys_id
+        (so records leaving the query while being updated are not
+        skipped), then updated by `batch_size` PUTs per Batch API request,
+        `workers` requests at a time. Returns the number of updated
+        records: records failing to update are logged and not counted.
+        """
+        kw = {'query': query}
+        self._compile_query(kw)
+        # pages are ordered on sys_id
+        query = re.sub(r'\^?ORDERBY[^^]*', '', kw['query'] or '')
+        query = query.strip('^')
+        if not query:
+            raise ValueError('no query specified on {0}'.format(path))
+        sys_ids = []
+        while True:
+            page = query
+            if len(sys_ids) > 0:
+                page += '^sys_id>{0}'.format(sys_ids[-1])
+            res = self.get(path, query=page + '^ORDERBYsys_id',
+                           fields='sys_id', limit=pagesize)
+            sys_ids.extend(r['sys_id'] for r in res)
+            if len(res) < pagesize:
+                break
+        chunks = [sys_ids[i:i + batch_size]
+                  for i in range(0, len(sys_ids), batch_size)]
+        executor = ThreadPoolExecutor(max_workers=workers)
+        try:
+            updated = sum(bounded_map(
+                lambda chunk: self._batch_update(path, chunk, params,
+                                                 **kwargs),
+                chunks, executor, 2 * workers))
+        finally:
+            executor.shutdown(wait=False)
+        if len(sys_ids) > updated:
+            self._logger.warning('%s: %d of %d records not updated', path,
+                                 len(sys_ids) - updated, len(sys_ids))
+        return updated
+
+    def _batch_update(self, path, sys_ids, params, **kwargs):
+        """PUTs params to records through the Batch API
+
+        Returns the number of records updated.
+        """
+        try:
+            served = self._batch(
+                [(sys_id, 'PUT', '{0}/{1}'.format(path, sys_id), params)
+                 for sys_id in sys_ids], **kwargs)
+        except ServiceNowHttpError as e:
+            self._logger.warning('%s: batch of %d updates failed: %s',
+                                 path, len(sys_ids), e)
+            return 0
+        updated = 0
+        for sys_id in sys_ids:
+            if sys_id not in served:
+                self._logger.warning('%s/%s not updated: not serviced',
+                                     path, sys_id)
+            elif served[sys_id][0] in (200, 204):
+                updated += 1
+            else:
+                self._logger.warning('%s/%s not updated: %s', path, sys_id,
+                                     served[sys_id][0])
+        return updated
+
+    def _batch(self, requests, **kwargs):
+        """Sends (id, method, path, params) requests as one Batch API call
+
+        Returns {id: (status code, decoded result)} for the requests the
+        instance serviced, the others are left out. Raises
+        ServiceNowHttpError when the batch itself fails.
+        """
+        headers = [{'name': 'Content-Type', 'value': 'application/json'},
+                   {'name': 'Accept', 'value': 'application/json'}]
+        bodies = {}
+        tables = set()
+        rest_requests = []
+        for key, method, path, params in requests:
+            url = self._url_rewrite(path, **kwargs)
+            tables.add(self._table_from_url(url))
+            request = {'id': key, 'method': method, 'headers': headers,
+                       'url': url[len(self.url):]}
+            if params is not None:
+                # requests sharing their params encode them once
+                if id(params) not in bodies:
+                    bodies[id(params)] = base64.b64encode(
+                        self._codec.dumps(params)).decode('ascii')
+                request['body'] = bodies[id(params)]
+            rest_requests.append(request)
+        url = '{0}/api/now/v1/batch'.format(self.url)
+        try:
+            res = self._call('POST', url,
+                             params={'batch_request_id': requests[0][0],
+                                     'rest_requests': rest_requests},
+                             status_codes=(200,))
+        finally:
+            if self.response_cache is not None:
+                for table in tables - set([None]):
+                    self.response_cache.invalidate(table)
+        if isinstance(res, dict) and 'error' in res:
+            raise ServiceNowHttpError(url, res['error'].get('code'),
+                                      res['error'].get('message'))
+        served = {}
+        for entry in res.get('serviced_requests', []):
+            body = entry.get('body')
+            served[entry.get('id')] = (
+                entry.get('status_code'),
+                self._decode(base64.b64decode(body)) if body else None)
+        return served
+
     def sysid_to_value(self, table, sysid):
         """Retrieve the display value from a Sys ID
 
         Needs read-only rights (or greater) on sys_dictionary and
         sys_db_object tables
         """
+        return self._flight.do(('sysid_to_value', table, sysid),
+                               self._sysid_to_value, table, sysid)
+
+    def _sysid_to_value(self, table, sysid):
         try:
             field = self._display_field(table)
         except KeyError:
@@ -268,6 +631,10 @@ class ServiceNow(object):
         Needs read-only rights (or greater) on sys_dictionary and
         sys_db_object tables
         """
+        return self._flight.do(('value_to_sysid', table, value),
+                               self._value_to_sysid, table, value)
+
+    def _value_to_sysid(self, table, value):
         try:
             field = self._display_field(table)
         except KeyError:
@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+"""Circuit breaker failing requests fast while an instance is down"""
+
+import logging
+import threading
+import time
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+
+class _Circuit(object):
+    def __init__(self):
+        self.state = CLOSED
+        self.failures = 0
+        self.opened = 0
+        self.probes = 0
+
+
+class CircuitBreaker(object):
+    """Stops sending requests to a failing host
+
+    A circuit opens after `failures` consecutive failed requests
+    (connection errors, timeouts, 408, 429 and 5xx statuses). Requests are
+    then rejected for `reset_timeout` seconds, after which the circuit is
+    half-open: `probes` requests at a time are let through, the first
+    success closing the circuit and a failure opening it again.
+
+    Circuits are kept per host, and per table of each host with
+    `per_table`. `hosts` overrides the settings of some hosts, e.g.
+    {'dev.service-now.com': {'failures': 2, 'reset_timeout': 120}}.
+    A breaker can be shared by several clients.
+    """
+    failure_codes = (-1, 408, 429, 500, 502, 503, 504)
+
+    def __init__(self, failures=5, reset_timeout=30, probes=1,
+                 per_table=False, hosts=None):
+        self.failures = failures
+        self.reset_timeout = reset_timeout
+        self.probes = probes
+        self.per_table = per_table
+        self.hosts = hosts or {}
+        self._circuits = {}
+        self._lock = threading.Lock()
+        self._logger = logging.getLogger('servicenow')
+
+    def _setting(self, host, name):
+        return self.hosts.get(host, {}).get(name, getattr(self, name))
+
+    def _circuit(self, host, table):
+        key = (host, table if self.per_table else None)
+        circuit = self._circuits.get(key)
+        if circuit is None:
+            circuit = self._circuits[key] = _Circuit()
+        return circuit
+
+    def state(self, host, table=None):
+        with self._lock:
+            circuit = self._circuit(host, table)
+            if circuit.state == OPEN and time.time() - circuit.opened >= \
+                    self._setting(host, 'reset_timeout'):
+                return HALF_OPEN
+            return circuit.state
+
+    def acquire(self, host, table=None):
+        """Returns None when a request may be sent
+
+        Otherwise returns the seconds left before the circuit lets a probe
+        through. A request allowed must be followed by success(), failure()
+        or release().
+        """
+        with self._lock:
+            circuit = self._circuit(host, table)
+            if circuit.state == CLOSED:
+                return None
+            if circuit.state == OPEN:
+                left = circuit.opened + \
+                    self._setting(host, 'reset_timeout') - time.time()
+                if left > 0:
+                    return left
+                circuit.state = HALF_OPEN
+                circuit.probes = 0
+            if circuit.probes >= self._setting(host, 'probes'):
+                return 0
+            circuit.probes += 1
+            return None
+
+    def success(self, host, table=None):
+        with self._lock:
+            circuit = self._circuit(host, table)
+            if circuit.state != CLOSED:
+                self._logger.info('Circuit of %s closed', host)
+            circuit.state = CLOSED
+            circuit.failures = 0
+            circuit.probes = 0
+
+    def failure(self, host, table=None):
+        with self._lock:
+            circuit = self._circuit(host, table)
+            circuit.failures += 1
+            if circuit.state == HALF_OPEN or (
+                    circuit.state == CLOSED and circuit.failures >=
+                    self._setting(host, 'failures')):
+                self._logger.warning(
+                    'Circuit of %s%s opened after %d failures', host,
+                    '/' + table if self.per_table and table else '',
+                    circuit.failures)
+                circuit.state = OPEN
+                circuit.opened = time.time()
+                circuit.probes = 0
+
+    def release(self, host, table=None):
+        """Ends a request allowed by acquire() without outcome"""
+        with self._lock:
+            circuit = self._circuit(host, table)
+            if circuit.state == HALF_OPEN and circuit.probes > 0:
+                circuit.probes -= 1
+
+    def reset(self):
+        """Closes every circuit"""
+        with self._lock:
+            self._circuits.clear()
@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+"""Request budgets counting the calls of a block of code"""
+
+import logging
+import os
+import re
+import sys
+import threading
+
+import servicenow
+
+try:
+    from urllib.parse import urlsplit, parse_qsl
+except ImportError:
+    from urlparse import urlsplit, parse_qsl
+
+_package = os.path.dirname(os.path.abspath(__file__))
+_ids = re.compile('(?<![0-9a-zA-Z])(?:[0-9a-f]{32}|[0-9]+)(?![0-9a-zA-Z])')
+
+
+def _operation(method, url):
+    """'GET table', 'POST import', 'GET stats'... of a request"""
+    match = re.search('/api/now/(?:v[0-9]+/)?([^/?&]+)', url)
+    return '{0} {1}'.format(method, match.group(1) if match else 'legacy')
+
+
+def _shape(method, url):
+    """The request with its record ids and parameter values left out"""
+    parts = urlsplit(url)
+    params = ','.join(sorted(k for k, _ in parse_qsl(parts.query)))
+    return '{0} {1}?{2}'.format(method, _ids.sub('{id}', parts.path), params)
+
+
+def _call_site():
+    """file:line (function) of the first caller outside the package"""
+    frame = sys._getframe(2)
+    while frame is not None and os.path.abspath(
+            frame.f_code.co_filename).startswith(_package + os.sep):
+        frame = frame.f_back
+    if frame is None:
+        return None
+    return '{0}:{1} ({2})'.format(frame.f_code.co_filename, frame.f_lineno,
+                                  frame.f_code.co_name)
+
+
+class Budget(object):
+    """Counts the calls of a client while entered, per operation and site
+
+    More than `max_requests` calls, or more than limits[operation] calls
+    of an operation such as 'GET table', raise ServiceNowBudgetExceeded,
+    or log a warning with action='warn'. Calls of any thread using the
+    client are counted.
+
+    The same request shape (method, path and parameter names, record ids
+    left out) sent `n_plus_one` times or more from a single call site is
+    reported as an N+1 pattern in `suspects` when leaving the block.
+    """
+    def __init__(self, snow, max_requests=None, limits=None,
+                 action='raise', n_plus_one=10):
+        if action not in ('raise', 'warn'):
+            raise ValueError('action must be raise or warn')
+        self.snow = snow
+        self.max_requests = max_requests
+        self.limits = limits or {}
+        self.action = action
+        self.n_plus_one = n_plus_one
+        self.requests = 0
+        self.operations = {}
+        self.sites = {}
+        self.shapes = {}
+        self.suspects = []
+        self._exceeded = set()
+        self._lock = threading.Lock()
+        self._logger = logging.getLogger('servicenow')
+
+    def __enter__(self):
+        self.snow._budgets.append(self)
+        return self
+
+    def __exit__(self, *exc):
+        self.snow._budgets.remove(self)
+        self.suspects = sorted(
+            ((site, shape, count)
+             for (site, shape), count in self.shapes.items()
+             if count >= self.n_plus_one),
+            key=lambda s: -s[2])
+        for site, shape, count in self.suspects:
+            self._logger.warning('N+1 requests: %d x %s from %s',
+                                 count, shape, site)
+        self._logger.info('%s', self.report())
+
+    def record(self, method, url):
+        """Counts a call, raising or warning when over budget"""
+        operation = _operation(method, url)
+        site = _call_site()
+        with self._lock:
+            self.requests += 1
+            self.operations[operation] = \
+                self.operations.get(operation, 0) + 1
+            self.sites[site] = self.sites.get(site, 0) + 1
+            key = (site, _shape(method, url))
+            self.shapes[key] = self.shapes.get(key, 0) + 1
+            over = []
+            if self.max_requests is not None and \
+                    self.requests > self.max_requests:
+                over.append((None, self.max_requests))
+            limit = self.limits.get(operation)
+            if limit is not None and self.operations[operation] > limit:
+                over.append((operation, limit))
+        for operation, limit in over:
+            message = '{0} budget of {1} requests exceeded at {2}'.format(
+                operation or 'request', limit, site)
+            if self.action == 'raise':
+                raise servicenow.ServiceNowBudgetExceeded(message, self)
+            if operation not in self._exceeded:
+                # warned once per budget
+                self._exceeded.add(operation)
+                self._logger.warning('%s', message)
+
+    def report(self):
+        """Summary of the calls per operation and call site"""
+        lines = ['{0} requests'.format(self.requests)]
+        for operation, count in sorted(self.operations.items(),
+                                       key=lambda o: -o[1]):
+            lines.append('  {0:6d} {1}'.format(count, operation))
+        lines.append('by call site:')
+        for site, count in sorted(self.sites.items(), key=lambda s: -s[1]):
+            lines.append('  {0:6d} {1}'.format(count, site))
+        for site, shape, count in self.suspects:
+            lines.append('N+1: {0} x {1} from {2}'.format(count, shape, site))
+        return '\n'.join(lines)
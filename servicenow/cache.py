@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+"""Caches of ServiceNow responses"""
+
+import hashlib
+import logging
+import mmap
+import os
+import tempfile
+import threading
+import time
+
+from collections import OrderedDict
+
+
+class PageCache(object):
+    """Disk-backed cache of raw page payloads
+
+    Entries are keyed by the full request URL, written once and read back
+    through memory-mapped files. They expire `ttl` seconds after being
+    written, and the least recently read entries are evicted when the
+    directory grows over `max_bytes`.
+
+    With `revalidate`, a scan first compares the record count and latest
+    sys_updated_on of its query with the previous scan, and re-fetches
+    every page when they differ.
+    """
+    def __init__(self, directory=None, ttl=300, max_bytes=256 * 1024 ** 2,
+                 revalidate=False):
+        if directory is None:
+            directory = os.path.join(tempfile.gettempdir(),
+                                     'servicenow-pages')
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.directory = directory
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.revalidate = revalidate
+        self._logger = logging.getLogger('servicenow')
+        self._lock = threading.Lock()
+        self._size = sum(size for _, size, _ in self._entries())
+
+    def _path(self, key):
+        digest = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, digest + '.page')
+
+    def _entries(self):
+        for name in os.listdir(self.directory):
+            if not name.endswith('.page'):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            yield path, st.st_size, st.st_atime
+
+    def load(self, key, codec):
+        """Returns the decoded payload stored for key, None if missing"""
+        path = self._path(key)
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        if time.time() - st.st_mtime > self.ttl:
+            self._remove(path)
+            return None
+        try:
+            # evictions of concurrent scans may remove the file meanwhile
+            f = open(path, 'rb')
+        except (IOError, OSError):
+            return None
+        with f:
+            try:
+                if os.fstat(f.fileno()).st_size == 0:
+                    return None
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except (IOError, OSError, ValueError):
+                return None
+            try:
+                view = memoryview(mm)
+                try:
+                    payload = codec.loads(view)
+                finally:
+                    view.release()
+            finally:
+                mm.close()
+        try:
+            os.utime(path, (time.time(), st.st_mtime))
+        except OSError:
+            pass
+        self._logger.debug('Page cache hit: %s', key)
+        return payload
+
+    def store(self, key, payload, codec):
+        data = codec.dumps(payload)
+        path = self._path(key)
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        try:
+            old = os.path.getsize(path)
+        except OSError:
+            old = 0
+        os.rename(tmp, path)
+        with self._lock:
+            self._size += len(data) - old
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def _remove(self, path):
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+        except OSError:
+            return
+        with self._lock:
+            self._size -= size
+
+    def _evict(self):
+        entries = sorted(self._entries(), key=lambda e: e[2])
+        self._size = sum(size for _, size, _ in entries)
+        for path, size, _ in entries:
+            if self._size <= self.max_bytes * 0.9:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            self._size -= size
+
+    def clear(self):
+        for path, _, _ in list(self._entries()):
+            self._remove(path)
+
+
+class ResponseCache(object):
+    """In-memory cache of GET responses
+
+    Raw response bodies are kept for `ttl` seconds, or for the duration
+    given in `table_ttls` for a table (0 disables caching for it). Any
+    write to a table drops its entries. At most `max_entries` responses
+    are kept, the least recently used being dropped first.
+
+    A response fetched while its table was written is not stored: pass the
+    generation() read before sending the request to put().
+    """
+    def __init__(self, ttl=5, table_ttls=None, max_entries=1024):
+        self.ttl = ttl
+        self.table_ttls = table_ttls or {}
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._tables = {}
+        self._generations = {}
+        self._epoch = 0
+        self._lock = threading.Lock()
+
+    def generation(self, table):
+        return (self._epoch, self._generations.get(table, 0))
+
+    def get(self, url):
+        with self._lock:
+            entry = self._entries.get(url)
+            if entry is None:
+                return None
+            if entry[0] < time.time():
+                self._drop(url)
+                return None
+            self._entries.pop(url)
+            self._entries[url] = entry
+            return entry[2]
+
+    def put(self, table, url, data, generation=None):
+        ttl = self.table_ttls.get(table, self.ttl)
+        if ttl <= 0:
+            return
+        with self._lock:
+            if generation is not None and \
+                    generation != self.generation(table):
+                return
+            if url in self._entries:
+                self._drop(url)
+            self._entries[url] = (time.time() + ttl, table, data)
+            self._tables.setdefault(table, set()).add(url)
+            while len(self._entries) > self.max_entries:
+                self._drop(next(iter(self._entries)))
+
+    def _drop(self, url):
+        _, table, _ = self._entries.pop(url)
+        self._tables[table].discard(url)
+
+    def invalidate(self, table=None):
+        """Drops the entries of a table, or every entry"""
+        with self._lock:
+            if table is None:
+                self._entries.clear()
+                self._tables.clear()
+                self._epoch += 1
+                return
+            self._generations[table] = self._generations.get(table, 0) + 1
+            for url in self._tables.pop(table, ()):
+                self._entries.pop(url, None)
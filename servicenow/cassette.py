@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+"""Record and replay of the requests of a client
+
+A workload is recorded once against an instance, then replayed offline
+to profile or benchmark the client with realistic responses.
+"""
+
+import base64
+import gzip
+import json
+import threading
+import time
+
+from servicenow.transport import Transport, TransportError
+
+try:
+    from urllib.parse import urlsplit
+except ImportError:
+    from urlparse import urlsplit
+
+
+class CassetteMiss(LookupError):
+    """No recorded response matches a replayed request"""
+
+
+def _key(method, url):
+    """Method and URL without host, the parameters sorted"""
+    parts = urlsplit(url)
+    query = '&'.join(sorted(p for p in parts.query.split('&') if p))
+    return '{0} {1}?{2}'.format(method, parts.path, query)
+
+
+class Cassette(Transport):
+    """Transport recording or replaying the requests of a client
+
+    With mode='record', requests go through `transport` (by default the
+    transport of the client given the cassette) and every response or
+    error is appended to the gzip-compressed JSON lines file at `path`,
+    keyed by method and URL (host left out, parameters sorted).
+
+    With mode='replay', no request is sent: the responses recorded for
+    a key are served in their recorded order, the last one repeating,
+    and CassetteMiss is raised for requests never recorded. They are
+    served at full speed, or after their recorded latency multiplied by
+    `latency`.
+    """
+    name = 'cassette'
+
+    def __init__(self, path, mode='replay', transport=None, latency=0):
+        if mode not in ('record', 'replay'):
+            raise ValueError('mode must be record or replay')
+        self.path = path
+        self.mode = mode
+        self.transport = transport
+        self.latency = latency
+        self._lock = threading.Lock()
+        self._file = None
+        self._interactions = {}
+        self._served = {}
+        if mode == 'record':
+            self._file = gzip.open(path, 'wb')
+        else:
+            with gzip.open(path, 'rb') as f:
+                for line in f:
+                    entry = json.loads(line.decode('utf-8'))
+                    self._interactions.setdefault(
+                        entry['key'], []).append(entry)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _record(self, key, elapsed, status=None, reason=None, body=None,
+                error=None):
+        entry = {'key': key, 'latency': round(elapsed, 6),
+                 'status': status, 'reason': reason}
+        if error is not None:
+            entry.update(status=error.code, reason=error.message,
+                         error=True)
+            body = error.content
+        if body is not None:
+            if not isinstance(body, bytes):
+                body = body.encode('utf-8')
+            entry['body'] = base64.b64encode(body).decode('ascii')
+        line = (json.dumps(entry, sort_keys=True) + '\n').encode('utf-8')
+        with self._lock:
+            self._file.write(line)
+
+    def _replay(self, key):
+        with self._lock:
+            entries = self._interactions.get(key)
+            if not entries:
+                raise CassetteMiss(key)
+            index = self._served.get(key, 0)
+            self._served[key] = index + 1
+            entry = entries[min(index, len(entries) - 1)]
+        if self.latency:
+            time.sleep(entry['latency'] * self.latency)
+        body = entry.get('body')
+        if body is not None:
+            body = base64.b64decode(body)
+        if entry.get('error'):
+            raise TransportError(entry['status'], entry['reason'], body)
+        return entry['status'], entry['reason'], body or b''
+
+    def send(self, method, url, headers, body=None, timeout=None):
+        key = _key(method, url)
+        if self.mode == 'replay':
+            return self._replay(key)
+        start = time.time()
+        try:
+            status, reason, data = self.transport.send(
+                method, url, headers, body, timeout=timeout)
+        except TransportError as e:
+            self._record(key, time.time() - start, error=e)
+            raise
+        self._record(key, time.time() - start, status, reason, data)
+        return status, reason, data
+
+    def close(self):
+        """Ends a recording, flushing the file"""
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+"""Same operations run against several instances concurrently"""
+
+import logging
+import time
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from servicenow.concurrency import bind
+from servicenow.table import Table, TableIterator, _gather
+
+try:
+    from urllib.parse import urlsplit
+except ImportError:
+    from urlparse import urlsplit
+
+
+class ClusterResults(OrderedDict):
+    """Results of the instances that answered, keyed by instance name
+
+    `errors` holds the exception of each instance that failed, and
+    `seconds` the time each instance took.
+    """
+    def __init__(self, *args, **kwargs):
+        super(ClusterResults, self).__init__(*args, **kwargs)
+        self.errors = OrderedDict()
+        self.seconds = OrderedDict()
+
+    def merged(self):
+        """(instance, item) tuples of the list results of every instance"""
+        return [(name, item) for name, items in self.items()
+                for item in items]
+
+
+class ClusterIterator(object):
+    """(instance, row) tuples of the rows streamed by every instance
+
+    `errors` holds the exception of each instance that failed while
+    iterating.
+    """
+    def __init__(self, names, iterators, workers):
+        self.names = names
+        self.iterators = iterators
+        self.workers = workers
+        self.errors = OrderedDict()
+
+    def __iter__(self):
+        errors = {}
+        try:
+            for index, row in _gather(self.iterators, self.workers, False,
+                                      errors):
+                yield self.names[index], row
+        finally:
+            for index in sorted(errors):
+                logging.getLogger('servicenow').warning(
+                    '%s failed: %s', self.names[index], errors[index])
+                self.errors[self.names[index]] = errors[index]
+
+
+class ServiceNowCluster(object):
+    """Runs the same requests against several instances concurrently
+
+    `instances` maps names to servicenow.table.ServiceNow clients, or is
+    a list of clients named after their host. Every instance is queried
+    at once, so an operation takes as long as the slowest instance
+    (`workers` bounds the instances queried at a time). The failure of
+    an instance is logged and kept with the results of the others.
+    """
+    def __init__(self, instances, workers=None):
+        if not isinstance(instances, dict):
+            instances = OrderedDict((urlsplit(snow.url).netloc, snow)
+                                    for snow in instances)
+        self.instances = OrderedDict(instances)
+        self.workers = workers or max(1, len(self.instances))
+        self.__logger = logging.getLogger('servicenow')
+
+    def __repr__(self):
+        return 'ServiceNowCluster({0})'.format(', '.join(self.instances))
+
+    def map(self, func):
+        """Calls func(client) for every instance, returns ClusterResults"""
+        def call(snow):
+            start = time.time()
+            try:
+                return func(snow), None, time.time() - start
+            except Exception as e:
+                return None, e, time.time() - start
+
+        results = ClusterResults()
+        executor = ThreadPoolExecutor(max_workers=self.workers)
+        try:
+            call = bind(call)
+            futures = [(name, executor.submit(call, snow))
+                       for name, snow in self.instances.items()]
+            for name, future in futures:
+                result, error, seconds = future.result()
+                results.seconds[name] = round(seconds, 3)
+                if error is None:
+                    results[name] = result
+                else:
+                    self.__logger.warning('%s failed: %s', name, error)
+                    results.errors[name] = error
+        finally:
+            executor.shutdown(wait=False)
+        return results
+
+    def get(self, path, **kwargs):
+        """ServiceNow.get() on every instance"""
+        return self.map(lambda snow: snow.get(path, **kwargs))
+
+    def count(self, table, query=None):
+        """Table.count() on every instance"""
+        return self.map(lambda snow: Table(snow, table).count(query))
+
+    def filter(self, table, **kwargs):
+        """Streams the rows of Table.filter() on every instance
+
+        Returns a ClusterIterator yielding (instance, row) as soon as the
+        pages of any instance arrive.
+        """
+        iterators = [TableIterator(snow, table, **kwargs)
+                     for snow in self.instances.values()]
+        return ClusterIterator(list(self.instances), iterators,
+                               self.workers)
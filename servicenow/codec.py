@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+"""JSON codecs used to encode request bodies and decode responses
+
+The fastest installed library is picked by default (orjson, msgspec,
+ujson), falling back to the standard json module.
+"""
+
+import json
+
+
+class JSONCodec(object):
+    """Standard library codec
+
+    dumps() returns UTF-8 bytes and loads() accepts bytes, text or a
+    memoryview, so a payload is serialized once and parsed without an
+    intermediate copy when the library allows it.
+    """
+    name = 'json'
+
+    def dumps(self, obj):
+        return json.dumps(obj).encode('utf-8')
+
+    def _loads(self, data):
+        if isinstance(data, memoryview):
+            data = data.tobytes()
+        return json.loads(data)
+
+    def loads(self, data):
+        try:
+            return self._loads(data)
+        except ValueError:
+            if isinstance(data, memoryview):
+                data = data.tobytes()
+            if isinstance(data, bytes):
+                data = data.decode('utf-8', 'ignore')
+            # the standard library is more lenient (big integers) and
+            # gives the usual error messages
+            return json.loads(data)
+
+
+class OrjsonCodec(JSONCodec):
+    name = 'orjson'
+
+    def __init__(self):
+        import orjson
+        self._orjson = orjson
+
+    def dumps(self, obj):
+        return self._orjson.dumps(obj)
+
+    def _loads(self, data):
+        return self._orjson.loads(data)
+
+
+def _enc_hook(obj):
+    # msgspec rejects str subclasses, such as the TableRowField values
+    # of rows sent back to the instance
+    if isinstance(obj, str):
+        return str(obj)
+    raise NotImplementedError(
+        'Encoding objects of type {0} is unsupported'.format(type(obj)))
+
+
+class MsgspecCodec(JSONCodec):
+    name = 'msgspec'
+
+    def __init__(self):
+        import msgspec.json
+        self._encoder = msgspec.json.Encoder(enc_hook=_enc_hook)
+        self._decoder = msgspec.json.Decoder()
+
+    def dumps(self, obj):
+        return self._encoder.encode(obj)
+
+    def _loads(self, data):
+        return self._decoder.decode(data)
+
+
+class UjsonCodec(JSONCodec):
+    name = 'ujson'
+
+    def __init__(self):
+        import ujson
+        self._ujson = ujson
+
+    def dumps(self, obj):
+        return self._ujson.dumps(obj, ensure_ascii=False).encode('utf-8')
+
+    def _loads(self, data):
+        if isinstance(data, memoryview):
+            data = data.tobytes()
+        return self._ujson.loads(data)
+
+
+CODECS = {
+    'orjson': OrjsonCodec,
+    'msgspec': MsgspecCodec,
+    'ujson': UjsonCodec,
+    'json': JSONCodec,
+}
+
+
+def get_codec(codec=None):
+    """Returns a codec instance
+
+    `codec` is None or 'auto' for the fastest available library, one of
+    'orjson', 'msgspec', 'ujson', 'json', or an object providing
+    dumps() and loads().
+    """
+    if codec is None or codec == 'auto':
+        for name in ('orjson', 'msgspec', 'ujson'):
+            try:
+                return CODECS[name]()
+            except ImportError:
+                continue
+        return JSONCodec()
+    if hasattr(codec, 'dumps') and hasattr(codec, 'loads'):
+        return codec
+    if codec not in CODECS:
+        raise ValueError('unknown codec {0}'.format(codec))
+    return CODECS[codec]()
@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+"""Helpers to share one ServiceNow client between threads"""
+
+import threading
+import time
+
+from collections import deque
+from contextlib import contextmanager
+
+_context = threading.local()
+
+
+class _Call(object):
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """Deduplicates concurrent calls sharing the same key
+
+    While a call for a key is running, other callers asking for the same
+    key wait for it and get its result (or its exception) instead of
+    running their own.
+
+    Waiting callers give up when their deadline() passes, raising the
+    exception returned by `expired(key)`, or wait as long as the running
+    call without `expired`.
+    """
+    def __init__(self, expired=None):
+        self.expired = expired
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, func, *args, **kwargs):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+        if not leader:
+            left = remaining() if self.expired is not None else None
+            if not call.event.wait(None if left is None else max(left, 0)):
+                raise self.expired(key)
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = func(*args, **kwargs)
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.event.set()
+        return call.result
+
+
+class StripedCache(object):
+    """Thread-safe dict split into independently locked stripes
+
+    Keys are spread over `stripes` dicts by hash, so threads working on
+    different keys rarely wait for each other.
+    """
+    def __init__(self, stripes=16):
+        self._stripes = [({}, threading.Lock()) for _ in range(stripes)]
+
+    def _stripe(self, key):
+        return self._stripes[hash(key) % len(self._stripes)]
+
+    def __contains__(self, key):
+        data, lock = self._stripe(key)
+        with lock:
+            return key in data
+
+    def __getitem__(self, key):
+        data, lock = self._stripe(key)
+        with lock:
+            return data[key]
+
+    def __setitem__(self, key, value):
+        data, lock = self._stripe(key)
+        with lock:
+            data[key] = value
+
+    def __delitem__(self, key):
+        data, lock = self._stripe(key)
+        with lock:
+            del data[key]
+
+    def __len__(self):
+        return sum(len(data) for data, _ in self._stripes)
+
+    def get(self, key, default=None):
+        data, lock = self._stripe(key)
+        with lock:
+            return data.get(key, default)
+
+    def setdefault(self, key, value):
+        data, lock = self._stripe(key)
+        with lock:
+            return data.setdefault(key, value)
+
+    def clear(self):
+        for data, lock in self._stripes:
+            with lock:
+                data.clear()
+
+
+@contextmanager
+def deadline(seconds):
+    """Bounds the requests sent by the current thread to `seconds` from now
+
+    Nested deadlines can only shorten the current one. Calls run by
+    bounded_map() and bind() get the deadline of the calling thread.
+    """
+    previous = getattr(_context, 'deadline', None)
+    at = time.time() + seconds if seconds is not None else None
+    if previous is not None and (at is None or previous < at):
+        at = previous
+    _context.deadline = at
+    try:
+        yield
+    finally:
+        _context.deadline = previous
+
+
+def remaining():
+    """Seconds left before the deadline of the current thread
+
+    None without deadline.
+    """
+    at = getattr(_context, 'deadline', None)
+    return None if at is None else at - time.time()
+
+
+def bind(func):
+    """Returns func running with the deadline of the calling thread"""
+    at = getattr(_context, 'deadline', None)
+    if at is None:
+        return func
+
+    def bound(*args, **kwargs):
+        previous = getattr(_context, 'deadline', None)
+        _context.deadline = at
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _context.deadline = previous
+    return bound
+
+
+def bounded_map(func, iterable, executor, window):
+    """Maps func over iterable with an executor, yielding results in order
+
+    At most `window` calls are submitted ahead of the consumer, so long
+    inputs are streamed with bounded memory.
+    """
+    func = bind(func)
+    pending = deque()
+    try:
+        for item in iterable:
+            pending.append(executor.submit(func, item))
+            if len(pending) >= window:
+                yield pending.popleft().result()
+        while len(pending) > 0:
+            yield pending.popleft().result()
+    finally:
+        for future in pending:
+            future.cancel()
@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+"""Bulk loads through Import Set staging tables"""
+
+import logging
+import time
+
+import servicenow
+
+from concurrent.futures import ThreadPoolExecutor
+from servicenow.concurrency import bounded_map
+
+
+class ImportSet(object):
+    """Loads rows into a staging table, transform maps running server-side
+
+    Rows are posted by chunks of `chunk_size` to the insertMultiple
+    endpoint, `workers` chunks at a time. When the instance transforms
+    asynchronously, the staging rows of each chunk are polled every
+    `poll_interval` seconds until transformed, or for at most `timeout`
+    seconds.
+
+    `stats` gives the throughput of the last load.
+    """
+    _result_fields = ('sys_import_row', 'sys_import_state',
+                      'sys_import_state_comment', 'sys_target_sys_id',
+                      'sys_target_table')
+
+    def __init__(self, snow, staging_table, chunk_size=1000, workers=4,
+                 poll_interval=1, timeout=300):
+        self.snow = snow
+        self.staging_table = staging_table
+        self.chunk_size = chunk_size
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+        self.stats = None
+        self.__logger = logging.getLogger('servicenow')
+
+    def __repr__(self):
+        return 'ImportSet({0})'.format(self.staging_table)
+
+    def _staging_rows(self, import_set, count):
+        deadline = time.time() + self.timeout
+        while True:
+            rows = self.snow.get(
+                self.staging_table,
+                query='sys_import_set={0}'.format(import_set),
+                fields=','.join(self._result_fields), limit=count)
+            if len(rows) >= count and not any(
+                    r.get('sys_import_state') == 'pending' for r in rows):
+                break
+            if time.time() >= deadline:
+                self.__logger.warning('%s: import set %s not transformed '
+                                      'after %d seconds', self,
+                                      import_set, self.timeout)
+                break
+            time.sleep(self.poll_interval)
+        rows = sorted(rows, key=lambda r: int(r.get('sys_import_row') or 0))
+        results = [{'status': r.get('sys_import_state') or 'pending',
+                    'sys_id': r.get('sys_target_sys_id') or None,
+                    'table': r.get('sys_target_table') or None,
+                    'message': r.get('sys_import_state_comment') or '',
+                    'import_set': import_set} for r in rows]
+        return results + [{'status': 'pending', 'sys_id': None,
+                           'table': None, 'message': '',
+                           'import_set': import_set}] * (count - len(rows))
+
+    def _load(self, chunk):
+        url = '{0}/api/now/import/{1}/insertMultiple'.format(
+            self.snow.url, self.staging_table)
+        try:
+            res = self.snow._call('POST', url, params={'records': chunk},
+                                  status_codes=(200, 201))
+            if isinstance(res, dict) and 'error' in res:
+                raise servicenow.ServiceNowHttpError(
+                    url, res['error'].get('code'),
+                    res['error'].get('message'))
+        except servicenow.ServiceNowHttpError as e:
+            return [{'status': 'error', 'sys_id': None, 'table': None,
+                     'message': str(e), 'import_set': None}] * len(chunk)
+        if isinstance(res, list):
+            # transformed synchronously
+            return [{'status': r.get('status'),
+                     'sys_id': r.get('sys_id'),
+                     'table': r.get('table'),
+                     'message': r.get('status_message', ''),
+                     'import_set': None} for r in res]
+        return self._staging_rows(res['import_set_id'], len(chunk))
+
+    def _chunks(self, rows):
+        chunk = []
+        for row in rows:
+            chunk.append(row)
+            if len(chunk) >= self.chunk_size:
+                yield chunk
+                chunk = []
+        if len(chunk) > 0:
+            yield chunk
+
+    def load(self, rows):
+        """Imports rows, yielding the transform result of each one in order
+
+        A result is a dict with the import state ('inserted', 'updated',
+        'ignored', 'skipped', 'error' or 'pending'), the target record
+        sys_id and table, the state message and the import set sys_id.
+        A chunk failing to post gives 'error' results for its rows.
+        """
+        start = time.time()
+        self.stats = {'rows': 0, 'chunks': 0, 'seconds': 0,
+                      'rows_per_sec': None, 'statuses': {}}
+        executor = ThreadPoolExecutor(max_workers=self.workers)
+        try:
+            for results in bounded_map(self._load, self._chunks(rows),
+                                       executor, 2 * self.workers):
+                self.stats['chunks'] += 1
+                for result in results:
+                    self.stats['rows'] += 1
+                    statuses = self.stats['statuses']
+                    statuses[result['status']] = \
+                        statuses.get(result['status'], 0) + 1
+                    yield result
+                elapsed = time.time() - start
+                self.stats['seconds'] = round(elapsed, 3)
+                self.stats['rows_per_sec'] = round(
+                    self.stats['rows'] / elapsed, 1) if elapsed > 0 else None
+        finally:
+            executor.shutdown(wait=False)
+            if self.snow.response_cache is not None:
+                # transform maps write tables unknown to the client
+                self.snow.response_cache.invalidate()
+        self.__logger.info('%s loaded %d rows (%s rows/sec)', self,
+                           self.stats['rows'], self.stats['rows_per_sec'])
@@ -0,0 +1,281 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+"""Structured queries compiled offline to encoded queries
+
+    >>> q = (Q('state') == 'New') & Q('priority').in_([1, 2])
+    >>> str(q.order_by('-opened_at'))
+    'state=New^priorityIN1,2^ORDERBYDESCopened_at'
+
+Conditions combine with & (AND), | (OR) and ~ (NOT); the expression is
+rewritten as the AND of ORs encoded queries express, redundant clauses
+being merged or dropped. No request is needed to compile a query.
+"""
+
+import datetime
+
+try:
+    text_type = unicode
+except NameError:
+    text_type = str
+
+_negations = {'=': '!=', '!=': '=', '<': '>=', '>=': '<', '>': '<=',
+              '<=': '>', 'IN': 'NOT IN', 'NOT IN': 'IN',
+              'LIKE': 'NOT LIKE', 'NOT LIKE': 'LIKE',
+              'ISEMPTY': 'ISNOTEMPTY', 'ISNOTEMPTY': 'ISEMPTY'}
+
+
+def _text(value):
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, datetime.datetime):
+        return value.strftime('%Y-%m-%d %H:%M:%S')
+    return text_type(value)
+
+
+class Query(object):
+    """Base of the conditions and their combinations"""
+    _order = ()
+
+    def __and__(self, other):
+        return And(self, other)
+
+    def __or__(self, other):
+        return Or(self, other)
+
+    def __invert__(self):
+        raise NotImplementedError
+
+    def __str__(self):
+        return self.compile()
+
+    def __repr__(self):
+        return 'Query({0})'.format(self.compile())
+
+    def order_by(self, *fields):
+        """Returns the query sorted by fields, descending when prefixed
+        with '-'
+        """
+        query = self._copy()
+        query._order = tuple(fields)
+        return query
+
+    def _copy(self):
+        raise NotImplementedError
+
+    def clauses(self):
+        """Returns the query as a list of OR-ed conditions to AND"""
+        raise NotImplementedError
+
+    def compile(self):
+        """Returns the encoded query"""
+        parts = ['^OR'.join(c.encode() for c in clause)
+                 for clause in _simplify(self.clauses())]
+        for field in self._order:
+            if field.startswith('-'):
+                parts.append('ORDERBYDESC' + field[1:])
+            else:
+                parts.append('ORDERBY' + field)
+        return '^'.join(parts)
+
+
+class Condition(Query):
+    """A field compared with values by an encoded query operator"""
+    def __init__(self, field, op, values=()):
+        self.field = field
+        self.op = op
+        self.values = tuple(_text(v) for v in values)
+
+    @property
+    def key(self):
+        return (self.field, self.op, self.values)
+
+    def _copy(self):
+        return Condition(self.field, self.op, self.values)
+
+    def __invert__(self):
+        if self.op not in _negations:
+            raise ValueError('{0} cannot be negated'.format(self.op))
+        return Condition(self.field, _negations[self.op], self.values)
+
+    def clauses(self):
+        return [[self]]
+
+    def encode(self):
+        values = [v.replace('^', '^^') for v in self.values]
+        if self.op == 'BETWEEN':
+            return '{0}BETWEEN{1}@{2}'.format(self.field, *values)
+        return '{0}{1}{2}'.format(self.field, self.op, ','.join(values))
+
+
+class And(Query):
+    def __init__(self, *parts):
+        self.parts = parts
+        self._order = _orders(parts)
+
+    def _copy(self):
+        return And(*self.parts)
+
+    def __invert__(self):
+        return Or(*[~p for p in self.parts])
+
+    def clauses(self):
+        return [clause for p in self.parts for clause in p.clauses()]
+
+
+class Or(Query):
+    def __init__(self, *parts):
+        self.parts = parts
+        self._order = _orders(parts)
+
+    def _copy(self):
+        return Or(*self.parts)
+
+    def __invert__(self):
+        return And(*[~p for p in self.parts])
+
+    def clauses(self):
+        clauses = [[]]
+        for p in self.parts:
+            clauses = [clause + other for clause in clauses
+                       for other in p.clauses()]
+        return clauses
+
+
+class Q(object):
+    """Field of a structured query
+
+    Comparing it or calling its methods gives a Condition. Comparisons
+    must be parenthesized when combined, as & and | bind tighter.
+    """
+    def __init__(self, field):
+        self.field = field
+
+    def __repr__(self):
+        return 'Q({0})'.format(self.field)
+
+    def __eq__(self, value):
+        if value is None:
+            return self.is_empty()
+        return Condition(self.field, '=', (value,))
+
+    def __ne__(self, value):
+        if value is None:
+            return self.is_not_empty()
+        return Condition(self.field, '!=', (value,))
+
+    __hash__ = None
+
+    def __lt__(self, value):
+        return Condition(self.field, '<', (value,))
+
+    def __le__(self, value):
+        return Condition(self.field, '<=', (value,))
+
+    def __gt__(self, value):
+        return Condition(self.field, '>', (value,))
+
+    def __ge__(self, value):
+        return Condition(self.field, '>=', (value,))
+
+    def in_(self, values):
+        return Condition(self.field, 'IN', values)
+
+    def not_in(self, values):
+        return Condition(self.field, 'NOT IN', values)
+
+    def like(self, value):
+        return Condition(self.field, 'LIKE', (value,))
+
+    def not_like(self, value):
+        return Condition(self.field, 'NOT LIKE', (value,))
+
+    def startswith(self, value):
+        return Condition(self.field, 'STARTSWITH', (value,))
+
+    def endswith(self, value):
+        return Condition(self.field, 'ENDSWITH', (value,))
+
+    def between(self, low, high):
+        return Condition(self.field, 'BETWEEN', (low, high))
+
+    def is_empty(self):
+        return Condition(self.field, 'ISEMPTY')
+
+    def is_not_empty(self):
+        return Condition(self.field, 'ISNOTEMPTY')
+
+
+def _orders(parts):
+    order = []
+    for p in parts:
+        order.extend(f for f in p._order if f not in order)
+    return tuple(order)
+
+
+def _merge(items, ops, op, combine):
+    """Merges the conditions on a field with operators in ops
+
+    The values of each field are combined into a single IN (or NOT IN)
+    condition taking the place of the first one; other items are kept as
+    they are. Returns None when combining leaves no value.
+    """
+    values = {}
+    for c in items:
+        if getattr(c, 'op', None) in ops:
+            if c.field in values:
+                values[c.field] = combine(values[c.field], c.values)
+            else:
+                values[c.field] = list(c.values)
+    merged = []
+    for c in items:
+        if getattr(c, 'op', None) not in ops:
+            merged.append(c)
+        elif c.field in values:
+            vals = values.pop(c.field)
+            if len(vals) == 0:
+                return None
+            merged.append(Condition(c.field,
+                                    ops[0] if len(vals) == 1 else op, vals))
+    return merged
+
+
+def _union(values, others):
+    return values + [v for v in others if v not in values]
+
+
+def _intersection(values, others):
+    return [v for v in values if v in others]
+
+
+def _unique(conditions):
+    seen = set()
+    unique = []
+    for c in conditions:
+        if c.key not in seen:
+            seen.add(c.key)
+            unique.append(c)
+    return unique
+
+
+def _simplify(clauses):
+    """Merges and drops redundant conditions of an AND of ORs"""
+    # a = 1 OR a IN (2, 3) => a IN (1, 2, 3)
+    clauses = [_merge(_unique(clause), ('=', 'IN'), 'IN', _union)
+               for clause in clauses]
+    # (a OR b) AND a => a
+    keys = [frozenset(c.key for c in clause) for clause in clauses]
+    kept = []
+    for i, clause in enumerate(clauses):
+        if keys[i] in keys[:i] or any(
+                other < keys[i] for other in keys):
+            continue
+        kept.append(clause)
+    # a IN (1, 2) AND a = 2 => a = 2, a != 1 AND a != 2 => a NOT IN (1, 2)
+    items = [clause[0] if len(clause) == 1 else clause for clause in kept]
+    merged = _merge(items, ('=', 'IN'), 'IN', _intersection)
+    if merged is None:
+        # contradiction, the query matches nothing as written
+        return kept
+    merged = _merge(merged, ('!=', 'NOT IN'), 'NOT IN', _union)
+    return [[c] if isinstance(c, Condition) else c for c in merged]
@@ -3,10 +3,30 @@
 # vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
 
 import servicenow
+import csv
+import datetime
+import gzip
+import io
+import json
 import logging
+import os
 import re
+import threading
 import time
 
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from servicenow.concurrency import StripedCache, bind, bounded_map
+from servicenow.concurrency import deadline
+from servicenow.query import And, Query
+
+try:
+    from queue import Queue, Full
+    from urllib.parse import quote
+except ImportError:
+    from Queue import Queue, Full
+    from urllib import quote
+
 
 try:
     text_type = str
@@ -15,14 +35,29 @@ except ImportError:
 
 
 class ServiceNow(servicenow.ServiceNow):
-    """Handles and requests ServiceNow instance"""
-    def __init__(self, url, username, password, proxy=None, verify=True):
+    """Handles and requests ServiceNow instance
+
+    `page_cache` is an optional servicenow.cache.PageCache serving the
+    pages of repeated table scans from disk.
+
+    `page_sizes` is the PageSizeController sizing table scan pages, and
+    remembering the best size of each table for the life of the client.
+
+    `interner` is the FieldInterner sharing the repeated field values of
+    the rows read.
+    """
+    def __init__(self, url, username, password, proxy=None, verify=True,
+                 page_cache=None, page_sizes=None, interner=None, **kwargs):
         super(ServiceNow, self).__init__(url,
                                          username,
                                          password,
                                          proxy,
-                                         verify)
-        self._cache = {}
+                                         verify,
+                                         **kwargs)
+        self._cache = StripedCache()
+        self.page_cache = page_cache
+        self.page_sizes = page_sizes or PageSizeController()
+        self.interner = interner or FieldInterner()
 
     def sysid_to_value(self, table, sysid):
         """Retrieve the display value from a Sys ID
@@ -31,11 +66,11 @@ class ServiceNow(servicenow.ServiceNow):
         sys_db_object tables
         """
         key = table + '.' + sysid
-        if key not in self._cache:
-            self._cache[key] = super(ServiceNow,
-                                     self).sysid_to_value(table,
-                                                          sysid)
-        return self._cache[key]
+        value = self._cache.get(key)
+        if value is None:
+            value = self._cache.setdefault(
+                key, super(ServiceNow, self).sysid_to_value(table, sysid))
+        return value
 
     def value_to_sysid(self, table, value):
         """Retrieve the Sys ID from a given display value
@@ -44,35 +79,103 @@ class ServiceNow(servicenow.ServiceNow):
         sys_db_object tables
         """
         key = table + '.' + value
-        if key not in self._cache:
-            self._cache[key] = super(ServiceNow,
-                                     self).value_to_sysid(table,
-                                                          value)
-        return self._cache[key]
+        sysid = self._cache.get(key)
+        if sysid is None:
+            sysid = self._cache.setdefault(
+                key, super(ServiceNow, self).value_to_sysid(table, value))
+        return sysid
 
     def Table(self, table):
         return Table(self, table)
 
 
 class Table(object):
+    _partition_size = 50000
+    _max_partitions = 256
+    _block_size = 100
+    _max_blocks = 16
+    _block_ttl = 5
+    _slice_pagesize = 1000
+
     def __init__(self, snow, table):
         self.snow = snow
         self.table = table
         self._default_pagesize = 30
         self.__logger = logging.getLogger('servicenow')
+        self._blocks = OrderedDict()
+        self._blocks_lock = threading.Lock()
 
     def __repr__(self):
         return 'Table({0})'.format(self.table)
 
     def __getitem__(self, index):
+        """Returns the row at index, or a list of rows for a slice
+
+        Rows are read by page-aligned blocks of _block_size records kept
+        for _block_ttl seconds, until the client writes any record (or
+        invalidate() is called), so neighbouring indexes cost a single
+        request.
+        """
+        if isinstance(index, slice):
+            return self._slice(index)
         if index < 0:
             return None
-        result = self.snow.get(self.table,
-                               display_value='all',
-                               offset=index, limit=1)
-        if len(result) == 0:
+        block = self._block(index // self._block_size)
+        if index % self._block_size >= len(block):
             return None
-        return TableRow(self, result[0])
+        return TableRow(self, block[index % self._block_size])
+
+    def _block(self, number):
+        # read before the GET, a write sent meanwhile drops the block
+        writes = getattr(self.snow, '_writes', None)
+        with self._blocks_lock:
+            entry = self._blocks.pop(number, None)
+            if entry is not None and entry[0] > time.time() and \
+                    entry[1] == writes:
+                self._blocks[number] = entry
+                return entry[2]
+        block = self.snow.get(self.table,
+                              display_value='all',
+                              offset=number * self._block_size,
+                              limit=self._block_size)
+        with self._blocks_lock:
+            self._blocks[number] = (time.time() + self._block_ttl, writes,
+                                    block)
+            while len(self._blocks) > self._max_blocks:
+                self._blocks.popitem(last=False)
+        return block
+
+    def _slice(self, index):
+        start, stop, step = index.start, index.stop, index.step or 1
+        if step < 0 or (start is not None and start < 0) or \
+                (stop is not None and stop < 0):
+            start, stop, step = index.indices(len(self))
+        if step < 0:
+            if start <= stop:
+                return []
+            return self._range(stop + 1, start + 1)[::step]
+        return self._range(start or 0, stop)[::step]
+
+    def _range(self, start, stop):
+        rows = []
+        if stop is None:
+            for page in TableIterator(self.snow, self.table,
+                                      offset=start).pages():
+                rows.extend(page)
+        while stop is not None and start < stop:
+            limit = min(self._slice_pagesize, stop - start)
+            result = self.snow.get(self.table, display_value='all',
+                                   offset=start, limit=limit)
+            rows.extend(result)
+            if len(result) < limit:
+                break
+            start += limit
+        return [TableRow(self, row) for row in rows]
+
+    def invalidate(self):
+        """Forgets the blocks read by index"""
+        with self._blocks_lock:
+            self._blocks.clear()
 
     def __iter__(self):
         return iter(TableIterator(self.snow, self.table))
@@ -102,9 +205,17 @@ class Table(object):
         return offset + 1
 
     def __delitem__(self, index):
-        self.remove(self[index])
+        # not read from the blocks: a stale index would delete another row
+        if index < 0:
+            raise IndexError(index)
+        result = self.snow.get(self.table, fields='sys_id',
+                               offset=index, limit=1)
+        if len(result) == 0:
+            raise IndexError(index)
+        self.remove(result[0])
 
     def remove(self, item):
+        self.invalidate()
         if isinstance(item, dict):
             return self.snow.delete("{0}/{sys_id}".format(self.table, **item))
         else:
@@ -116,8 +227,199 @@ class Table(object):
         for field in row:
             if field != 'sys_id':
                 params[field] = row[field]
+        self.invalidate()
         return self.snow.post(self.table, params, **kwargs)
 
+    def update_where(self, query, values, **kwargs):
+        """Sets values on every record matching the encoded query
+
+        The JSONv2 client does it in one request, the REST client with
+        concurrent Batch API requests of batch_size PUTs. Returns the
+        number of updated records.
+        """
+        self.invalidate()
+        return self.snow.update_where(self.table, query, values, **kwargs)
+
+    def upsert_many(self, rows, key='serial_number', chunk_size=100,
+                    workers=4, **kwargs):
+        """Inserts or updates records matched on a natural key
+
+        Existing records are looked up by chunks of `chunk_size` keys
+        (keyIN queries, OR-ed with key=value for keys holding a comma),
+        then missing ones are inserted and existing ones updated with only
+        their changed fields, by Batch API requests of `chunk_size`
+        records, `workers` requests at a time. Rows sharing a key are
+        merged, the last value winning.
+
+        Returns one outcome per row, in order: a dict with the key, the
+        action ('inserted', 'updated', 'unchanged' or 'error'), the
+        sys_id and the error when the request failed.
+        """
+        rows = list(rows)
+        merged = OrderedDict()
+        for row in rows:
+            if row.get(key) in (None, ''):
+                raise ValueError('no {0} specified in {1}'.format(key, row))
+            value = text_type(row[key])
+            merged.setdefault(value, {}).update(row)
+        fields = set([key, 'sys_id'])
+        for row in rows:
+            fields.update(row)
+        keys = list(merged)
+        chunks = [keys[i:i + chunk_size]
+                  for i in range(0, len(keys), chunk_size)]
+
+        def lookup(chunk):
+            values = [v.replace('^', '^^') for v in chunk]
+            # IN lists are comma separated
+            clauses = ['{0}={1}'.format(key, v) for v in values if ',' in v]
+            plain = [v for v in values if ',' not in v]
+            if len(plain) > 0:
+                clauses.insert(0, '{0}IN{1}'.format(key, ','.join(plain)))
+            return self.snow.get(
+                self.table, query='^OR'.join(clauses),
+                fields=','.join(sorted(fields)),
+                exclude_reference_link=True)
+
+        def upsert(chunk):
+            try:
+                served = self.snow._batch(chunk, **kwargs)
+            except servicenow.ServiceNowHttpError as e:
+                served = e
+            results = []
+            for value, method, path, params in chunk:
+                record = existing.get(value)
+                status, res = None, None
+                if isinstance(served, dict) and value in served:
+                    status, res = served[value]
+                if not isinstance(res, dict):
+                    res = {}
+                if status in (200, 201, 204):
+                    results.append({
+                        'key': value,
+                        'action': 'inserted' if method == 'POST'
+                        else 'updated',
+                        'sys_id': res.get('sys_id') or
+                        (record and record['sys_id'])})
+                    continue
+                error = served
+                if not isinstance(error, Exception):
+                    error = servicenow.ServiceNowHttpError(
+                        path, status, res.get('error', {}).get(
+                            'message', 'not serviced'))
+                results.append({'key': value, 'action': 'error',
+                                'sys_id': record and record['sys_id'],
+                                'error': error})
+            return results
+
+        existing = {}
+        self.invalidate()
+        executor = ThreadPoolExecutor(max_workers=workers)
+        try:
+            for res in bounded_map(lookup, chunks, executor, 2 * workers):
+                for record in res:
+                    existing.setdefault(text_type(record[key]), record)
+            outcomes = {}
+            requests = []
+            for value in keys:
+                row = merged[value]
+                record = existing.get(value)
+                if record is None:
+                    requests.append((value, 'POST', self.table, dict(
+                        (f, v) for f, v in row.items() if f != 'sys_id')))
+                    continue
+                params = dict(
+                    (f, v) for f, v in row.items() if f != 'sys_id' and
+                    text_type(v) != text_type(record.get(f, '')))
+                if len(params) > 0:
+                    requests.append((value, 'PUT', '{0}/{1}'.format(
+                        self.table, record['sys_id']), params))
+                else:
+                    outcomes[value] = {'key': value, 'action': 'unchanged',
+                                       'sys_id': record['sys_id']}
+            batches = [requests[i:i + chunk_size]
+                       for i in range(0, len(requests), chunk_size)]
+            for results in bounded_map(upsert, batches, executor,
+                                       2 * workers):
+                for outcome in results:
+                    outcomes[outcome['key']] = outcome
+        finally:
+            executor.shutdown(wait=False)
+        self.invalidate()
+        return [outcomes[text_type(row[key])] for row in rows]
+
+    def attachments(self, sys_id):
+        """Lists the attachments of a record (Attachment API metadata)"""
+        return self.snow.get('api/now/attachment',
+                             query='table_name={0}^table_sys_id={1}'.format(
+                                 self.table, sys_id))
+
+    def download(self, attachment, fileobj, chunk_size=65536):
+        """Writes the content of an attachment to a binary file object
+
+        `attachment` is an item of attachments() or its sys_id. The content
+        is streamed by blocks of `chunk_size` bytes. Returns the number of
+        bytes written.
+        """
+        if isinstance(attachment, dict):
+            attachment = attachment['sys_id']
+        size = 0
+        for chunk in self.snow._stream(
+                'GET', '{0}/api/now/attachment/{1}/file'.format(
+                    self.snow.url, attachment), chunk_size=chunk_size):
+            fileobj.write(chunk)
+            size += len(chunk)
+        return size
+
+    def download_all(self, sys_id, directory, workers=4, chunk_size=65536):
+        """Downloads every attachment of a record into a directory
+
+        Attachments are transferred `workers` at a time. Returns the paths
+        of the written files, the attachment sys_id prefixing the names
+        attached several times.
+        """
+        attachments = self.attachments(sys_id)
+        names = [a['file_name'] for a in attachments]
+        paths = [os.path.join(directory, name) if names.count(name) == 1
+                 else os.path.join(directory,
+                                   '{0}_{1}'.format(a['sys_id'], name))
+                 for a, name in zip(attachments, names)]
+
+        def download(item):
+            attachment, path = item
+            with open(path, 'wb') as f:
+                self.download(attachment, f, chunk_size)
+            return path
+        executor = ThreadPoolExecutor(max_workers=workers)
+        try:
+            return list(bounded_map(download, zip(attachments, paths),
+                                    executor, 2 * workers))
+        finally:
+            executor.shutdown(wait=False)
+
+    def upload(self, sys_id, fileobj, file_name=None,
+               content_type='application/octet-stream', chunk_size=65536):
+        """Attaches the content of a binary file object to a record
+
+        The content is streamed by blocks of `chunk_size` bytes.
+        `file_name` defaults to the name of the file. Returns the
+        attachment metadata.
+        """
+        if file_name is None:
+            file_name = os.path.basename(getattr(fileobj, 'name', ''))
+        if not file_name:
+            raise ValueError('no file_name specified')
+        url = '{0}/api/now/attachment/file?table_name={1}&' \
+            'table_sys_id={2}&file_name={3}'.format(
+                self.snow.url, quote(self.table), quote(sys_id),
+                quote(file_name))
+        chunks = self.snow._stream('POST', url, body=fileobj,
+                                   headers={'Content-Type': content_type,
+                                            'Accept': 'application/json'},
+                                   status_codes=(200, 201),
+                                   chunk_size=chunk_size)
+        return self.snow._decode(b''.join(chunks))
+
     def _prepare(self, *filters):
         if len([f for f in filters if len(f) > 0]) == 0:
             raise Exception('no filters found')
@@ -173,13 +475,249 @@ class Table(object):
                 query.append(g.string)
         return "^".join(query)
 
-    def search(self, *args):
-        return TableIterator(self.snow, self.table,
-                             query=self._prepare(*args))
+    def search(self, *args, **kwargs):
+        """Iterates over the records matching every filter
+
+        Filters are servicenow.query.Query objects, compiled without any
+        request, or strings such as 'state=New' whose fields are first
+        probed (reference fields, choice labels).
+        Keywords arguments are passed to filter(), such as dot-walked
+        `fields` (see filter()).
+        """
+        queries = [f for f in args if isinstance(f, Query)]
+        if len(queries) == 0:
+            return TableIterator(self.snow, self.table,
+                                 query=self._prepare(*args), **kwargs)
+        filters = [f for f in args if not isinstance(f, Query) and f]
+        query = And(*queries).compile()
+        if len(filters) > 0:
+            query = '{0}^{1}'.format(self._prepare(*filters), query)
+        return TableIterator(self.snow, self.table, query=query, **kwargs)
 
     def filter(self, **kwargs):
+        """Iterates over the records matching the keywords arguments
+
+        `fields` may include dot-walked fields, read in the same requests
+        and exposed as nested attributes: with
+        fields='number,caller_id.name', row.caller_id.name is the name of
+        the caller.
+        """
         return TableIterator(self.snow, self.table, **kwargs)
 
+    def count(self, query=None):
+        """Counts the records matching the query with the stats API"""
+        return self.aggregate(query)['count']
+
+    def aggregate(self, query=None, group_by=None, count=True, sum=None,
+                  avg=None, min=None, max=None, **kwargs):
+        """Computes aggregates server-side with the stats API
+
+        sum, avg, min and max are lists (or comma-separated strings) of
+        fields. Returns a dict such as
+        {'count': 12, 'sum': {'reassignment_count': 30.0}}, or with
+        `group_by` a list of those dicts each holding its group values
+        under 'group_by'. Other keywords are passed to the stats API
+        (display_value, having, order_by...).
+        """
+        fields = {}
+        for name, value in (('sum', sum), ('avg', avg),
+                            ('min', min), ('max', max)):
+            if isinstance(value, (list, tuple)):
+                value = ','.join(value)
+            if value:
+                fields['{0}_fields'.format(name)] = value
+        if isinstance(group_by, (list, tuple)):
+            group_by = ','.join(group_by)
+        kwargs.update(fields)
+        res = self.snow.get('api/now/stats/{0}'.format(self.table),
+                            query=query, group_by=group_by,
+                            count='true' if count else None, **kwargs)
+        if group_by is None:
+            return _stats(res['stats'])
+        results = []
+        for group in res:
+            result = _stats(group['stats'])
+            result['group_by'] = dict((f['field'], f['value'])
+                                      for f in group['groupby_fields'])
+            results.append(result)
+        return results
+
+    def _partition(self, query, partitions, by):
+        if partitions == 1:
+            return ['']
+        if by == 'sys_id':
+            digits = len('{0:x}'.format(partitions)) + 1
+            bounds = ['{0:0{1}x}'.format(i * 16 ** digits // partitions,
+                                         digits)
+                      for i in range(1, partitions)]
+        elif by == 'sys_created_on':
+            fmt = '%Y-%m-%d %H:%M:%S'
+            res = self.aggregate(query, count=False, min=by, max=by)
+            if not res['min'][by]:
+                return ['']
+            start = datetime.datetime.strptime(res['min'][by], fmt)
+            end = datetime.datetime.strptime(res['max'][by], fmt)
+            step = (end - start) // partitions
+            if step < datetime.timedelta(seconds=1):
+                return ['']
+            bounds = [(start + step * i).strftime(fmt)
+                      for i in range(1, partitions)]
+        else:
+            raise ValueError('cannot partition on {0}'.format(by))
+        ranges = ['{0}<{1}'.format(by, bounds[0])]
+        for low, high in zip(bounds, bounds[1:]):
+            ranges.append('{0}>={1}^{0}<{2}'.format(by, low, high))
+        ranges.append('{0}>={1}'.format(by, bounds[-1]))
+        return ranges
+
+    def parallel_scan(self, query=None, partitions=None, workers=4,
+                      by='sys_id', ordered=False, **kwargs):
+        """Scans the table with concurrent requests over disjoint ranges
+
+        The table is split on `by` (sys_id prefixes or sys_created_on
+        windows) into `partitions` ranges, by default one per
+        _partition_size records matching the query. `workers` threads
+        page through the ranges; rows come out as soon as they arrive,
+        or range after range when `ordered` is True. Other keywords are
+        passed to each range iterator (fields, display_value...).
+        """
+        if partitions is None:
+            partitions = min(self._max_partitions, max(
+                1, -(-self.count(query) // self._partition_size)))
+        iterators = [
+            TableIterator(self.snow, self.table,
+                          query='^'.join(str(q) for q in (query, r) if q),
+                          **kwargs)
+            for r in self._partition(query, partitions, by)]
+        return _gather(iterators, workers, ordered)
+
+    def export(self, path, format='ndjson', fields=None, query=None,
+               compress=False, checkpoint=None, **kwargs):
+        """Streams the records matching the query to a file
+
+        Pages are written as they arrive, without building TableRow
+        objects: one JSON object per line for 'ndjson', or 'csv' with a
+        header from `fields` (or from the first page). Raw values are
+        exported unless display_value is given. The file is gzipped when
+        `compress` is True or `path` ends with '.gz'.
+
+        With `checkpoint`, the progress is saved to that file after each
+        page, so an interrupted export resumes where it stopped (the
+        records are then ordered by sys_id unless an order is given).
+        Returns the number of rows, elapsed seconds and rows per second.
+        """
+        if format not in ('ndjson', 'csv'):
+            raise ValueError('format must be ndjson or csv')
+        state = {'offset': 0, 'header': None}
+        if checkpoint is not None:
+            kwargs.setdefault('order', 'sys_id')
+            if os.path.exists(checkpoint):
+                with open(checkpoint) as f:
+                    state = json.load(f)
+        if isinstance(fields, (list, tuple)):
+            fields = ','.join(fields)
+        header = fields.split(',') if fields else state['header']
+        kwargs.setdefault('display_value', 'false')
+        iterator = TableIterator(self.snow, self.table, query=query,
+                                 fields=fields, offset=state['offset'],
+                                 **kwargs)
+        mode = 'ab' if state['offset'] > 0 else 'wb'
+        if compress or path.endswith('.gz'):
+            raw = gzip.open(path, mode)
+        else:
+            raw = io.open(path, mode)
+        rows = 0
+        time_start = time.time()
+        with raw:
+            out = raw
+            if format == 'csv':
+                out = io.TextIOWrapper(raw, encoding='utf-8', newline='')
+                writer = None
+            for page in iterator.pages():
+                if len(page) == 0:
+                    continue
+                if format == 'ndjson':
+                    out.write(b''.join(self.snow._codec.dumps(row) + b'\n'
+                                       for row in page))
+                else:
+                    if writer is None:
+                        if header is None:
+                            header = list(page[0])
+                        writer = csv.DictWriter(out, header, restval='',
+                                                extrasaction='ignore')
+                        if state['offset'] == 0:
+                            writer.writeheader()
+                    writer.writerows(
+                        dict((k, v.get('value') if isinstance(v, dict)
+                              else v) for k, v in row.items())
+                        for row in page)
+                    out.flush()
+                rows += len(page)
+                if checkpoint is not None:
+                    raw.flush()
+                    state['offset'] += len(page)
+                    state['header'] = header
+                    with open(checkpoint + '.tmp', 'w') as f:
+                        json.dump(state, f)
+                    os.rename(checkpoint + '.tmp', checkpoint)
+            if format == 'csv':
+                out.detach()
+        elapsed = time.time() - time_start
+        if checkpoint is not None and os.path.exists(checkpoint):
+            os.remove(checkpoint)
+        stats = {'rows': rows, 'seconds': elapsed,
+                 'rows_per_sec': rows / elapsed if elapsed > 0 else None}
+        self.__logger.info('%s exported %d rows to %s (%s rows/sec)',
+                           self.table, rows, path, stats['rows_per_sec'])
+        return stats
+
+
+class PageSizeController(object):
+    """Adapts TableIterator page sizes to a target page latency
+
+    After each page, the size moves towards the one that would have taken
+    `target` seconds, by a `smoothing` fraction of the gap, growing at
+    most `max_growth` times per page and staying within
+    [min_size, max_size]. A page failing with a timeout, throttling or
+    server error is retried up to `retries` times, `backoff` times
+    smaller. The size reached on full pages is remembered per table.
+    """
+    retryable_codes = (-1, 408, 429, 500, 502, 503, 504)
+
+    def __init__(self, target=0.8, min_size=10, max_size=10000,
+                 smoothing=0.5, max_growth=2.0, backoff=0.5, retries=3):
+        self.target = target
+        self.min_size = min_size
+        self.max_size = max_size
+        self.smoothing = smoothing
+        self.max_growth = max_growth
+        self.backoff = backoff
+        self.retries = retries
+        self._learned = {}
+
+    def _clamp(self, size):
+        return int(max(self.min_size, min(self.max_size, size)))
+
+    def initial(self, table, default):
+        return self._learned.get(table, default)
+
+    def next(self, size, elapsed):
+        if elapsed <= 0:
+            return self._clamp(size * self.max_growth)
+        ideal = size * self.target / elapsed
+        return self._clamp(min(size + self.smoothing * (ideal - size),
+                               size * self.max_growth))
+
+    def failed(self, size, error, attempt):
+        """Returns the size to retry with, None to give up"""
+        if error.code not in self.retryable_codes or \
+                attempt > self.retries or size <= 1:
+            return None
+        return int(max(1, min(self.max_size, size) * self.backoff))
+
+    def learn(self, table, size):
+        self._learned[table] = size
+
 
 class TableIterator(object):
     def __init__(self, snow, table, **opts):
@@ -188,39 +726,308 @@ class TableIterator(object):
         self.table = table
         self.opts = opts
 
-    def __iter__(self):
+    def _fingerprint(self, kwargs):
+        res = Table(self.snow, self.table).aggregate(
+            kwargs.get('query'), max='sys_updated_on')
+        return [res['count'], res.get('max', {}).get('sys_updated_on')]
+
+    def _fetch(self, kwargs, controller, cache, read_cache):
+        if cache is not None and read_cache:
+            cached = cache.load(self.snow._url_rewrite(self.table, **kwargs),
+                                self.snow._codec)
+            if cached is not None:
+                return cached
+        attempt = 0
+        while True:
+            time_start = time.time()
+            try:
+                results = self.snow.get(self.table, **kwargs)
+                break
+            except servicenow.ServiceNowHttpError as e:
+                attempt += 1
+                limit = controller.failed(kwargs['limit'], e, attempt)
+                if limit is None:
+                    raise
+                logging.getLogger('servicenow').warning(
+                    '%s, retrying %s with %d records', e, self.table, limit)
+                kwargs['limit'] = limit
+        time_elapsed = time.time() - time_start
+        next_limit = controller.next(kwargs['limit'], time_elapsed)
+        if cache is not None and isinstance(results, list):
+            # the next page size is kept so a replayed scan requests the
+            # same pages
+            cache.store(self.snow._url_rewrite(self.table, **kwargs),
+                        [results, next_limit], self.snow._codec)
+        return results, next_limit
+
+    def pages(self):
+        """Yields each page of records as returned by the instance
+
+        With a `deadline` option, the whole iteration must complete within
+        that many seconds (see ServiceNow.deadline()).
+        """
         kwargs = dict(self.opts)
+        until = kwargs.pop('deadline', None)
+        if until is not None:
+            until += time.time()
         record_limit = kwargs.get('limit')
         record = 0
-        kwargs['limit'] = self._default_pagesize
-        kwargs['offset'] = 0
+        controller = _page_sizes(self.snow)
+        cache = getattr(self.snow, 'page_cache', None)
+        if cache is None:
+            kwargs['limit'] = controller.initial(self.table,
+                                                self._default_pagesize)
+        else:
+            # replayed scans must request the same pages
+            kwargs['limit'] = self._default_pagesize
+        kwargs['offset'] = kwargs.get('offset', 0)
         kwargs['display_value'] = kwargs.get('display_value', 'all')
+        read_cache = True
+        ceiling = controller.max_size
+        fingerprint = None
+        if cache is not None and cache.revalidate:
+            key = 'fingerprint:' + self.snow._url_rewrite(
+                self.table, **dict((k, v) for k, v in kwargs.items()
+                                   if k not in ('limit', 'offset')))
+            with deadline(_left(until)):
+                fingerprint = self._fingerprint(kwargs)
+            read_cache = cache.load(key, self.snow._codec) == fingerprint
         while True:
-            time_start = time.time()
-            results = self.snow.get(self.table, **kwargs)
-            time_elapsed = time.time() - time_start
-            for row in results:
-                if record_limit is not None and record == record_limit:
-                    raise StopIteration
-                record += 1
-                yield TableRow(self, row)
+            if record_limit is not None:
+                kwargs['limit'] = min(kwargs['limit'], record_limit - record)
+            limit = kwargs['limit']
+            with deadline(_left(until)):
+                results, next_limit = self._fetch(kwargs, controller, cache,
+                                                  read_cache)
+            if kwargs['limit'] < limit:
+                # the page was retried smaller, do not grow past it again
+                ceiling = kwargs['limit']
+            next_limit = min(next_limit, ceiling)
+            if record_limit is not None and \
+                    record + len(results) >= record_limit:
+                yield results[:record_limit - record]
+                return
+            record += len(results)
+            if len(results) > 0:
+                yield results
             if len(results) < kwargs['limit']:
-                raise StopIteration
+                break
+            controller.learn(self.table, next_limit)
             kwargs['offset'] += kwargs['limit']
-            kwargs['limit'] = int(max(1, kwargs['limit'] * 0.8 / time_elapsed))
+            kwargs['limit'] = next_limit
+        if fingerprint is not None:
+            cache.store(key, fingerprint, self.snow._codec)
+
+    def __iter__(self):
+        for page in self.pages():
+            for row in page:
+                yield TableRow(self, row)
+
+
+def _page_sizes(snow):
+    """PageSizeController of a client, one is kept on clients without"""
+    controller = getattr(snow, 'page_sizes', None)
+    if controller is None:
+        # setdefault keeps the first one set by concurrent scans
+        controller = vars(snow).setdefault('page_sizes',
+                                           PageSizeController())
+    return controller
+
+
+def _left(until):
+    return None if until is None else until - time.time()
+
+
+def _number(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _stats(stats):
+    """Converts a stats API result to numbers"""
+    result = {}
+    if 'count' in stats:
+        result['count'] = int(stats['count'])
+    for name in ('sum', 'avg'):
+        if name in stats:
+            result[name] = dict((k, _number(v))
+                                for k, v in stats[name].items())
+    for name in ('min', 'max'):
+        if name in stats:
+            result[name] = dict(stats[name])
+    return result
+
+
+def _put(queue, item, stop):
+    while not stop.is_set():
+        try:
+            queue.put(item, timeout=0.1)
+            return
+        except Full:
+            continue
+
+
+def _gather(iterators, workers, ordered, errors=None):
+    """Pages through iterators concurrently and yields their rows
+
+    With an `errors` dict, the exception of a failing iterator is stored
+    under its index instead of being raised, and (index, row) tuples are
+    yielded.
+    """
+    stop = threading.Event()
+    if ordered:
+        queues = [Queue(maxsize=4) for _ in iterators]
+    else:
+        queues = [Queue(maxsize=4 * workers)] * len(iterators)
+
+    def produce(index):
+        try:
+            for page in iterators[index].pages():
+                if stop.is_set():
+                    return
+                _put(queues[index], (index, page), stop)
+        except Exception as e:
+            _put(queues[index], (index, e), stop)
+        else:
+            _put(queues[index], (index, None), stop)
+
+    executor = ThreadPoolExecutor(max_workers=workers)
+    try:
+        produce = bind(produce)
+        for index in range(len(iterators)):
+            executor.submit(produce, index)
+        pending = set(range(len(iterators)))
+        while len(pending) > 0:
+            queue = queues[min(pending)]
+            index, page = queue.get()
+            if page is None:
+                pending.discard(index)
+                continue
+            if isinstance(page, Exception):
+                if errors is None:
+                    raise page
+                errors[index] = page
+                pending.discard(index)
+                continue
+            for row in page:
+                if errors is None:
+                    yield TableRow(iterators[index], row)
+                else:
+                    yield index, TableRow(iterators[index], row)
+    finally:
+        stop.set()
+        executor.shutdown(wait=False)
+
+
+def _field_parts(data):
+    """(link, display_value, value) of a field given as read or as set
+
+    Fields of other rows are unwrapped to plain strings.
+    """
+    if isinstance(data, TableRowField):
+        parts = (data.link, data.display_value, data.value)
+    elif isinstance(data, dict):
+        parts = (data.get('link'), data.get('display_value'),
+                 data.get('value'))
+    else:
+        return (None, None, data)
+    return tuple(text_type(p) if isinstance(p, text_type) else p
+                 for p in parts)
+
+
+class FieldInterner(object):
+    """Shares the TableRowField objects of repeated column values
+
+    Large result sets repeat a few values per column (states, priorities,
+    reference display values) across many rows: rows decoded through the
+    interner get a single field object per distinct value of a column.
+    Reference fields are not shared, their link and value strings are.
+    At most `max_values` values of up to `max_length` characters are kept
+    per table column, other values getting fields of their own.
+    """
+    def __init__(self, max_values=256, max_length=64):
+        self.max_values = max_values
+        self.max_length = max_length
+        self._columns = {}
+
+    def _shareable(self, key):
+        for part in key:
+            if part is not None and (type(part) is not text_type or
+                                     len(part) > self.max_length):
+                return False
+        return True
+
+    def field(self, table, column, data):
+        """Returns the field of a column value, shared when possible"""
+        key = _field_parts(data)
+        if not self._shareable(key):
+            return TableRowField(*key)
+        values = self._columns.get((table, column))
+        if values is None:
+            values = self._columns.setdefault((table, column), {})
+        field = values.get(key)
+        if field is None:
+            field = TableRowField(*key)
+            if len(values) < self.max_values:
+                field = values.setdefault(key, field)
+        if field.link:
+            # reference fields cache the record they point at, so rows get
+            # their own field, only its strings being shared
+            return TableRowField(field.link, field.display_value,
+                                 field.value)
+        return field
+
+    def clear(self):
+        self._columns.clear()
 
 
 class TableRow(dict):
     def __init__(self, parent, data):
         obj = dict()
+        snow = getattr(parent, 'snow', None)
+        interner = getattr(snow, 'interner', None)
+        if not isinstance(interner, FieldInterner):
+            interner = None
+        # fields dot-walked through get attributes, so are never shared
+        walked = set()
         for key in data:
-            if isinstance(data[key], dict):
-                obj[key] = TableRowField(**data[key])
+            names = key.split('.')
+            for i in range(1, len(names)):
+                walked.add('.'.join(names[:i]))
+        for key in data:
+            if interner is not None and key not in walked:
+                obj[key] = interner.field(getattr(parent, 'table', None),
+                                          key, data[key])
             else:
-                obj[key] = TableRowField(value=data[key])
+                obj[key] = TableRowField(*_field_parts(data[key]))
         super(TableRow, self).__init__(obj)
         self.__dict__ = obj
         self._parent = parent
+        for key in sorted(obj, key=lambda k: k.count('.')):
+            if isinstance(obj[key], TableRowField):
+                obj[key]._snow = snow
+            if '.' in key:
+                self._walk(key)
+
+    def _walk(self, key):
+        """Attaches a dot-walked field to the field it is read through
+
+        Fields only read through dot-walking get an empty placeholder, kept
+        out of the row items.
+        """
+        names = key.split('.')
+        node = self.__dict__.get(names[0])
+        if node is None:
+            node = self.__dict__[names[0]] = TableRowField(value='')
+        for name in names[1:-1]:
+            child = node.__dict__.get(name)
+            if not isinstance(child, TableRowField):
+                child = TableRowField(value='')
+                setattr(node, name, child)
+            node = child
+        setattr(node, names[-1], self[key])
 
     def __eq__(self, data):
         for k in self:
@@ -238,11 +1045,20 @@ class TableRow(dict):
         return True
 
     def __setitem__(self, name, value):
-        if self[name] == self[name].value:
-            self[name].value = value
+        # fields may be shared with other rows: replaced, never modified
+        old = self[name]
+        if old == old.value:
+            field = TableRowField(old.link, old.display_value, value)
         else:
-            self[name].display_value = value
+            field = TableRowField(old.link, value, old.value)
+        for key, attr in old.__dict__.items():
+            if key not in ('link', 'value', 'display_value', '_reference'):
+                setattr(field, key, attr)
+        super(TableRow, self).__setitem__(name, field)
+        self.__dict__[name] = field
         if self._parent is not None:
+            if isinstance(self._parent, Table):
+                self._parent.invalidate()
             self._parent.snow.put(
                 "{0}/{sys_id}".format(self._parent.table, **self),
                 {name: value})
@@ -269,6 +1085,21 @@ class TableRowField(text_type):
             obj.__str__ = lambda self: self.__unicode__().encode('utf-8')
         return obj
 
+    @property
+    def reference(self):
+        """TableRowReference to the record of a reference field
+
+        None when the field has no link. The record is only fetched when
+        one of its fields is read.
+        """
+        if not self.link:
+            return None
+        ref = self.__dict__.get('_reference')
+        if ref is None or ref.link != self.link:
+            ref = self._reference = TableRowReference(
+                self.__dict__.get('_snow'), self.link, self.value)
+        return ref
+
     def __ne__(self, data):
         return not self.__eq__(data)
 
@@ -284,4 +1115,54 @@ class TableRowField(text_type):
         return False
 
 
+class TableRowReference(object):
+    """Record pointed at by a reference field link, fetched lazily
+
+    Reading an item or an attribute fetches the record once (with
+    display values), then answers from it.
+    """
+    def __init__(self, snow, link, sys_id=None):
+        self.snow = snow
+        self.link = link
+        match = re.search('/api/now/(?:v[0-9]+/)?table/([^/?&]+)/([^/?&]+)',
+                          link)
+        self.table = match.group(1) if match else None
+        self.sys_id = match.group(2) if match else sys_id
+        self._row = None
+
+    def __repr__(self):
+        return 'TableRowReference({0})'.format(self.link)
+
+    @property
+    def row(self):
+        """The referenced TableRow, fetched on first access"""
+        if self._row is None:
+            if self.snow is None:
+                raise ValueError('no client to fetch {0}'.format(self.link))
+            if self.table is not None:
+                data = self.snow.get('{0}/{1}'.format(self.table,
+                                                      self.sys_id),
+                                     display_value='all')
+            else:
+                data = self.snow._call('GET', self.link, status_codes=(200,))
+            if not isinstance(data, dict) or 'error' in data:
+                raise servicenow.ServiceNowReferenceNotFound(
+                    self.sys_id, self.table)
+            parent = self.snow.Table(self.table) \
+                if hasattr(self.snow, 'Table') and self.table else None
+            self._row = TableRow(parent, data)
+        return self._row
+
+    def __getitem__(self, name):
+        return self.row[name]
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        try:
+            return self.row[name]
+        except KeyError:
+            raise AttributeError(name)
+
+
 API = ServiceNow
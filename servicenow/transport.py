@@ -0,0 +1,452 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+"""HTTP transports sending the requests of a ServiceNow client
+
+The standard library urllib is used by default. Adapters for urllib3,
+requests and httpx can be picked when those libraries are installed, and
+FakeTransport answers requests in-process for tests and benchmarks.
+"""
+
+import base64
+import io
+import json
+import os
+import socket
+import ssl
+import threading
+
+try:
+    from urllib.request import HTTPPasswordMgrWithDefaultRealm, HTTPSHandler
+    from urllib.request import HTTPBasicAuthHandler, ProxyHandler
+    from urllib.request import build_opener, Request
+    from urllib.error import HTTPError, URLError
+    from http.client import BadStatusLine
+except ImportError:
+    from urllib2 import HTTPPasswordMgrWithDefaultRealm, HTTPSHandler
+    from urllib2 import HTTPBasicAuthHandler, ProxyHandler
+    from urllib2 import build_opener, Request, HTTPError, URLError
+    from httplib import BadStatusLine
+
+
+class TransportError(Exception):
+    """No usable response was received
+
+    `code` is the status of an error response, None when the connection
+    failed.
+    """
+    def __init__(self, code, message, content=None):
+        Exception.__init__(self, message)
+        self.code = code
+        self.message = message
+        self.content = content
+
+
+class Transport(object):
+    """Sends the HTTP requests of a client
+
+    send() returns (status, reason, body) and raises TransportError for
+    error statuses (4xx and 5xx), connection failures and timeouts.
+    `timeout` is None or a (connect, read) tuple of seconds. Transports
+    must be usable from several threads.
+    """
+    name = None
+
+    def send(self, method, url, headers, body=None, timeout=None):
+        raise NotImplementedError
+
+    def stream(self, method, url, headers, body=None, chunk_size=65536,
+               timeout=None):
+        """Sends a request without buffering the bodies
+
+        `body` may be a file object. Returns (status, reason, chunks),
+        chunks yielding the response body by blocks of at most
+        `chunk_size` bytes. This default implementation buffers them.
+        """
+        if hasattr(body, 'read'):
+            body = b''.join(iter(lambda: body.read(chunk_size), b''))
+        status, reason, data = self.send(method, url, headers, body,
+                                         timeout)
+        return status, reason, (data[i:i + chunk_size]
+                                for i in range(0, len(data), chunk_size))
+
+    def close(self):
+        pass
+
+
+def _basic_auth(username, password):
+    token = '{0}:{1}'.format(username, password).encode('utf-8')
+    return 'Basic ' + base64.b64encode(token).decode('ascii')
+
+
+def _chunks(read, close, chunk_size):
+    try:
+        while True:
+            chunk = read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+    finally:
+        close()
+
+
+class FileChunks(object):
+    """File object read by blocks of at most `chunk_size` bytes
+
+    Used as a request body, it is streamed with a Content-Length by every
+    transport instead of being loaded in memory.
+    """
+    def __init__(self, fileobj, chunk_size=65536, length=None):
+        self.fileobj = fileobj
+        self.chunk_size = chunk_size
+        if length is None:
+            try:
+                length = os.fstat(fileobj.fileno()).st_size - \
+                    fileobj.tell()
+            except (AttributeError, OSError, ValueError,
+                    io.UnsupportedOperation):
+                position = fileobj.tell()
+                fileobj.seek(0, os.SEEK_END)
+                length = fileobj.tell() - position
+                fileobj.seek(position)
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+    def read(self, size=-1):
+        if size is None or size < 0 or size > self.chunk_size:
+            size = self.chunk_size
+        return self.fileobj.read(size)
+
+    def __iter__(self):
+        return iter(lambda: self.fileobj.read(self.chunk_size), b'')
+
+
+class UrllibTransport(Transport):
+    """Standard library transport
+
+    urllib has a single socket timeout: the larger of the connect and read
+    timeouts is used.
+    """
+    name = 'urllib'
+
+    def __init__(self, url, username, password, proxy=None, verify=True):
+        self._auth = _basic_auth(username, password)
+        self._password_mgr = HTTPPasswordMgrWithDefaultRealm()
+        self._password_mgr.add_password(None, url, username, password)
+        self._ssl_context = None
+        if verify is False:
+            self._ssl_context = ssl.create_default_context()
+            self._ssl_context.check_hostname = False
+            self._ssl_context.verify_mode = ssl.CERT_NONE
+        self._proxy = proxy
+        self._local = threading.local()
+
+    @property
+    def _opener(self):
+        """urllib opener of the current thread
+
+        Handlers keep per-request state (authentication retries), so
+        they are not shared between threads.
+        """
+        opener = getattr(self._local, 'opener', None)
+        if opener is None:
+            handlers = []
+            if self._ssl_context is not None:
+                handlers.append(HTTPSHandler(context=self._ssl_context))
+            handlers.append(HTTPBasicAuthHandler(self._password_mgr))
+            if self._proxy is not None:
+                handlers.append(ProxyHandler(
+                    {'http': self._proxy, 'https': self._proxy}))
+            opener = self._local.opener = build_opener(*handlers)
+        return opener
+
+    def _open(self, method, url, headers, body, timeout):
+        request = Request(url)
+        request.get_method = lambda: method
+        if body:
+            # setting data drops any Content-Length header
+            request.data = body
+        for name, value in headers.items():
+            request.add_header(name, value)
+        try:
+            if timeout is None:
+                return self._opener.open(request)
+            return self._opener.open(request, timeout=max(timeout))
+        except HTTPError as e:
+            try:
+                content = e.read()
+            except:
+                content = None
+            raise TransportError(e.code, e.msg, content)
+        except BadStatusLine as e:
+            raise TransportError(None, e.line)
+        except URLError as e:
+            raise TransportError(None, e.reason)
+        except socket.timeout:
+            raise TransportError(None, 'timed out')
+
+    def send(self, method, url, headers, body=None, timeout=None):
+        response = self._open(method, url, headers, body, timeout)
+        try:
+            return response.getcode(), response.msg, response.read()
+        except socket.timeout:
+            raise TransportError(None, 'timed out')
+
+    def stream(self, method, url, headers, body=None, chunk_size=65536,
+               timeout=None):
+        # a streamed body cannot be sent again after an authentication
+        # challenge
+        headers = dict(headers, Authorization=self._auth)
+        if isinstance(body, FileChunks):
+            headers['Content-Length'] = str(len(body))
+        response = self._open(method, url, headers, body, timeout)
+        return response.getcode(), response.msg, _chunks(
+            response.read, response.close, chunk_size)
+
+
+class Urllib3Transport(Transport):
+    """urllib3 transport, one connection pool shared by all threads"""
+    name = 'urllib3'
+
+    def __init__(self, url, username, password, proxy=None, verify=True):
+        import urllib3
+        self._urllib3 = urllib3
+        kwargs = {}
+        if verify is False:
+            kwargs['cert_reqs'] = 'CERT_NONE'
+            urllib3.disable_warnings(
+                urllib3.exceptions.InsecureRequestWarning)
+        if proxy is not None:
+            self._pool = urllib3.ProxyManager(proxy, **kwargs)
+        else:
+            self._pool = urllib3.PoolManager(**kwargs)
+        self._auth = _basic_auth(username, password)
+
+    def _timeout(self, timeout):
+        if timeout is None:
+            return self._urllib3.Timeout.DEFAULT_TIMEOUT
+        return self._urllib3.Timeout(connect=timeout[0], read=timeout[1])
+
+    def send(self, method, url, headers, body=None, timeout=None):
+        headers = dict(headers, Authorization=self._auth)
+        try:
+            response = self._pool.request(method, url, body=body or None,
+                                          headers=headers, retries=False,
+                                          timeout=self._timeout(timeout))
+        except self._urllib3.exceptions.HTTPError as e:
+            raise TransportError(None, str(e))
+        if response.status >= 400:
+            raise TransportError(response.status, response.reason,
+                                 response.data)
+        return response.status, response.reason, response.data
+
+    def stream(self, method, url, headers, body=None, chunk_size=65536,
+               timeout=None):
+        headers = dict(headers, Authorization=self._auth)
+        if isinstance(body, FileChunks):
+            headers['Content-Length'] = str(len(body))
+        try:
+            response = self._pool.request(method, url, body=body or None,
+                                          headers=headers, retries=False,
+                                          timeout=self._timeout(timeout),
+                                          preload_content=False)
+        except self._urllib3.exceptions.HTTPError as e:
+            raise TransportError(None, str(e))
+        if response.status >= 400:
+            content = response.read()
+            response.release_conn()
+            raise TransportError(response.status, response.reason, content)
+        return response.status, response.reason, _chunks(
+            response.read, response.release_conn, chunk_size)
+
+    def close(self):
+        self._pool.clear()
+
+
+class RequestsTransport(Transport):
+    """requests transport, one session per thread"""
+    name = 'requests'
+
+    def __init__(self, url, username, password, proxy=None, verify=True):
+        import requests
+        self._requests = requests
+        self._auth = (username, password)
+        self._proxies = None
+        if proxy is not None:
+            self._proxies = {'http': proxy, 'https': proxy}
+        self._verify = verify
+        self._local = threading.local()
+        self._sessions = []
+        self._lock = threading.Lock()
+
+    @property
+    def _session(self):
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = self._local.session = self._requests.Session()
+            session.auth = self._auth
+            session.verify = self._verify
+            if self._proxies is not None:
+                session.proxies.update(self._proxies)
+            with self._lock:
+                self._sessions.append(session)
+        return session
+
+    def send(self, method, url, headers, body=None, timeout=None):
+        try:
+            response = self._session.request(method, url, data=body or None,
+                                             headers=headers,
+                                             timeout=timeout)
+        except self._requests.RequestException as e:
+            raise TransportError(None, str(e))
+        if response.status_code >= 400:
+            raise TransportError(response.status_code, response.reason,
+                                 response.content)
+        return response.status_code, response.reason, response.content
+
+    def stream(self, method, url, headers, body=None, chunk_size=65536,
+               timeout=None):
+        try:
+            response = self._session.request(method, url, data=body or None,
+                                             headers=headers, stream=True,
+                                             timeout=timeout)
+        except self._requests.RequestException as e:
+            raise TransportError(None, str(e))
+        if response.status_code >= 400:
+            content = response.content
+            response.close()
+            raise TransportError(response.status_code, response.reason,
+                                 content)
+        return response.status_code, response.reason, _chunks(
+            response.raw.read, response.close, chunk_size)
+
+    def close(self):
+        with self._lock:
+            for session in self._sessions:
+                session.close()
+            self._sessions = []
+
+
+class HttpxTransport(Transport):
+    """httpx transport, one client shared by all threads"""
+    name = 'httpx'
+
+    def __init__(self, url, username, password, proxy=None, verify=True):
+        import httpx
+        self._httpx = httpx
+        kwargs = {'auth': (username, password), 'verify': verify}
+        if proxy is not None:
+            kwargs['proxy'] = proxy
+        try:
+            self._client = httpx.Client(**kwargs)
+        except TypeError:
+            # httpx < 0.26 names it proxies
+            kwargs['proxies'] = kwargs.pop('proxy')
+            self._client = httpx.Client(**kwargs)
+
+    def _timeout(self, timeout):
+        if timeout is None:
+            return self._client.timeout
+        return self._httpx.Timeout(timeout[1], connect=timeout[0])
+
+    def send(self, method, url, headers, body=None, timeout=None):
+        try:
+            response = self._client.request(method, url, content=body or None,
+                                            headers=headers,
+                                            timeout=self._timeout(timeout))
+        except self._httpx.HTTPError as e:
+            raise TransportError(None, str(e))
+        if response.status_code >= 400:
+            raise TransportError(response.status_code, response.reason_phrase,
+                                 response.content)
+        return (response.status_code, response.reason_phrase,
+                response.content)
+
+    def stream(self, method, url, headers, body=None, chunk_size=65536,
+               timeout=None):
+        if isinstance(body, FileChunks):
+            headers = dict(headers, **{'Content-Length': str(len(body))})
+        request = self._client.build_request(method, url, content=body,
+                                             headers=headers,
+                                             timeout=self._timeout(timeout))
+        try:
+            response = self._client.send(request, stream=True)
+        except self._httpx.HTTPError as e:
+            raise TransportError(None, str(e))
+        if response.status_code >= 400:
+            content = response.read()
+            response.close()
+            raise TransportError(response.status_code, response.reason_phrase,
+                                 content)
+
+        def chunks():
+            try:
+                for chunk in response.iter_bytes(chunk_size):
+                    yield chunk
+            finally:
+                response.close()
+        return response.status_code, response.reason_phrase, chunks()
+
+    def close(self):
+        self._client.close()
+
+
+class FakeTransport(Transport):
+    """In-process transport answering from a handler
+
+    `handler` provides handle(method, url, body) returning (status,
+    payload) like benchmarks.fake_server.FakeInstance; bodies are passed
+    and returned decoded. No socket is opened, so the client can be
+    profiled without network noise.
+    """
+    name = 'fake'
+
+    def __init__(self, handler):
+        self.handler = handler
+
+    def send(self, method, url, headers, body=None, timeout=None):
+        if body:
+            if isinstance(body, bytes):
+                body = body.decode('utf-8')
+            body = json.loads(body)
+        status, payload = self.handler.handle(method, url, body or None)
+        data = json.dumps(payload).encode('utf-8') \
+            if payload is not None else b''
+        if status >= 400:
+            raise TransportError(status, 'Error', data)
+        return status, 'OK', data
+
+
+TRANSPORTS = {
+    'urllib3': Urllib3Transport,
+    'requests': RequestsTransport,
+    'httpx': HttpxTransport,
+    'urllib': UrllibTransport,
+}
+
+
+def get_transport(transport, url, username, password, proxy=None,
+                  verify=True):
+    """Returns a transport instance
+
+    `transport` is None for urllib, 'auto' for the fastest available
+    library (urllib3, requests, httpx, then urllib), one of 'urllib',
+    'urllib3', 'requests', 'httpx', or an object providing send().
+    """
+    args = (url, username, password, proxy, verify)
+    if transport is None:
+        return UrllibTransport(*args)
+    if transport == 'auto':
+        for name in ('urllib3', 'requests', 'httpx'):
+            try:
+                return TRANSPORTS[name](*args)
+            except ImportError:
+                continue
+        return UrllibTransport(*args)
+    if hasattr(transport, 'send'):
+        return transport
+    if transport not in TRANSPORTS:
+        raise ValueError('unknown transport {0}'.format(transport))
+    return TRANSPORTS[transport](*args)
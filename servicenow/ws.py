@@ -4,6 +4,9 @@
 
 import servicenow
 
+from concurrent.futures import ThreadPoolExecutor
+from servicenow.concurrency import bounded_map
+
 try:
     from urllib.parse import quote
 except ImportError:
@@ -22,6 +25,7 @@ class ServiceNow(servicenow.ServiceNow):
         """
 
         url = path + '.do?JSONv2'
+        self._compile_query(kwargs)
         if 'display_value' in kwargs:
             url += '&displayvalue={display_value}'.format(**kwargs)
             del kwargs['display_value']
@@ -39,6 +43,13 @@ class ServiceNow(servicenow.ServiceNow):
             url += "&{0}".format("&".join(opts))
         return "{0}/{1}".format(self.url, url)
 
+    def _table_from_url(self, url):
+        """Returns the table a JSONv2 URL reads or writes"""
+        path = url.split('?')[0]
+        if not path.endswith('.do'):
+            return None
+        return path.split('/')[-1][:-3]
+
     def get(self, path, **kwargs):
         if len(path.split('/')) > 1:
             kwargs['sys_id'] = path.split('/')[-1]
@@ -73,6 +84,46 @@ class ServiceNow(servicenow.ServiceNow):
                                             sys_id=sys_id),
                           status_codes=(200, 202, 204))
 
+    def update_where(self, path, query, params, **kwargs):
+        """Update every record matching the query in a single request
+
+        Returns the number of updated records.
+        """
+        if not query:
+            raise ValueError('no query specified on {0}'.format(path))
+        res = self.put(path, params, query=query, **kwargs)
+        return len(res) if isinstance(res, list) else 0
+
+    def get_keys(self, path, query=None):
+        """Returns the sys_ids of the records matching the query"""
+        keys = self.get(path, action='getKeys', query=query)
+        return [k for item in keys for k in item.split(',') if k != '']
+
+    def bulk_get(self, path, query=None, chunk_size=100, workers=4,
+                 **kwargs):
+        """Streams the records matching the query
+
+        The sys_ids are listed first with getKeys, then fetched with
+        getRecords by chunks of `chunk_size` from `workers` threads, so
+        large extractions stay below the JSONv2 row limit and request
+        time. Other keywords are passed to getRecords.
+        """
+        keys = self.get_keys(path, query)
+        chunks = [keys[i:i + chunk_size]
+                  for i in range(0, len(keys), chunk_size)]
+
+        def fetch(chunk):
+            return self.get(path, action='getRecords',
+                            query='sys_idIN{0}'.format(','.join(chunk)),
+                            **kwargs)
+        executor = ThreadPoolExecutor(max_workers=workers)
+        try:
+            for records in bounded_map(fetch, chunks, executor, 2 * workers):
+                for record in records:
+                    yield record
+        finally:
+            executor.shutdown(wait=False)
+
     update = put
     insert = post
 
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import unittest
+import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import servicenow  # noqa
+import servicenow.breaker  # noqa
+import servicenow.transport  # noqa
+
+
+class Handler(object):
+    """Answers with the queued statuses, then 200"""
+    def __init__(self, *statuses):
+        self.statuses = list(statuses)
+        self.calls = 0
+
+    def handle(self, method, url, body):
+        self.calls += 1
+        status = self.statuses.pop(0) if self.statuses else 200
+        if status is None:
+            raise servicenow.transport.TransportError(None, 'refused')
+        return status, {'result': []}
+
+
+class TestCaseCircuitBreaker(unittest.TestCase):
+    def setUp(self):
+        patcher = mock.patch('servicenow.breaker.time.time')
+        self.time = patcher.start()
+        self.time.return_value = 1000
+        self.addCleanup(patcher.stop)
+
+    def test_opens_after_failures(self):
+        breaker = servicenow.breaker.CircuitBreaker(failures=3,
+                                                    reset_timeout=10)
+        for _ in range(2):
+            self.assertIsNone(breaker.acquire('h'))
+            breaker.failure('h')
+        self.assertEqual(breaker.state('h'), 'closed')
+        breaker.success('h')
+        breaker.failure('h')
+        breaker.failure('h')
+        self.assertEqual(breaker.state('h'), 'closed')
+        breaker.failure('h')
+        self.assertEqual(breaker.state('h'), 'open')
+        self.time.return_value = 1004
+        self.assertEqual(breaker.acquire('h'), 6)
+
+    def test_half_open(self):
+        breaker = servicenow.breaker.CircuitBreaker(failures=1,
+                                                    reset_timeout=10)
+        breaker.failure('h')
+        self.time.return_value = 1010
+        self.assertEqual(breaker.state('h'), 'half-open')
+        self.assertIsNone(breaker.acquire('h'))
+        self.assertEqual(breaker.acquire('h'), 0)
+        breaker.failure('h')
+        self.assertEqual(breaker.state('h'), 'open')
+        self.time.return_value = 1020
+        self.assertIsNone(breaker.acquire('h'))
+        breaker.release('h')
+        self.assertIsNone(breaker.acquire('h'))
+        breaker.success('h')
+        self.assertEqual(breaker.state('h'), 'closed')
+
+    def test_per_table_and_hosts(self):
+        breaker = servicenow.breaker.CircuitBreaker(
+            failures=2, per_table=True, hosts={'dev': {'failures': 1}})
+        breaker.failure('prod', 'incident')
+        breaker.failure('prod', 'incident')
+        self.assertEqual(breaker.state('prod', 'incident'), 'open')
+        self.assertEqual(breaker.state('prod', 'cmdb_ci'), 'closed')
+        breaker.failure('dev', 'incident')
+        self.assertEqual(breaker.state('dev', 'incident'), 'open')
+        breaker.reset()
+        self.assertEqual(breaker.state('prod', 'incident'), 'closed')
+
+
+class TestCaseServiceNowBreaker(unittest.TestCase):
+    def snow(self, handler, **kwargs):
+        self.breaker = servicenow.breaker.CircuitBreaker(**kwargs)
+        return servicenow.ServiceNow(
+            'https://test.service-now.com', 'user', 'pass',
+            transport=servicenow.transport.FakeTransport(handler),
+            breaker=self.breaker)
+
+    def test_short_circuit(self):
+        handler = Handler(None, 503)
+        snow = self.snow(handler, failures=2, reset_timeout=60)
+        for _ in range(2):
+            self.assertRaises(servicenow.ServiceNowHttpError,
+                              snow.get, 'incident')
+        with self.assertRaises(servicenow.ServiceNowCircuitOpen) as ctx:
+            snow.get('incident')
+        self.assertGreater(ctx.exception.retry_after, 59)
+        self.assertEqual(handler.calls, 2)
+        self.assertEqual(self.breaker.state('test.service-now.com'), 'open')
+
+    def test_client_errors_not_counted(self):
+        handler = Handler(404, 404, 404)
+        snow = self.snow(handler, failures=2)
+        for _ in range(3):
+            self.assertRaises(servicenow.ServiceNowHttpError,
+                              snow.get, 'incident')
+        self.assertEqual(self.breaker.state('test.service-now.com'),
+                         'closed')
+
+    def test_probe_recovers(self):
+        handler = Handler(500)
+        snow = self.snow(handler, failures=1, reset_timeout=0)
+        self.assertRaises(servicenow.ServiceNowHttpError,
+                          snow.get, 'incident')
+        self.assertEqual(snow.get('incident'), [])
+        self.assertEqual(self.breaker.state('test.service-now.com'),
+                         'closed')
+
+    def test_per_table(self):
+        handler = Handler(500)
+        snow = self.snow(handler, failures=1, per_table=True)
+        self.assertRaises(servicenow.ServiceNowHttpError,
+                          snow.get, 'incident')
+        self.assertRaises(servicenow.ServiceNowCircuitOpen,
+                          snow.get, 'incident')
+        self.assertEqual(snow.get('cmdb_ci'), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
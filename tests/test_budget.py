@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import unittest
+import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import servicenow  # noqa
+import servicenow.budget  # noqa
+import servicenow.transport  # noqa
+
+
+class Handler(object):
+    def __init__(self):
+        self.calls = 0
+
+    def handle(self, method, url, body):
+        self.calls += 1
+        return 200, {'result': [{'sys_id': '1'}]}
+
+
+class TestCaseBudget(unittest.TestCase):
+    def setUp(self):
+        self.handler = Handler()
+        self.snow = servicenow.ServiceNow(
+            'https://test.service-now.com', 'user', 'pass',
+            transport=servicenow.transport.FakeTransport(self.handler))
+
+    def test_shape(self):
+        self.assertEqual(
+            servicenow.budget._shape(
+                'GET', 'https://h/api/now/table/incident/'
+                       '0123456789abcdef0123456789abcdef?sysparm_limit=1'),
+            'GET /api/now/table/incident/{id}?sysparm_limit')
+        self.assertEqual(servicenow.budget._operation(
+            'POST', 'https://h/api/now/v2/import/u_staging'), 'POST import')
+        self.assertEqual(servicenow.budget._operation(
+            'GET', 'https://h/incident.do?JSONv2'), 'GET legacy')
+
+    def test_count(self):
+        with self.snow.budget() as budget:
+            self.snow.get('incident')
+            self.snow.get('api/now/stats/incident')
+            self.snow.post('incident', {'short_description': 'x'})
+        self.snow.get('incident')
+        self.assertEqual(budget.requests, 3)
+        self.assertEqual(budget.operations, {'GET table': 1, 'GET stats': 1,
+                                             'POST table': 1})
+        self.assertEqual(len(budget.sites), 3)
+        self.assertTrue(all(__file__.rstrip('c') in site
+                            for site in budget.sites))
+        self.assertIn('3 requests', budget.report())
+
+    def test_exceeded(self):
+        with self.assertRaises(servicenow.ServiceNowBudgetExceeded) as ctx:
+            with self.snow.budget(max_requests=2):
+                for i in range(5):
+                    self.snow.get('incident')
+        self.assertEqual(self.handler.calls, 2)
+        self.assertEqual(ctx.exception.budget.requests, 3)
+        self.assertEqual(self.snow._budgets, [])
+
+    def test_limits_warn(self):
+        with self.snow.budget(limits={'POST table': 1},
+                              action='warn') as budget:
+            with mock.patch.object(budget._logger, 'warning') as warning:
+                for i in range(3):
+                    self.snow.post('incident', {})
+                self.snow.get('incident')
+        self.assertEqual(self.handler.calls, 4)
+        self.assertEqual(warning.call_count, 1)
+        self.assertIn('POST table budget of 1', warning.call_args[0][1])
+        self.assertEqual(budget.requests, 4)
+
+    def test_n_plus_one(self):
+        with self.snow.budget(n_plus_one=5) as budget:
+            for i in range(6):
+                self.snow.get('incident/{0:032x}'.format(i))
+            self.snow.get('incident', limit=10)
+        self.assertEqual(len(budget.suspects), 1)
+        site, shape, count = budget.suspects[0]
+        self.assertEqual(shape, 'GET /api/now/table/incident/{id}?')
+        self.assertEqual(count, 6)
+        self.assertIn('N+1: 6 x', budget.report())
+
+
+if __name__ == '__main__':
+    unittest.main()
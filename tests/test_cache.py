@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import servicenow.cache  # noqa
+import servicenow.codec  # noqa
+
+
+class TestCaseServicenowPageCache(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.codec = servicenow.codec.get_codec()
+
+    def test_store_load(self):
+        cache = servicenow.cache.PageCache(self.directory)
+        self.assertIsNone(cache.load('http://h/a', self.codec))
+        cache.store('http://h/a', [[{'name': 'toto'}], 30], self.codec)
+        self.assertEqual(cache.load('http://h/a', self.codec),
+                         [[{'name': 'toto'}], 30])
+        self.assertIsNone(cache.load('http://h/b', self.codec))
+
+    def test_stdlib_codec(self):
+        cache = servicenow.cache.PageCache(self.directory)
+        codec = servicenow.codec.get_codec('json')
+        cache.store('http://h/a', [{'name': 'toto'}], codec)
+        self.assertEqual(cache.load('http://h/a', codec), [{'name': 'toto'}])
+
+    def test_ttl(self):
+        cache = servicenow.cache.PageCache(self.directory, ttl=60)
+        cache.store('http://h/a', [], self.codec)
+        path = cache._path('http://h/a')
+        os.utime(path, (time.time(), time.time() - 120))
+        self.assertIsNone(cache.load('http://h/a', self.codec))
+        self.assertFalse(os.path.exists(path))
+
+    def test_eviction(self):
+        cache = servicenow.cache.PageCache(self.directory, max_bytes=100)
+        for i in range(10):
+            cache.store('http://h/{0}'.format(i), 'x' * 20, self.codec)
+            os.utime(cache._path('http://h/{0}'.format(i)),
+                     (time.time() - 100 + i, time.time()))
+        self.assertLessEqual(cache._size, 100)
+        self.assertEqual(cache.load('http://h/9', self.codec), 'x' * 20)
+        self.assertIsNone(cache.load('http://h/0', self.codec))
+
+    def test_evicted_during_load(self):
+        cache = servicenow.cache.PageCache(self.directory)
+        cache.store('http://h/a', [], self.codec)
+        path = cache._path('http://h/a')
+        st = os.stat(path)
+        os.remove(path)
+        with mock.patch('servicenow.cache.os.stat', return_value=st):
+            self.assertIsNone(cache.load('http://h/a', self.codec))
+
+    def test_clear(self):
+        cache = servicenow.cache.PageCache(self.directory)
+        cache.store('http://h/a', [], self.codec)
+        cache.clear()
+        self.assertEqual(cache._size, 0)
+        self.assertIsNone(cache.load('http://h/a', self.codec))
+
+
+class TestCaseServicenowResponseCache(unittest.TestCase):
+    def test_get_put(self):
+        cache = servicenow.cache.ResponseCache()
+        self.assertIsNone(cache.get('http://h/a'))
+        cache.put('incident', 'http://h/a', b'[]')
+        self.assertEqual(cache.get('http://h/a'), b'[]')
+
+    def test_table_ttl(self):
+        cache = servicenow.cache.ResponseCache(
+            ttl=60, table_ttls={'incident': 0, 'sys_user': -1})
+        cache.put('incident', 'http://h/a', b'[]')
+        cache.put('sys_user', 'http://h/b', b'[]')
+        cache.put('sc_task', 'http://h/c', b'[]')
+        self.assertIsNone(cache.get('http://h/a'))
+        self.assertIsNone(cache.get('http://h/b'))
+        self.assertEqual(cache.get('http://h/c'), b'[]')
+
+    def test_expired(self):
+        cache = servicenow.cache.ResponseCache(ttl=60)
+        cache.put('incident', 'http://h/a', b'[]')
+        with mock.patch('time.time', return_value=time.time() + 120):
+            self.assertIsNone(cache.get('http://h/a'))
+
+    def test_invalidate(self):
+        cache = servicenow.cache.ResponseCache()
+        cache.put('incident', 'http://h/a', b'[]')
+        cache.put('sc_task', 'http://h/b', b'[]')
+        cache.invalidate('incident')
+        self.assertIsNone(cache.get('http://h/a'))
+        self.assertEqual(cache.get('http://h/b'), b'[]')
+        cache.invalidate()
+        self.assertIsNone(cache.get('http://h/b'))
+
+    def test_stale_generation(self):
+        cache = servicenow.cache.ResponseCache()
+        generation = cache.generation('incident')
+        cache.invalidate('incident')
+        cache.put('incident', 'http://h/a', b'[]', generation)
+        self.assertIsNone(cache.get('http://h/a'))
+
+    def test_max_entries(self):
+        cache = servicenow.cache.ResponseCache(max_entries=2)
+        cache.put('incident', 'http://h/a', b'a')
+        cache.put('incident', 'http://h/b', b'b')
+        cache.get('http://h/a')
+        cache.put('incident', 'http://h/c', b'c')
+        self.assertIsNone(cache.get('http://h/b'))
+        self.assertEqual(cache.get('http://h/a'), b'a')
+        self.assertEqual(cache.get('http://h/c'), b'c')
+
+
+if __name__ == '__main__':
+    unittest.main()
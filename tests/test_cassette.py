@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import servicenow  # noqa
+import servicenow.cassette  # noqa
+import servicenow.table  # noqa
+import servicenow.transport  # noqa
+from benchmarks.fake_server import FakeInstance  # noqa
+
+
+class TestCaseCassette(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'incident.jsonl.gz')
+        self.instance = FakeInstance()
+        self.instance.populate('incident', 120)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def client(self, cassette, url='http://fake'):
+        return servicenow.table.ServiceNow(
+            url, 'admin', 'admin', cassette=cassette,
+            transport=servicenow.transport.FakeTransport(self.instance))
+
+    def record(self):
+        with servicenow.cassette.Cassette(self.path, 'record') as cassette:
+            snow = self.client(cassette)
+            rows = list(snow.Table('incident').filter(
+                fields='number', limit=120))
+            snow.post('incident', {'short_description': 'recorded'})
+            self.assertRaises(servicenow.ServiceNowHttpError, snow.get,
+                              'incident/unknown')
+        return rows
+
+    def test_key(self):
+        self.assertEqual(
+            servicenow.cassette._key(
+                'GET', 'https://a.service-now.com/api/now/table/incident'
+                       '?sysparm_limit=10&sysparm_fields=number'),
+            'GET /api/now/table/incident'
+            '?sysparm_fields=number&sysparm_limit=10')
+
+    def test_replay(self):
+        rows = self.record()
+        requests = self.instance.requests
+        cassette = servicenow.cassette.Cassette(self.path)
+        snow = self.client(cassette, 'https://other.service-now.com')
+        replayed = list(snow.Table('incident').filter(fields='number',
+                                                      limit=120))
+        self.assertEqual([r['number'] for r in replayed],
+                         [r['number'] for r in rows])
+        self.assertEqual(snow.post('incident', {})['short_description'],
+                         'recorded')
+        with self.assertRaises(servicenow.ServiceNowHttpError) as ctx:
+            snow.get('incident/unknown')
+        self.assertEqual(ctx.exception.code, 404)
+        self.assertRaises(servicenow.cassette.CassetteMiss, snow.get,
+                          'problem')
+        self.assertEqual(self.instance.requests, requests)
+
+    def test_replay_order(self):
+        with servicenow.cassette.Cassette(self.path, 'record') as cassette:
+            snow = self.client(cassette)
+            counts = []
+            for _ in range(2):
+                counts.append(len(snow.get('incident')))
+                snow.post('incident', {})
+        snow = self.client(servicenow.cassette.Cassette(self.path))
+        self.assertEqual([len(snow.get('incident')) for _ in range(3)],
+                         counts + counts[-1:])
+
+    def test_latency(self):
+        self.record()
+        cassette = servicenow.cassette.Cassette(self.path, latency=2)
+        snow = self.client(cassette)
+        with mock.patch('servicenow.cassette.time.sleep') as sleep:
+            snow.post('incident', {})
+        self.assertEqual(sleep.call_count, 1)
+        self.assertGreaterEqual(sleep.call_args[0][0], 0)
+
+    def test_mode(self):
+        self.assertRaises(ValueError, servicenow.cassette.Cassette,
+                          self.path, 'rewind')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import servicenow  # noqa
+import servicenow.cluster  # noqa
+import servicenow.table  # noqa
+import servicenow.transport  # noqa
+from benchmarks.fake_server import FakeInstance  # noqa
+
+
+class Down(object):
+    def handle(self, method, url, body):
+        raise servicenow.transport.TransportError(None, 'refused')
+
+
+class TestCaseServiceNowCluster(unittest.TestCase):
+    def client(self, url, handler):
+        return servicenow.table.ServiceNow(
+            url, 'admin', 'admin',
+            transport=servicenow.transport.FakeTransport(handler))
+
+    def setUp(self):
+        self.instances = []
+        for rows in (30, 50, 70):
+            instance = FakeInstance(latency=0.2)
+            instance.populate('incident', rows)
+            self.instances.append(instance)
+        self.cluster = servicenow.cluster.ServiceNowCluster(
+            [self.client('https://i{0}.service-now.com'.format(i), instance)
+             for i, instance in enumerate(self.instances)])
+
+    def test_names(self):
+        self.assertEqual(list(self.cluster.instances),
+                         ['i0.service-now.com', 'i1.service-now.com',
+                          'i2.service-now.com'])
+        cluster = servicenow.cluster.ServiceNowCluster(
+            {'dev': self.cluster.instances['i0.service-now.com']})
+        self.assertEqual(list(cluster.count('incident')), ['dev'])
+
+    def test_concurrent(self):
+        start = time.time()
+        results = self.cluster.get('incident', limit=5)
+        self.assertLess(time.time() - start, 0.5)
+        self.assertEqual([len(r) for r in results.values()], [5, 5, 5])
+        self.assertEqual(len(results.merged()), 15)
+        self.assertEqual(results.errors, {})
+        self.assertEqual(len(results.seconds), 3)
+
+    def test_count(self):
+        results = self.cluster.count('incident')
+        self.assertEqual(list(results.values()), [30, 50, 70])
+
+    def test_errors_isolated(self):
+        self.cluster.instances['down'] = self.client('https://down', Down())
+        self.cluster.workers = 4
+        results = self.cluster.count('incident')
+        self.assertEqual(len(results), 3)
+        self.assertIsInstance(results.errors['down'],
+                              servicenow.ServiceNowHttpError)
+        rows = self.cluster.filter('incident', fields='number')
+        counts = {}
+        for name, row in rows:
+            counts[name] = counts.get(name, 0) + 1
+        self.assertEqual(counts, {'i0.service-now.com': 30,
+                                  'i1.service-now.com': 50,
+                                  'i2.service-now.com': 70})
+        self.assertEqual(list(rows.errors), ['down'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import unittest
+import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import servicenow  # noqa
+import servicenow.codec  # noqa
+import servicenow.table  # noqa
+
+
+class TestCaseServicenowCodec(unittest.TestCase):
+    def setUp(self):
+        if sys.version_info >= (3, 0):
+            self.urllib_name = "urllib.request"
+        else:
+            self.urllib_name = "urllib2"
+
+    def test_json_roundtrip(self):
+        codec = servicenow.codec.get_codec('json')
+        data = codec.dumps({"name": u"toté"})
+        self.assertIsInstance(data, bytes)
+        self.assertEqual(codec.loads(data), {"name": u"toté"})
+
+    def test_loads_text(self):
+        codec = servicenow.codec.get_codec('json')
+        self.assertEqual(codec.loads('[1, 2]'), [1, 2])
+
+    def test_loads_invalid_utf8(self):
+        codec = servicenow.codec.get_codec()
+        self.assertEqual(codec.loads(b'{"name": "a\xffb"}'), {"name": "ab"})
+
+    def test_dumps_str_subclass(self):
+        field = servicenow.table.TableRowField(value=u"toté")
+        for name in servicenow.codec.CODECS:
+            try:
+                codec = servicenow.codec.get_codec(name)
+            except ImportError:
+                continue
+            self.assertEqual(codec.loads(codec.dumps({"name": field})),
+                             {"name": u"toté"}, name)
+
+    def test_enc_hook(self):
+        value = servicenow.codec._enc_hook(
+            servicenow.table.TableRowField(value="x"))
+        self.assertIs(type(value), str)
+        self.assertEqual(value, "x")
+        with self.assertRaises(NotImplementedError):
+            servicenow.codec._enc_hook(object())
+
+    def test_auto_falls_back_to_stdlib(self):
+        with mock.patch.dict(servicenow.codec.CODECS, {
+                'orjson': mock.Mock(side_effect=ImportError),
+                'msgspec': mock.Mock(side_effect=ImportError),
+                'ujson': mock.Mock(side_effect=ImportError)}):
+            codec = servicenow.codec.get_codec('auto')
+        self.assertEqual(codec.name, 'json')
+
+    def test_custom_codec(self):
+        custom = mock.Mock()
+        self.assertIs(servicenow.codec.get_codec(custom), custom)
+
+    def test_unknown_codec(self):
+        with self.assertRaises(ValueError):
+            servicenow.codec.get_codec('yaml')
+
+    def test_body_serialized_once(self):
+        codec = mock.Mock()
+        codec.dumps.return_value = b'{"status": "start"}'
+        codec.loads.return_value = {"result": {"message": "success"}}
+        m = mock.Mock()
+        m.return_value.getcode.return_value = 200
+        m.return_value.read.return_value = b'{"result":{"message":"success"}}'
+        with mock.patch(
+                self.urllib_name + ".OpenerDirector.open", m, create=True):
+            snow = servicenow.ServiceNow(
+                "http://host:port/path", "user", "pass", codec=codec)
+            self.assertEqual(snow.put(
+                "api/now/table/sc_task/1", {"status": "start"}
+            ), {"message": "success"})
+        codec.dumps.assert_called_once_with({"status": "start"})
+        codec.loads.assert_called_once_with(
+            b'{"result":{"message":"success"}}')
+        self.assertEqual(m.call_args[0][0].data, b'{"status": "start"}')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,238 @@
+#!/usr/bin/env python
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import threading
+import time
+import unittest
+import mock
+
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import servicenow.concurrency  # noqa
+import servicenow.table  # noqa
+import servicenow.transport  # noqa
+from benchmarks.fake_server import FakeInstance, FakeServer  # noqa
+
+
+def run_threads(count, target):
+    results = [None] * count
+    errors = []
+
+    def run(index):
+        try:
+            results[index] = target()
+        except Exception as e:
+            errors.append(e)
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results, errors
+
+
+def slow_response(body, delay=0.1):
+    def fake_open(request):
+        time.sleep(delay)
+        mock_req = mock.Mock()
+        mock_req.getcode.return_value = 200
+        mock_req.read.return_value = body(request) if callable(body) else body
+        return mock_req
+    return fake_open
+
+
+class TestCaseSingleFlight(unittest.TestCase):
+    def test_shared_result(self):
+        flight = servicenow.concurrency.SingleFlight()
+        calls = []
+
+        def func():
+            calls.append(1)
+            time.sleep(0.1)
+            return 'toto'
+        results, errors = run_threads(
+            10, lambda: flight.do('key', func))
+        self.assertEqual(results, ['toto'] * 10)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(flight.do('key', func), 'toto')
+        self.assertEqual(len(calls), 2)
+
+    def test_shared_error(self):
+        flight = servicenow.concurrency.SingleFlight()
+
+        def func():
+            time.sleep(0.1)
+            raise KeyError('name')
+        results, errors = run_threads(5, lambda: flight.do('key', func))
+        self.assertEqual(len(errors), 5)
+        self.assertTrue(all(isinstance(e, KeyError) for e in errors))
+
+    def test_follower_deadline(self):
+        flight = servicenow.concurrency.SingleFlight(expired=KeyError)
+        started = threading.Event()
+
+        def func():
+            started.set()
+            time.sleep(0.5)
+            return 'toto'
+        thread = threading.Thread(target=lambda: flight.do('key', func))
+        thread.start()
+        started.wait(2)
+        start = time.time()
+        with servicenow.concurrency.deadline(0.05):
+            self.assertRaises(KeyError, flight.do, 'key', func)
+        self.assertLess(time.time() - start, 0.3)
+        thread.join()
+
+
+class TestCaseDeadline(unittest.TestCase):
+    def test_nested(self):
+        self.assertIsNone(servicenow.concurrency.remaining())
+        with servicenow.concurrency.deadline(10):
+            self.assertLessEqual(servicenow.concurrency.remaining(), 10)
+            with servicenow.concurrency.deadline(60):
+                self.assertLessEqual(servicenow.concurrency.remaining(), 10)
+            with servicenow.concurrency.deadline(1):
+                self.assertLessEqual(servicenow.concurrency.remaining(), 1)
+            with servicenow.concurrency.deadline(None):
+                self.assertLessEqual(servicenow.concurrency.remaining(), 10)
+        self.assertIsNone(servicenow.concurrency.remaining())
+
+    def test_bounded_map(self):
+        executor = ThreadPoolExecutor(max_workers=2)
+        self.addCleanup(executor.shutdown)
+        with servicenow.concurrency.deadline(10):
+            left = list(servicenow.concurrency.bounded_map(
+                lambda _: servicenow.concurrency.remaining(), range(4),
+                executor, 2))
+        self.assertTrue(all(0 < x <= 10 for x in left))
+        self.assertEqual(list(servicenow.concurrency.bounded_map(
+            lambda _: servicenow.concurrency.remaining(), range(4),
+            executor, 2)), [None] * 4)
+
+
+class TestCaseServicenowConcurrency(unittest.TestCase):
+    def setUp(self):
+        if sys.version_info >= (3, 0):
+            self.urllib_name = "urllib.request"
+        else:
+            self.urllib_name = "urllib2"
+
+    def test_coalesced_get(self):
+        m = mock.Mock(side_effect=slow_response('{"result":[{"id": 1}]}'))
+        with mock.patch(
+                self.urllib_name + ".OpenerDirector.open", m, create=True):
+            snow = servicenow.table.ServiceNow("http://h:1", "user", "pass")
+            results, errors = run_threads(
+                20, lambda: snow.get('incident', limit=1))
+        self.assertEqual(errors, [])
+        self.assertEqual(results, [[{"id": 1}]] * 20)
+        self.assertIsNot(results[0], results[1])
+        self.assertEqual(m.call_count, 1)
+
+    def test_get_after_write_not_coalesced(self):
+        started = threading.Event()
+        release = threading.Event()
+        record = {'sys_id': '1', 'state': 'New'}
+
+        class Handler(object):
+            def handle(self, method, url, body):
+                if method == 'PUT':
+                    record.update(body)
+                    return 200, {'result': dict(record)}
+                result = dict(record)
+                if not started.is_set():
+                    started.set()
+                    release.wait(2)
+                return 200, {'result': result}
+
+        snow = servicenow.table.ServiceNow(
+            "http://h:1", "user", "pass",
+            transport=servicenow.transport.FakeTransport(Handler()))
+        before = []
+        thread = threading.Thread(
+            target=lambda: before.append(snow.get('incident/1')))
+        thread.start()
+        started.wait(2)
+        snow.put('incident/1', {'state': 'Closed'})
+        after = snow.get('incident/1')
+        release.set()
+        thread.join()
+        self.assertEqual(before[0]['state'], 'New')
+        self.assertEqual(after['state'], 'Closed')
+
+    def test_coalesced_get_deadline(self):
+        started = threading.Event()
+
+        class Handler(object):
+            def handle(self, method, url, body):
+                started.set()
+                time.sleep(0.5)
+                return 200, {'result': []}
+
+        snow = servicenow.table.ServiceNow(
+            "http://h:1", "user", "pass",
+            transport=servicenow.transport.FakeTransport(Handler()))
+        thread = threading.Thread(target=lambda: snow.get('incident'))
+        thread.start()
+        started.wait(2)
+        start = time.time()
+        with snow.deadline(0.05):
+            with self.assertRaises(
+                    servicenow.ServiceNowDeadlineExceeded) as ctx:
+                snow.get('incident')
+        self.assertLess(time.time() - start, 0.3)
+        self.assertIn('/api/now/table/incident', ctx.exception.url)
+        thread.join()
+
+    def test_coalesced_sysid_to_value(self):
+        def body(request):
+            if 'sys_dictionary' in request.get_full_url():
+                return '[{"element": "name"}]'
+            return '{"result":{"name": "toto"}}'
+        m = mock.Mock(side_effect=slow_response(body))
+        with mock.patch(
+                self.urllib_name + ".OpenerDirector.open", m, create=True):
+            snow = servicenow.table.ServiceNow("http://h:1", "user", "pass")
+            results, errors = run_threads(
+                20, lambda: snow.sysid_to_value('sys_user', '123'))
+        self.assertEqual(errors, [])
+        self.assertEqual(results, ['toto'] * 20)
+        self.assertEqual(m.call_count, 2)
+
+
+class TestCaseServicenowStress(unittest.TestCase):
+    def test_shared_client(self):
+        instance = FakeInstance()
+        rows = instance.populate('incident', 300)
+        instance.tables['sys_choice'].append({'value': '1'})
+        with FakeServer(instance) as server:
+            snow = servicenow.table.ServiceNow(server.url, 'user', 'pass')
+
+            def work():
+                seen = []
+                for row in rows[::7]:
+                    self.assertEqual(
+                        snow.sysid_to_value('incident', row['sys_id']),
+                        row['number'])
+                    self.assertEqual(
+                        snow.value_to_sysid('incident', row['number']),
+                        row['sys_id'])
+                self.assertIs(snow._admin, True)
+                for row in snow.Table('incident').filter(fields='number'):
+                    seen.append(row['number'].value)
+                return seen
+            results, errors = run_threads(16, work)
+        self.assertEqual(errors, [])
+        expected = [row['number'] for row in rows]
+        for seen in results:
+            self.assertEqual(seen, expected)
+        self.assertEqual(len(snow._cache), 2 * len(rows[::7]))
+
+
+if __name__ == '__main__':
+    unittest.main()
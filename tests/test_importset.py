@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import unittest
+import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import servicenow.importset  # noqa
+import servicenow.table  # noqa
+import servicenow.transport  # noqa
+from benchmarks.fake_server import FakeInstance  # noqa
+
+
+class TestCaseServicenowImportSet(unittest.TestCase):
+    def setUp(self):
+        self.instance = FakeInstance()
+        self.snow = servicenow.table.ServiceNow(
+            "http://h:1", "user", "pass",
+            transport=servicenow.transport.FakeTransport(self.instance))
+
+    def test_load(self):
+        self.instance.transform_maps['u_imp_computer'] = (
+            'cmdb_ci_computer', 'serial_number')
+        self.instance.tables['cmdb_ci_computer'] = [
+            {'sys_id': 'c1', 'serial_number': 'SN3', 'name': 'old'}]
+        rows = [{'serial_number': 'SN{0}'.format(i), 'name': 'pc{0}'.format(i)}
+                for i in range(25)]
+        importset = servicenow.importset.ImportSet(
+            self.snow, 'u_imp_computer', chunk_size=10, workers=3)
+        results = list(importset.load(iter(rows)))
+        self.assertEqual(len(results), 25)
+        self.assertEqual(results[3]['status'], 'updated')
+        self.assertEqual(results[3]['sys_id'], 'c1')
+        self.assertEqual(results[4]['table'], 'cmdb_ci_computer')
+        computers = dict((r['sys_id'], r['name'])
+                         for r in self.instance.tables['cmdb_ci_computer'])
+        self.assertEqual([computers[r['sys_id']] for r in results],
+                         [r['name'] for r in rows])
+        self.assertEqual(importset.stats['rows'], 25)
+        self.assertEqual(importset.stats['chunks'], 3)
+        self.assertEqual(importset.stats['statuses'],
+                         {'inserted': 24, 'updated': 1})
+        self.assertEqual(len(self.instance.tables['u_imp_computer']), 25)
+
+    def test_load_ignored(self):
+        importset = servicenow.importset.ImportSet(self.snow, 'u_imp_user')
+        results = list(importset.load([{'name': 'toto'}]))
+        self.assertEqual(results[0]['status'], 'ignored')
+        self.assertEqual(results[0]['message'], 'No transform map')
+
+    def test_load_pending(self):
+        m = mock.Mock(side_effect=[
+            {'import_set_id': 'i1'},
+            [{'sys_import_row': '0', 'sys_import_state': 'pending'}],
+            [{'sys_import_row': '1', 'sys_import_state': 'inserted',
+              'sys_target_sys_id': 'b', 'sys_target_table': 'sys_user'},
+             {'sys_import_row': '0', 'sys_import_state': 'inserted',
+              'sys_target_sys_id': 'a', 'sys_target_table': 'sys_user'}],
+        ])
+        with mock.patch("servicenow.ServiceNow._call", m, create=True):
+            importset = servicenow.importset.ImportSet(
+                self.snow, 'u_imp_user', poll_interval=0)
+            results = list(importset.load([{'name': 'a'}, {'name': 'b'}]))
+        self.assertEqual([r['sys_id'] for r in results], ['a', 'b'])
+        self.assertEqual(m.call_count, 3)
+
+    def test_load_timeout(self):
+        m = mock.Mock(side_effect=[{'import_set_id': 'i1'}, []])
+        with mock.patch("servicenow.ServiceNow._call", m, create=True):
+            importset = servicenow.importset.ImportSet(
+                self.snow, 'u_imp_user', timeout=0)
+            results = list(importset.load([{'name': 'a'}]))
+        self.assertEqual(results[0]['status'], 'pending')
+
+    def test_load_error(self):
+        m = mock.Mock(side_effect=servicenow.ServiceNowHttpError(
+            'http://h:1', 403, 'Forbidden'))
+        with mock.patch("servicenow.ServiceNow._call", m, create=True):
+            importset = servicenow.importset.ImportSet(
+                self.snow, 'u_imp_user', chunk_size=2)
+            results = list(importset.load([{'name': 'a'}] * 3))
+        self.assertEqual([r['status'] for r in results], ['error'] * 3)
+        self.assertEqual(importset.stats['statuses'], {'error': 3})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+# -*- coding: utf-8 -*-
+
+import datetime
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import servicenow  # noqa
+import servicenow.table  # noqa
+import servicenow.transport  # noqa
+from servicenow.query import Q  # noqa
+
+
+class Handler(object):
+    def __init__(self):
+        self.urls = []
+
+    def handle(self, method, url, body):
+        self.urls.append(url)
+        return 200, {'result': [{'sys_id': '1', 'state': 'New'}]}
+
+
+class TestCaseQuery(unittest.TestCase):
+    def test_compile(self):
+        q = (Q('state') == 'New') & Q('priority').in_([1, 2])
+        self.assertEqual(str(q), 'state=New^priorityIN1,2')
+        self.assertEqual(str((Q('a') < 1) | (Q('b') >= 2)), 'a<1^ORb>=2')
+        self.assertEqual(str(Q('a') == None), 'aISEMPTY')  # noqa
+        self.assertEqual(str(Q('a') != None), 'aISNOTEMPTY')  # noqa
+        self.assertEqual(str(Q('a').like('x') & Q('b').not_in(['y', 'z'])),
+                         'aLIKEx^bNOT INy,z')
+        self.assertEqual(str(Q('a').between(1, 5)), 'aBETWEEN1@5')
+        self.assertEqual(str(Q('a') == 'x^y'), 'a=x^^y')
+        self.assertEqual(str(Q('active') == True), 'active=true')  # noqa
+        self.assertEqual(
+            str(Q('opened_at') > datetime.datetime(2020, 1, 2, 3, 4, 5)),
+            'opened_at>2020-01-02 03:04:05')
+
+    def test_order_by(self):
+        q = (Q('state') == 'New').order_by('priority', '-opened_at')
+        self.assertEqual(str(q), 'state=New^ORDERBYpriority'
+                                 '^ORDERBYDESCopened_at')
+        self.assertEqual(str(q & (Q('a') == 1)), 'state=New^a=1'
+                         '^ORDERBYpriority^ORDERBYDESCopened_at')
+
+    def test_nested(self):
+        q = ((Q('a') == 1) & (Q('b') == 2)) | (Q('c') == 3)
+        self.assertEqual(str(q), 'a=1^ORc=3^b=2^ORc=3')
+
+    def test_invert(self):
+        q = ~((Q('a') == 1) & (Q('b') < 2))
+        self.assertEqual(str(q), 'a!=1^ORb>=2')
+        self.assertEqual(str(~Q('a').in_([1, 2])), 'aNOT IN1,2')
+        self.assertRaises(ValueError, lambda: ~Q('a').startswith('x'))
+
+    def test_simplify(self):
+        self.assertEqual(str((Q('a') == 1) | (Q('a') == 2) |
+                             Q('a').in_([3, 1])), 'aIN1,2,3')
+        self.assertEqual(str((Q('a') == 1) & (Q('a') == 1)), 'a=1')
+        self.assertEqual(str(((Q('a') == 1) | (Q('b') == 2)) &
+                             (Q('a') == 1)), 'a=1')
+        self.assertEqual(str(Q('a').in_([1, 2]) & (Q('a') == 2)), 'a=2')
+        self.assertEqual(str((Q('b') != 1) & (Q('c') == 3) & (Q('b') != 2)),
+                         'bNOT IN1,2^c=3')
+        # contradictions are left as written
+        self.assertEqual(str((Q('a') == 1) & (Q('a') == 2)), 'a=1^a=2')
+
+
+class TestCaseQuerySearch(unittest.TestCase):
+    def test_single_request(self):
+        handler = Handler()
+        snow = servicenow.table.ServiceNow(
+            'https://test.service-now.com', 'user', 'pass',
+            transport=servicenow.transport.FakeTransport(handler))
+        rows = list(snow.Table('incident').search(
+            Q('state') == 'New', Q('priority').in_([1, 2])))
+        self.assertEqual(len(rows), 1)
+        self.assertEqual(len(handler.urls), 1)
+        self.assertIn('sysparm_query=state%3DNew%5EpriorityIN1%2C2',
+                      handler.urls[0])
+
+    def test_query_keyword(self):
+        handler = Handler()
+        snow = servicenow.ServiceNow(
+            'https://test.service-now.com', 'user', 'pass',
+            transport=servicenow.transport.FakeTransport(handler))
+        snow.get('incident', query=Q('state').not_in(['New', 'Closed']),
+                 order='number')
+        self.assertIn('sysparm_query=stateNOT%20INNew%2CClosed'
+                      '%5EORDERBYnumber', handler.urls[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -3,7 +3,10 @@
 # -*- coding: utf-8 -*-
 
 import os
+import socket
 import sys
+import threading
+import time
 import unittest
 import mock
 
@@ -19,6 +22,8 @@ else:
 
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 import servicenow  # noqa
+import servicenow.cache  # noqa
+import servicenow.transport  # noqa
 
 
 class TestCaseServicenow(unittest.TestCase):
@@ -435,6 +440,39 @@ class TestCaseServicenow(unittest.TestCase):
             with self.assertRaises(servicenow.ServiceNowHttpError):
                 snow.delete("api/now/table/sc_task/1")
 
+    def test_response_cache(self):
+        m = mock.Mock()
+        m.return_value.getcode.return_value = 200
+        m.return_value.read.return_value = '{"result":[{"id": 123}]}'
+        with mock.patch(
+                self.urllib_name + ".OpenerDirector.open", m, create=True):
+            snow = servicenow.ServiceNow(
+                "http://host:port/path", "user", "pass",
+                response_cache=servicenow.cache.ResponseCache())
+            for i in range(3):
+                self.assertEqual(snow.get("sc_task", limit=1), [{"id": 123}])
+            self.assertEqual(m.call_count, 1)
+            snow.get("sc_task", limit=2)
+            snow.get("api/now/stats/sc_task", count='true')
+            self.assertEqual(m.call_count, 3)
+            snow.put("sc_task/1", {"status": "start"})
+            snow.get("sc_task", limit=1)
+            snow.get("api/now/stats/sc_task", count='true')
+            self.assertEqual(m.call_count, 6)
+
+    def test_response_cache_error_not_stored(self):
+        m = mock.Mock()
+        m.return_value.getcode.return_value = 201
+        m.return_value.msg = 'Created'
+        with mock.patch(
+                self.urllib_name + ".OpenerDirector.open", m, create=True):
+            snow = servicenow.ServiceNow(
+                "http://host:port/path", "user", "pass",
+                response_cache=servicenow.cache.ResponseCache())
+            snow.get("sc_task")
+            snow.get("sc_task")
+            self.assertEqual(m.call_count, 2)
+
     def test_display_field(self):
         def fake_open(request):
             mock_req = mock.Mock()
@@ -566,6 +604,97 @@ class TestCaseServicenow(unittest.TestCase):
                 snow.value_to_sysid("table", "value")
 
 
+class TestCaseServicenowTimeouts(unittest.TestCase):
+    def setUp(self):
+        if sys.version_info >= (3, 0):
+            self.urllib_name = "urllib.request"
+        else:
+            self.urllib_name = "urllib2"
+
+    def response(self, body='{"result": []}', delay=0):
+        def fake_open(request, timeout=None):
+            time.sleep(delay)
+            mock_req = mock.Mock()
+            mock_req.getcode.return_value = 200
+            mock_req.read.return_value = body
+            return mock_req
+        return fake_open
+
+    def test_timeout(self):
+        m = mock.Mock(side_effect=self.response())
+        with mock.patch(
+                self.urllib_name + ".OpenerDirector.open", m, create=True):
+            snow = servicenow.ServiceNow("http://h:1", "user", "pass",
+                                         timeout=(2, 10))
+            snow.get('incident')
+        self.assertEqual(m.call_args[1], {'timeout': 10})
+
+    def test_timeout_error(self):
+        m = mock.Mock(side_effect=socket.timeout('timed out'))
+        with mock.patch(
+                self.urllib_name + ".OpenerDirector.open", m, create=True):
+            snow = servicenow.ServiceNow("http://h:1", "user", "pass",
+                                         timeout=1)
+            with self.assertRaises(servicenow.ServiceNowHttpError) as e:
+                snow.get('incident')
+        self.assertEqual(e.exception.code, -1)
+
+    def test_deadline(self):
+        m = mock.Mock(side_effect=self.response(delay=0.1))
+        with mock.patch(
+                self.urllib_name + ".OpenerDirector.open", m, create=True):
+            snow = servicenow.ServiceNow("http://h:1", "user", "pass",
+                                         timeout=5)
+            with snow.deadline(0.15):
+                snow.get('incident')
+                self.assertLessEqual(m.call_args[1]['timeout'], 0.15)
+                snow.get('sys_user')
+                with self.assertRaises(servicenow.ServiceNowDeadlineExceeded):
+                    snow.get('sc_task')
+            snow.get('sc_task')
+        self.assertEqual(m.call_args[1], {'timeout': 5})
+        self.assertEqual(m.call_count, 3)
+
+    def test_hedge(self):
+        calls = []
+        lock = threading.Lock()
+
+        def fake_open(request, timeout=None):
+            with lock:
+                calls.append(request.get_full_url())
+                count = len(calls)
+            # the first request of the hedged URL hangs
+            if count == 21:
+                time.sleep(1)
+            return self.response('{"result": [%d]}' % count)(request)
+        m = mock.Mock(side_effect=fake_open)
+        with mock.patch(
+                self.urllib_name + ".OpenerDirector.open", m, create=True):
+            snow = servicenow.ServiceNow("http://h:1", "user", "pass",
+                                         hedge=True)
+            for i in range(20):
+                snow.get('incident/{0}'.format(i))
+            start = time.time()
+            self.assertEqual(snow.get('incident/slow'), [22])
+            self.assertLess(time.time() - start, 0.5)
+        self.assertEqual(calls[-2:], [calls[-1]] * 2)
+
+    def test_hedge_admin(self):
+        handler = mock.Mock()
+        handler.handle.return_value = 200, {'result': [{'value': 'x'}]}
+        snow = servicenow.ServiceNow(
+            "http://h:1", "user", "pass", hedge=True,
+            transport=servicenow.transport.FakeTransport(handler))
+        for i in range(20):
+            snow.get('incident/{0}'.format(i))
+        thread = threading.Thread(target=lambda: snow._admin)
+        thread.daemon = True
+        thread.start()
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+        self.assertTrue(snow._admin)
+
+
 if __name__ == '__main__':
     import logging
     v_loglevel = "WARN"
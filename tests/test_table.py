@@ -1,15 +1,24 @@
 #!/usr/bin/env python
 # vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
 # -*- coding: utf-8 -*-
+import csv
+import gzip
+import io
 import json
 import logging
 import os
+import shutil
 import sys
+import tempfile
+import time
 import unittest
 import mock
 
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import servicenow.cache # noqa
 import servicenow.table # noqa
+import servicenow.transport # noqa
+from benchmarks.fake_server import FakeInstance # noqa
 
 
 class FakePaginate: 
@@ -75,6 +84,14 @@ class TestCaseServicenowTable(unittest.TestCase):
             handler_console.setFormatter(formatter)
             handler_console.setLevel(getattr(logging, v_loglevel))
             self.__logger.addHandler(handler_console)
+        self.instance = FakeInstance()
+
+    def fake_client(self, handler=None, **kwargs):
+        """Client answered in-process by `handler`, self.instance by default"""
+        return servicenow.table.ServiceNow(
+            "http://h:1", "user", "pass",
+            transport=servicenow.transport.FakeTransport(
+                handler or self.instance), **kwargs)
 
     def test_sysid_to_value(self):
         m = mock.Mock()
@@ -214,6 +231,47 @@ class TestCaseServicenowTable(unittest.TestCase):
             self.assertEqual(first['name'], 'uh4')
             self.assertEqual(first.name, 'uh4')
 
+    def test_getitem_block_cache(self):
+        rows = self.instance.populate('incident', 250)
+        snow = self.fake_client()
+        table = snow.Table('incident')
+        numbers = [table[i]['number'] for i in range(90, 130)]
+        self.assertEqual(numbers, [r['number'] for r in rows[90:130]])
+        self.assertEqual(self.instance.requests, 2)
+        self.assertIsNone(table[260])
+        table.insert({'number': 'INC9999999'})
+        table[95]
+        self.assertEqual(self.instance.requests, 5)
+
+    def test_getitem_block_expiry(self):
+        rows = self.instance.populate('incident', 5)
+        snow = self.fake_client()
+        table = snow.Table('incident')
+        self.assertEqual(table[0]['state'], rows[0]['state'])
+        snow.put('incident/' + rows[0]['sys_id'], {'state': 'Closed'})
+        self.assertEqual(table[0]['state'], 'Closed')
+        self.fake_client().put('incident/' + rows[0]['sys_id'],
+                               {'state': 'New'})
+        self.assertEqual(table[0]['state'], 'Closed')
+        with mock.patch('servicenow.table.time.time',
+                        return_value=time.time() + table._block_ttl + 1):
+            self.assertEqual(table[0]['state'], 'New')
+
+    def test_getitem_slice(self):
+        rows = self.instance.populate('incident', 250)
+        snow = self.fake_client()
+        table = snow.Table('incident')
+        numbers = [r['number'].value for r in table[100:200]]
+        self.assertEqual(numbers, [r['number'] for r in rows[100:200]])
+        self.assertEqual(self.instance.requests, 1)
+        table._slice_pagesize = 40
+        for index in (slice(10, 130, 3), slice(200, None),
+                      slice(None, 5), slice(-10, -2),
+                      slice(20, 5, -2), slice(None, None, -50),
+                      slice(30, 10)):
+            self.assertEqual([r['number'].value for r in table[index]],
+                             [r['number'] for r in rows[index]])
+
     def test_no_item(self):
         def fake_open(request):
             mock_req = mock.Mock()
@@ -300,6 +358,22 @@ class TestCaseServicenowTable(unittest.TestCase):
             self.assertIn('sysparm_query', i)
             self.assertEqual(i['sysparm_query'], 'nameLIKEbt1%5EORDERBYname')
 
+    def test_filter_dot_walked(self):
+        m = mock.Mock()
+        m.return_value.getcode.return_value = 200
+        m.return_value.read.return_value = json.dumps({'result': [{
+            'number': {'value': 'INC1', 'display_value': 'INC1'},
+            'caller_id.name': {'value': 'Bob', 'display_value': 'Bob'}}]})
+        with mock.patch(
+                self.urllib_name + ".OpenerDirector.open", m, create=True):
+            snow = servicenow.table.ServiceNow("http://h:1", "user", "pass")
+            rows = list(snow.Table('incident').filter(
+                fields='number,caller_id.name'))
+        self.assertEqual(rows[0].caller_id.name, 'Bob')
+        self.assertIn('sysparm_fields=number%2Ccaller_id.name',
+                      m.call_args[0][0].get_full_url())
+        self.assertEqual(m.call_count, 1)
+
     def test_search_paginate_default_00(self):
         data_list = []
         for i in range(0, 352):
@@ -425,6 +499,426 @@ class TestCaseServicenowTable(unittest.TestCase):
         self.assertEqual(f.url_params_list[1]["sysparm_offset"], "3")
         self.assertEqual(f.url_params_list[1]["result.len"], 5)
 
+    def test_count(self):
+        self.instance.populate('incident', 42)
+        snow = self.fake_client()
+        table = snow.Table('incident')
+        self.assertEqual(table.count(), 42)
+        self.assertEqual(table.count('number=INC0000001'), 1)
+
+    def test_aggregate(self):
+        rows = self.instance.populate('incident', 60)
+        handler = mock.Mock(wraps=self.instance)
+        snow = self.fake_client(handler)
+        table = snow.Table('incident')
+        total = table.aggregate('state=New', sum=['priority'],
+                                max='sys_created_on')
+        groups = table.aggregate(group_by='state', avg='priority')
+        news = [r for r in rows if r['state'] == 'New']
+        self.assertEqual(total, {
+            'count': len(news),
+            'sum': {'priority': float(sum(int(r['priority']) for r in news))},
+            'max': {'sys_created_on': max(r['sys_created_on'] for r in news)}})
+        self.assertEqual(len(groups), 3)
+        for group in groups:
+            members = [r for r in rows
+                       if r['state'] == group['group_by']['state']]
+            self.assertEqual(group['count'], len(members))
+            self.assertAlmostEqual(
+                group['avg']['priority'],
+                sum(int(r['priority']) for r in members) / len(members))
+        self.assertIn('sysparm_group_by=state',
+                      handler.handle.call_args[0][1])
+
+    def test_parallel_scan(self):
+        self.instance.populate('incident', 500)
+        snow = self.fake_client()
+        table = snow.Table('incident')
+        rows = list(table.parallel_scan(partitions=8, workers=3))
+        self.assertEqual(len(rows), 500)
+        self.assertEqual(
+            sorted(r['sys_id'].value for r in rows),
+            sorted(r['sys_id'] for r in self.instance.tables['incident']))
+        rows = list(table.parallel_scan('state=New', partitions=4,
+                                        workers=2, ordered=True))
+        self.assertEqual(
+            sorted(r['number'].value for r in rows),
+            sorted(r['number'] for r in self.instance.tables['incident']
+                   if r['state'] == 'New'))
+        ranges = [int(r['sys_id'].value[0], 16) // 4 for r in rows]
+        self.assertEqual(ranges, sorted(ranges))
+
+    def test_parallel_scan_created_on(self):
+        self.instance.populate('incident', 120)
+        snow = self.fake_client()
+        table = snow.Table('incident')
+        rows = list(table.parallel_scan(partitions=6,
+                                        by='sys_created_on',
+                                        ordered=True))
+        self.assertEqual(len(rows), 120)
+        seconds = [int(r['sys_created_on'].value[-2:]) for r in rows]
+        self.assertLess(max(seconds[:18]), 9)
+        self.assertGreaterEqual(min(seconds[-20:]), 49)
+
+    def test_parallel_scan_error(self):
+        m = mock.Mock()
+        m.return_value.open.side_effect = \
+            self.compat_urllib.HTTPError('', 500, 'Error', None, None)
+        with mock.patch(
+                self.urllib_name + ".OpenerDirector", m, create=True):
+            snow = servicenow.table.ServiceNow("http://h:1", "user", "pass")
+            with self.assertRaises(servicenow.ServiceNowHttpError):
+                list(snow.Table('incident').parallel_scan(partitions=2))
+
+    def test_export_ndjson(self):
+        self.instance.populate('incident', 95)
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'incident.ndjson')
+        snow = self.fake_client()
+        stats = snow.Table('incident').export(
+            path, fields='number,state', query='state=New')
+        with open(path) as f:
+            lines = [json.loads(line) for line in f]
+        expected = [{'number': r['number'], 'state': r['state']}
+                    for r in self.instance.tables['incident']
+                    if r['state'] == 'New']
+        self.assertEqual(lines, expected)
+        self.assertEqual(stats['rows'], len(expected))
+
+    def test_export_csv_gzip_resume(self):
+        self.instance.populate('incident', 100)
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'incident.csv.gz')
+        checkpoint = os.path.join(tmpdir, 'incident.checkpoint')
+        calls = []
+        down = [True]
+
+        def handle(method, url, body):
+            calls.append(url)
+            if len(calls) >= 2 and down[0]:
+                raise servicenow.transport.TransportError(
+                    None, 'Connection reset')
+            return self.instance.handle(method, url, body)
+        snow = self.fake_client(mock.Mock(handle=handle))
+        table = snow.Table('incident')
+        with self.assertRaises(servicenow.ServiceNowHttpError):
+            table.export(path, format='csv', fields='sys_id,number',
+                         checkpoint=checkpoint)
+        with open(checkpoint) as f:
+            self.assertEqual(json.load(f)['offset'], 30)
+        down[0] = False
+        stats = table.export(path, format='csv', fields='sys_id,number',
+                             checkpoint=checkpoint)
+        self.assertFalse(os.path.exists(checkpoint))
+        with gzip.open(path, 'rt') as f:
+            rows = list(csv.DictReader(f))
+        self.assertEqual(
+            rows, sorted([{'sys_id': r['sys_id'], 'number': r['number']}
+                          for r in self.instance.tables['incident']],
+                         key=lambda r: r['sys_id']))
+        self.assertEqual(stats['rows'], 70)
+
+    def test_page_cache(self):
+        self.instance.populate('incident', 80)
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        snow = self.fake_client(
+            page_cache=servicenow.cache.PageCache(tmpdir))
+        table = snow.Table('incident')
+        first = [r['number'].value for r in table.filter(query='state=New')]
+        requests = self.instance.requests
+        second = [r['number'].value for r in table.filter(query='state=New')]
+        self.assertEqual(first, second)
+        self.assertEqual(self.instance.requests, requests)
+
+    def test_page_cache_revalidate(self):
+        self.instance.populate('incident', 80)
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        snow = self.fake_client(
+            page_cache=servicenow.cache.PageCache(tmpdir, revalidate=True))
+        table = snow.Table('incident')
+        list(table.filter(fields='number,state'))
+        requests = self.instance.requests
+        list(table.filter(fields='number,state'))
+        self.assertEqual(self.instance.requests, requests + 1)
+        self.instance.tables['incident'][5].update(
+            {'state': 'Closed', 'sys_updated_on': '2021-01-01 00:00:00'})
+        rows = list(table.filter(fields='number,state'))
+        self.assertEqual(rows[5]['state'].value, 'Closed')
+        self.assertGreater(self.instance.requests, requests + 2)
+
+    def test_page_size_retry(self):
+        self.instance.populate('incident', 100)
+        limits = []
+
+        def handle(method, url, body):
+            limit = int(url.split('sysparm_limit=')[1].split('&')[0])
+            limits.append(limit)
+            if limit > 20:
+                return 503, {'error': {'message': 'Unavailable'}}
+            return self.instance.handle(method, url, body)
+        snow = self.fake_client(mock.Mock(handle=handle))
+        table = snow.Table('incident')
+        rows = list(table.filter(fields='number'))
+        self.assertEqual(len(rows), 100)
+        self.assertEqual(limits[:2], [30, 15])
+        self.assertEqual(limits[2:], [15] * 6)
+        self.assertEqual(snow.page_sizes._learned['incident'], 15)
+        del limits[:]
+        list(table.filter(fields='number', limit=5))
+        self.assertEqual(limits, [5])
+
+    def test_page_size_retry_exhausted(self):
+        handler = mock.Mock()
+        handler.handle.return_value = 500, {'error': {'message': 'Error'}}
+        snow = self.fake_client(
+            handler, page_sizes=servicenow.table.PageSizeController(retries=2))
+        with self.assertRaises(servicenow.ServiceNowHttpError):
+            list(snow.Table('incident').filter())
+        self.assertEqual(handler.handle.call_count, 3)
+
+    def test_page_sizes_per_client(self):
+        self.instance.populate('incident', 100)
+        transport = servicenow.transport.FakeTransport(self.instance)
+        clients = [servicenow.ServiceNow("http://h:1", "user", "pass",
+                                         transport=transport)
+                   for _ in range(2)]
+        list(servicenow.table.TableIterator(clients[0], 'incident'))
+        self.assertIn('incident', clients[0].page_sizes._learned)
+        self.assertNotIn('page_sizes', vars(clients[1]))
+        self.assertIsNot(servicenow.table._page_sizes(clients[1]),
+                         clients[0].page_sizes)
+
+    def test_update_where(self):
+        rows = self.instance.populate('incident', 150)
+        expected = [r['sys_id'] for r in rows if r['state'] == 'New']
+        snow = self.fake_client()
+        table = snow.Table('incident')
+        count = table.update_where('state=New', {'state': 'Closed'},
+                                   pagesize=20)
+        self.assertEqual(count, len(expected))
+        self.assertEqual(
+            [r['sys_id'] for r in rows if r['state'] == 'Closed'
+             and r['sys_id'] in expected], expected)
+        self.assertFalse(any(r['state'] == 'New' for r in rows))
+
+    def test_update_where_batches(self):
+        rows = self.instance.populate('incident', 150)
+        expected = len([r for r in rows if r['state'] == 'New'])
+        snow = self.fake_client()
+        count = snow.Table('incident').update_where(
+            'state=New^ORDERBYnumber', {'state': 'Closed'}, pagesize=20,
+            batch_size=30)
+        self.assertEqual(count, expected)
+        self.assertFalse(any(r['state'] == 'New' for r in rows))
+        self.assertEqual(self.instance.requests,
+                         expected // 20 + 1 + -(-expected // 30))
+
+    def test_update_where_isolates_failures(self):
+        instance = self.instance
+        rows = instance.populate('incident', 150)
+        expected = len([r for r in rows if r['state'] == 'New'])
+
+        class Flaky(object):
+            batches = 0
+
+            def handle(self, method, url, body):
+                if '/api/now/v1/batch' in url:
+                    self.batches += 1
+                    if self.batches == 1:
+                        return 503, {'error': {'message': 'Unavailable'}}
+                    if self.batches == 2:
+                        # a record deleted while updating
+                        gone = body['rest_requests'][0]['url']
+                        gone = gone.split('?')[0].split('/')[-1]
+                        rows.remove(next(r for r in rows
+                                         if r['sys_id'] == gone))
+                return instance.handle(method, url, body)
+
+        snow = self.fake_client(Flaky())
+        count = snow.Table('incident').update_where(
+            'state=New', {'state': 'Closed'}, workers=1, batch_size=10)
+        self.assertEqual(count, expected - 11)
+        self.assertEqual(len([r for r in rows if r['state'] == 'New']), 10)
+
+    def test_iterator_deadline(self):
+        instance = FakeInstance(latency=0.05)
+        instance.populate('incident', 300)
+        snow = self.fake_client(
+            instance,
+            page_sizes=servicenow.table.PageSizeController(max_size=30))
+        rows = []
+        with self.assertRaises(servicenow.ServiceNowDeadlineExceeded):
+            for row in snow.Table('incident').filter(deadline=0.12):
+                rows.append(row)
+        self.assertLess(len(rows), 300)
+        self.assertIsNone(servicenow.concurrency.remaining())
+
+    def test_upsert_many(self):
+        rows = self.instance.populate('incident', 30)
+        route = self.instance._route
+        requests = []
+
+        def failing_route(method, url, body):
+            requests.append((method, url))
+            if body and body.get('number') == 'INC9999998':
+                return 403, {'error': {'message': 'Forbidden'}}
+            return route(method, url, body)
+        snow = self.fake_client()
+        with mock.patch.object(self.instance, '_route',
+                               side_effect=failing_route):
+            outcomes = snow.Table('incident').upsert_many([
+                {'number': rows[0]['number'], 'state': 'Closed'},
+                {'number': rows[1]['number'], 'state': rows[1]['state']},
+                {'number': 'INC9999999', 'state': 'New'},
+                {'number': 'INC9999998', 'state': 'New'},
+                {'number': rows[0]['number'], 'priority': '1'},
+            ], key='number', chunk_size=2, workers=2)
+        self.assertEqual([o['action'] for o in outcomes],
+                         ['updated', 'unchanged', 'inserted', 'error',
+                          'updated'])
+        self.assertEqual(outcomes[0]['sys_id'], rows[0]['sys_id'])
+        self.assertEqual(outcomes[3]['error'].code, 403)
+        self.assertEqual((rows[0]['state'], rows[0]['priority']),
+                         ('Closed', '1'))
+        self.assertEqual(rows[-1]['number'], 'INC9999999')
+        self.assertEqual(rows[-1]['sys_id'], outcomes[2]['sys_id'])
+        self.assertEqual(len([r for r in requests if r[0] == 'GET']), 2)
+        self.assertEqual(
+            [r[1].split('?')[0] for r in requests if r[0] == 'PUT'],
+            ['/api/now/table/incident/' + rows[0]['sys_id']])
+        self.assertEqual(
+            len([r for r in requests if r[1].endswith('/v1/batch')]), 2)
+
+    def test_upsert_many_batch_error(self):
+        self.instance.populate('incident', 3)
+
+        def handle(method, url, body):
+            if url.endswith('/batch'):
+                return 503, {'error': {'message': 'Unavailable'}}
+            return self.instance.handle(method, url, body)
+        snow = self.fake_client(mock.Mock(handle=handle))
+        outcomes = snow.Table('incident').upsert_many(
+            [{'number': 'INC9999999'}], key='number')
+        self.assertEqual(outcomes[0]['action'], 'error')
+        self.assertEqual(outcomes[0]['error'].code, 503)
+
+    def test_upsert_many_comma_key(self):
+        rows = self.instance.populate('incident', 3)
+        rows[1]['number'] = 'SN1,REV2'
+        snow = self.fake_client()
+        outcomes = snow.Table('incident').upsert_many([
+            {'number': 'SN1,REV2', 'state': 'Closed'},
+            {'number': rows[0]['number'], 'state': 'Closed'}],
+            key='number')
+        self.assertEqual([o['action'] for o in outcomes],
+                         ['updated', 'updated'])
+        self.assertEqual(outcomes[0]['sys_id'], rows[1]['sys_id'])
+        self.assertEqual(len(rows), 3)
+
+    def test_upsert_many_no_key(self):
+        snow = servicenow.table.ServiceNow("http://h:1", "user", "pass")
+        with self.assertRaises(ValueError):
+            snow.Table('incident').upsert_many([{'state': 'New'}])
+
+    def test_attachment_download(self):
+        content = os.urandom(1000)
+        responses = {}
+
+        def fake_open(request):
+            response = mock.Mock()
+            response.getcode.return_value = 200
+            url = request.get_full_url()
+            if url.endswith('/file'):
+                response.read.side_effect = io.BytesIO(
+                    content + url.encode('utf-8')).read
+            else:
+                response.read.side_effect = io.BytesIO(json.dumps(
+                    {'result': [{'sys_id': 'a1', 'file_name': 'log.txt'},
+                                {'sys_id': 'a2', 'file_name': 'log.txt'},
+                                {'sys_id': 'a3', 'file_name': 'x.bin'}]}
+                ).encode('utf-8')).read
+            responses[url] = (request, response)
+            return response
+        m = mock.Mock()
+        m.return_value.open.side_effect = fake_open
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        with mock.patch(
+                self.urllib_name + ".OpenerDirector", m, create=True):
+            snow = servicenow.table.ServiceNow("http://h:1", "user", "pass")
+            table = snow.Table('incident')
+            f = io.BytesIO()
+            url = 'http://h:1/api/now/attachment/a3/file'
+            self.assertEqual(table.download({'sys_id': 'a3'}, f,
+                                            chunk_size=256),
+                             1000 + len(url))
+            self.assertEqual(f.getvalue(), content + url.encode('utf-8'))
+            request, response = responses[url]
+            self.assertEqual(request.get_header('Authorization'),
+                             'Basic dXNlcjpwYXNz')
+            self.assertEqual(set(c[0] for c in response.read.call_args_list),
+                             set([(256,)]))
+            self.assertTrue(response.close.called)
+            paths = table.download_all('123', tmpdir, workers=3)
+        self.assertIn('http://h:1/api/now/attachment?sysparm_query='
+                      'table_name%3Dincident%5Etable_sys_id%3D123', responses)
+        self.assertEqual([os.path.basename(p) for p in paths],
+                         ['a1_log.txt', 'a2_log.txt', 'x.bin'])
+        with open(paths[1], 'rb') as f:
+            self.assertTrue(f.read().endswith(b'/a2/file'))
+
+    def test_attachment_upload(self):
+        requests = []
+
+        def fake_open(request):
+            requests.append((request, request.data.read(10000)))
+            response = mock.Mock()
+            response.getcode.return_value = 201
+            response.read.side_effect = io.BytesIO(
+                b'{"result": {"sys_id": "a1"}}').read
+            return response
+        m = mock.Mock()
+        m.return_value.open.side_effect = fake_open
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'my log.txt')
+        with open(path, 'wb') as f:
+            f.write(b'x' * 5000)
+        with mock.patch(
+                self.urllib_name + ".OpenerDirector", m, create=True):
+            snow = servicenow.table.ServiceNow("http://h:1", "user", "pass")
+            with open(path, 'rb') as f:
+                res = snow.Table('incident').upload('123', f, chunk_size=1024,
+                                                    content_type='text/plain')
+        self.assertEqual(res, {'sys_id': 'a1'})
+        request, first = requests[0]
+        self.assertEqual(request.get_full_url(),
+                         'http://h:1/api/now/attachment/file?table_name='
+                         'incident&table_sys_id=123&file_name=my%20log.txt')
+        self.assertEqual(request.get_method(), 'POST')
+        self.assertEqual(request.get_header('Content-length'), '5000')
+        self.assertEqual(request.get_header('Content-type'), 'text/plain')
+        self.assertEqual(first, b'x' * 1024)
+
+    def test_attachment_not_found(self):
+        m = mock.Mock(side_effect=self.compat_urllib.HTTPError(
+            'http://h:1', 404, 'Not Found', {}, None))
+        with mock.patch(
+                self.urllib_name + ".OpenerDirector.open", m, create=True):
+            snow = servicenow.table.ServiceNow("http://h:1", "user", "pass")
+            with self.assertRaises(servicenow.ServiceNowHttpError) as e:
+                snow.Table('incident').download('a1', io.BytesIO())
+        self.assertEqual(e.exception.code, 404)
+
+    def test_update_where_no_query(self):
+        snow = servicenow.table.ServiceNow("http://h:1", "user", "pass")
+        with self.assertRaises(ValueError):
+            snow.Table('incident').update_where(None, {'state': 'Closed'})
+
     def test_search_wrong_field(self):
         def fake_open(request):
             mock_req = mock.Mock()
@@ -459,6 +953,42 @@ class TestCaseServicenowTable(unittest.TestCase):
         tr2 = servicenow.table.TableRow(table, {'name':'toto', 'adr':'ici','sys_id':'256'})
         self.assertTrue(tr1 == tr2)
 
+    def test_dot_walked_fields(self):
+        parent = mock.MagicMock()
+        row = servicenow.table.TableRow(parent, {
+            'number': {'value': 'INC1', 'display_value': 'INC1'},
+            'caller_id': {'link': 'http://h:1/api/now/table/sys_user/123',
+                          'value': '123', 'display_value': 'Bob'},
+            'caller_id.name': {'value': 'Bob', 'display_value': 'Bob'},
+            'assignment_group.manager.email': {
+                'value': 'a@b.c', 'display_value': 'a@b.c'},
+        })
+        self.assertEqual(row.caller_id, 'Bob')
+        self.assertEqual(row.caller_id.name, 'Bob')
+        self.assertIs(row.caller_id.name, row['caller_id.name'])
+        self.assertEqual(row.assignment_group.manager.email, 'a@b.c')
+        self.assertNotIn('assignment_group', row)
+        self.assertIsNone(row.number.reference)
+
+    def test_reference(self):
+        parent = mock.MagicMock()
+        parent.snow.get.return_value = {
+            'email': {'value': 'bob@h', 'display_value': 'bob@h'}}
+        row = servicenow.table.TableRow(parent, {
+            'caller_id': {'link': 'http://h:1/api/now/table/sys_user/123',
+                          'value': '123', 'display_value': 'Bob'}})
+        reference = row.caller_id.reference
+        self.assertEqual((reference.table, reference.sys_id),
+                         ('sys_user', '123'))
+        self.assertEqual(parent.snow.get.call_count, 0)
+        self.assertEqual(reference.email, 'bob@h')
+        self.assertEqual(reference['email'].value, 'bob@h')
+        self.assertIs(row.caller_id.reference, reference)
+        parent.snow.get.assert_called_once_with('sys_user/123',
+                                                display_value='all')
+        with self.assertRaises(AttributeError):
+            reference.phone
+
     def test_setitem(self):
         parent = mock.MagicMock()
         parent.snow = mock.MagicMock()
@@ -496,6 +1026,118 @@ class TestCaseServicenowTable(unittest.TestCase):
         )
 
 
+class TestCaseServicenowFieldInterner(unittest.TestCase):
+    def setUp(self):
+        self.snow = servicenow.table.ServiceNow(
+            'https://test.service-now.com', 'user', 'pass',
+            interner=servicenow.table.FieldInterner(max_values=2,
+                                                    max_length=10))
+        self.table = self.snow.Table('incident')
+
+    def test_shared(self):
+        first = servicenow.table.TableRow(self.table, {
+            'state': 'New', 'caller_id': {'link': 'http://l',
+                                          'display_value': 'Bob',
+                                          'value': '123'}})
+        second = servicenow.table.TableRow(self.table, {
+            'state': 'New', 'caller_id': {'link': 'http://l',
+                                           'display_value': 'Bob',
+                                           'value': '123'}})
+        self.assertIs(first['state'], second['state'])
+        self.assertIsNot(first.caller_id, second.caller_id)
+        self.assertIs(first.caller_id.link, second.caller_id.link)
+        self.assertIs(first.caller_id.value, second.caller_id.value)
+        self.assertEqual(second['caller_id'], 'Bob')
+        other = servicenow.table.TableRow(self.snow.Table('problem'),
+                                          {'state': 'New'})
+        self.assertIsNot(other['state'], first['state'])
+
+    def test_reference_not_shared(self):
+        data = {'caller_id': {
+            'link': 'https://test.service-now.com/api/now/table/sys_user/123',
+            'display_value': 'Bob', 'value': '123'}}
+        first = servicenow.table.TableRow(self.table, data)
+        second = servicenow.table.TableRow(self.table, data)
+        with mock.patch.object(self.snow, 'get',
+                               return_value={'email': 'bob@x'}) as get:
+            self.assertEqual(first.caller_id.reference['email'], 'bob@x')
+            self.assertIsNot(first.caller_id.reference,
+                             second.caller_id.reference)
+            second.caller_id.reference['email']
+        self.assertEqual(get.call_count, 2)
+
+    def test_bounded(self):
+        rows = [servicenow.table.TableRow(self.table, {'state': v})
+                for v in ('1', '2', '3', '3', 'a' * 11, 'a' * 11)]
+        self.assertIs(rows[0]['state'], servicenow.table.TableRow(
+            self.table, {'state': '1'})['state'])
+        self.assertIsNot(rows[2]['state'], rows[3]['state'])
+        self.assertIsNot(rows[4]['state'], rows[5]['state'])
+        self.assertEqual(rows[4]['state'], 'a' * 11)
+
+    def test_setitem_not_shared(self):
+        with mock.patch.object(self.snow, 'put'):
+            first = servicenow.table.TableRow(self.table, {
+                'sys_id': '1', 'state': 'New'})
+            second = servicenow.table.TableRow(self.table, {
+                'sys_id': '2', 'state': 'New'})
+            first['state'] = 'Closed'
+        self.assertEqual(first['state'], 'Closed')
+        self.assertEqual(first.state.value, 'Closed')
+        self.assertEqual(second['state'], 'New')
+
+    def test_insert_existing_row(self):
+        instance = FakeInstance()
+        instance.populate('incident', 2)
+        snow = servicenow.table.ServiceNow(
+            'http://fake', 'admin', 'admin',
+            transport=servicenow.transport.FakeTransport(instance))
+        table = snow.Table('incident')
+        row = table[0]
+        copy = servicenow.table.TableRow(table, dict(row))
+        self.assertEqual(copy['number'], row['number'])
+        res = table.insert(row)
+        self.assertEqual(res['number'], row['number'])
+        self.assertEqual(len(instance.tables['incident']), 3)
+
+    def test_dot_walked_not_shared(self):
+        first = servicenow.table.TableRow(self.table, {
+            'caller_id': 'Bob', 'caller_id.phone': '1'})
+        second = servicenow.table.TableRow(self.table, {
+            'caller_id': 'Bob', 'caller_id.phone': '2'})
+        self.assertEqual(first.caller_id.phone, '1')
+        self.assertEqual(second.caller_id.phone, '2')
+
+
+class TestCaseServicenowPageSizeController(unittest.TestCase):
+    def test_next(self):
+        controller = servicenow.table.PageSizeController(
+            target=1, min_size=10, max_size=1000, smoothing=0.5)
+        self.assertEqual(controller.next(100, 1), 100)
+        self.assertEqual(controller.next(100, 2), 75)
+        self.assertEqual(controller.next(100, 0.1), 200)
+        self.assertEqual(controller.next(100, 0), 200)
+        self.assertEqual(controller.next(800, 0.1), 1000)
+        self.assertEqual(controller.next(10, 100), 10)
+
+    def test_failed(self):
+        controller = servicenow.table.PageSizeController(retries=2)
+        error = servicenow.ServiceNowHttpError('http://h', 503, '', '')
+        self.assertEqual(controller.failed(100, error, 1), 50)
+        self.assertEqual(controller.failed(50, error, 2), 25)
+        self.assertIsNone(controller.failed(25, error, 3))
+        self.assertIsNone(controller.failed(1, error, 1))
+        error = servicenow.ServiceNowHttpError('http://h', 403, '', '')
+        self.assertIsNone(controller.failed(100, error, 1))
+
+    def test_learn(self):
+        controller = servicenow.table.PageSizeController()
+        self.assertEqual(controller.initial('incident', 30), 30)
+        controller.learn('incident', 120)
+        self.assertEqual(controller.initial('incident', 30), 120)
+        self.assertEqual(controller.initial('sys_user', 30), 30)
+
+
 if __name__ == '__main__':
     import logging
     v_loglevel = "DEBUG"
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import unittest
+import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import servicenow.table  # noqa
+import servicenow.transport  # noqa
+import servicenow.ws  # noqa
+from benchmarks.fake_server import FakeInstance  # noqa
+
+
+class TestCaseServicenowTransport(unittest.TestCase):
+    def setUp(self):
+        if sys.version_info >= (3, 0):
+            self.urllib_name = "urllib.request"
+            self.compat_urllib = __import__(
+                "urllib.request", fromlist=("request",))
+        else:
+            self.urllib_name = "urllib2"
+            self.compat_urllib = __import__("urllib2")
+
+    def test_get_transport(self):
+        args = ('http://h:1', 'user', 'pass')
+        self.assertIsInstance(servicenow.transport.get_transport(None, *args),
+                              servicenow.transport.UrllibTransport)
+        self.assertIsInstance(
+            servicenow.transport.get_transport('urllib', *args),
+            servicenow.transport.UrllibTransport)
+        fake = servicenow.transport.FakeTransport(FakeInstance())
+        self.assertIs(servicenow.transport.get_transport(fake, *args), fake)
+        with self.assertRaises(ValueError):
+            servicenow.transport.get_transport('toto', *args)
+
+    def test_get_transport_auto(self):
+        with mock.patch.dict(sys.modules, {'urllib3': None, 'requests': None,
+                                           'httpx': None}):
+            transport = servicenow.transport.get_transport(
+                'auto', 'http://h:1', 'user', 'pass')
+        self.assertIsInstance(transport, servicenow.transport.UrllibTransport)
+
+    def test_urllib_errors(self):
+        m = mock.Mock(side_effect=self.compat_urllib.URLError('refused'))
+        with mock.patch(
+                self.urllib_name + ".OpenerDirector.open", m, create=True):
+            snow = servicenow.ServiceNow("http://h:1", "user", "pass")
+            with self.assertRaises(servicenow.ServiceNowHttpError) as e:
+                snow.get('incident')
+        self.assertEqual(e.exception.code, -1)
+        self.assertEqual(e.exception.message, 'refused')
+
+    def test_urllib3(self):
+        urllib3 = mock.Mock()
+        response = urllib3.PoolManager.return_value.request.return_value
+        response.status = 200
+        response.reason = 'OK'
+        response.data = b'{"result": [{"sys_id": "1"}]}'
+        with mock.patch.dict(sys.modules, {'urllib3': urllib3}):
+            snow = servicenow.ServiceNow("http://h:1", "user", "pass",
+                                         transport='urllib3')
+            self.assertEqual(snow.get('incident'), [{'sys_id': '1'}])
+            response.status = 404
+            response.reason = 'Not Found'
+            with self.assertRaises(servicenow.ServiceNowHttpError) as e:
+                snow.get('incident')
+        self.assertEqual(e.exception.code, 404)
+        _, kwargs = urllib3.PoolManager.return_value.request.call_args
+        self.assertEqual(kwargs['headers']['Authorization'],
+                         'Basic dXNlcjpwYXNz')
+
+    def test_custom_transport(self):
+        class Transport(servicenow.transport.Transport):
+            def send(self, method, url, headers, body=None, timeout=None):
+                return 200, 'OK', b'{"result": {"url": "' + \
+                    url.encode('utf-8') + b'"}}'
+        snow = servicenow.ServiceNow("http://h:1", "user", "pass",
+                                     transport=Transport())
+        self.assertEqual(snow.get('incident/1'),
+                         {'url': 'http://h:1/api/now/table/incident/1'})
+
+    def test_fake_transport(self):
+        instance = FakeInstance()
+        rows = instance.populate('incident', 80)
+        new = len([r for r in rows if r['state'] == 'New'])
+        transport = servicenow.transport.FakeTransport(instance)
+        snow = servicenow.table.ServiceNow("http://h:1", "user", "pass",
+                                           transport=transport)
+        table = snow.Table('incident')
+        self.assertEqual([r['sys_id'].value for r in table],
+                         [r['sys_id'] for r in rows])
+        record = table.insert({'number': 'INC9999999'})
+        self.assertEqual(instance.tables['incident'][-1]['sys_id'],
+                         record['sys_id'])
+        with self.assertRaises(servicenow.ServiceNowHttpError) as e:
+            snow.get('incident/unknown')
+        self.assertEqual(e.exception.code, 404)
+        ws = servicenow.ws.ServiceNow("http://h:1", "user", "pass",
+                                      transport=transport)
+        self.assertEqual(len(ws.get('incident', query='state=New')), new)
+
+
+if __name__ == '__main__':
+    unittest.main()
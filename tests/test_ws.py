@@ -9,7 +9,14 @@ import unittest
 import mock
 
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import servicenow.cache # noqa
 import servicenow.ws # noqa
+from servicenow.query import Q # noqa
+
+try:
+    from urllib.parse import unquote
+except ImportError:
+    from urllib import unquote
 
 
 class TestCaseServicenowWebService(unittest.TestCase):
@@ -55,6 +62,80 @@ class TestCaseServicenowWebService(unittest.TestCase):
             self.assertEqual(snow.delete('u_goal_uh/123'), [])
         m.assert_called_with('POST', 'http://h:1/u_goal_uh.do?JSONv2&sysparm_action=deleteRecord&sysparm_sys_id=123', status_codes=(200, 202, 204))
 
+    def test_response_cache(self):
+        m = mock.Mock()
+        m.return_value.getcode.return_value = 200
+        m.return_value.read.return_value = '{"records":[{"sys_id":"123"}]}'
+        urllib_name = "urllib.request" if sys.version_info >= (3, 0) \
+            else "urllib2"
+        with mock.patch(
+                urllib_name + ".OpenerDirector.open", m, create=True):
+            snow = servicenow.ws.ServiceNow(
+                "http://h:1", "user", "pass",
+                response_cache=servicenow.cache.ResponseCache())
+            snow.get('u_goal_uh/123')
+            snow.get('u_goal_uh/123')
+            snow.get('other/123')
+            self.assertEqual(m.call_count, 2)
+            snow.put('u_goal_uh/123', {'name': 'toto'})
+            snow.get('u_goal_uh/123')
+            snow.get('other/123')
+            self.assertEqual(m.call_count, 4)
+
+    def test_bulk_get(self):
+        keys = ['{0:032x}'.format(i) for i in range(25)]
+
+        def fake_call(method, url, status_codes):
+            self.assertEqual(method, 'GET')
+            if 'sysparm_action=getKeys' in url:
+                self.assertIn('sysparm_query=active%3Dtrue', url)
+                return [','.join(keys)]
+            self.assertIn('sysparm_action=getRecords', url)
+            query = unquote(url.split('sysparm_query=')[1].split('&')[0])
+            self.assertTrue(query.startswith('sys_idIN'))
+            return [{'sys_id': k} for k in query[8:].split(',')]
+        m = mock.Mock(side_effect=fake_call)
+        with mock.patch(
+                "servicenow.ServiceNow._call", m, create=True):
+            snow = servicenow.ws.ServiceNow("http://h:1", "user", "pass")
+            rows = list(snow.bulk_get('incident', query='active=true',
+                                      chunk_size=10, workers=3))
+        self.assertEqual([r['sys_id'] for r in rows], keys)
+        self.assertEqual(m.call_count, 4)
+
+    def test_bulk_get_no_record(self):
+        m = mock.Mock(return_value=[''])
+        with mock.patch(
+                "servicenow.ServiceNow._call", m, create=True):
+            snow = servicenow.ws.ServiceNow("http://h:1", "user", "pass")
+            self.assertEqual(list(snow.bulk_get('incident')), [])
+        self.assertEqual(m.call_count, 1)
+
+    def test_update_where(self):
+        m = mock.Mock()
+        m.return_value = [{"sys_id": "1"}, {"sys_id": "2"}]
+        with mock.patch(
+                "servicenow.ServiceNow._call", m, create=True):
+            snow = servicenow.ws.ServiceNow("http://h:1", "user", "pass")
+            self.assertEqual(snow.update_where(
+                'incident', 'state=1', {'state': '2'}), 2)
+        m.assert_called_once_with('POST', 'http://h:1/incident.do?JSONv2&sysparm_action=update&sysparm_query=state%3D1', status_codes=(200, 204), params={'state': '2'})
+
+    def test_update_where_structured_query(self):
+        m = mock.Mock()
+        m.return_value = [{"sys_id": "1"}]
+        with mock.patch(
+                "servicenow.ServiceNow._call", m, create=True):
+            snow = servicenow.ws.ServiceNow("http://h:1", "user", "pass")
+            self.assertEqual(snow.update_where(
+                'incident', Q('state') == 'In Progress', {'state': '2'}), 1)
+        m.assert_called_once_with('POST', 'http://h:1/incident.do?JSONv2&sysparm_action=update&sysparm_query=state%3DIn%20Progress', status_codes=(200, 204), params={'state': '2'})
+
+    def test_update_where_no_query(self):
+        snow = servicenow.ws.ServiceNow("http://h:1", "user", "pass")
+        with self.assertRaises(ValueError):
+            snow.update_where('incident', '', {'state': '2'})
+
     def test_delete_no_sysid(self):
             snow = servicenow.ws.ServiceNow("http://h:1", "user", "pass")
             with self.assertRaises(ValueError) as e: